@@ -2,5 +2,5 @@
 set -xe
 
 cd yarnspawner
-py.test yarnspawner --verbose
+py.test yarnspawner --verbose -m "not slow"
 flake8 yarnspawner
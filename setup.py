@@ -25,5 +25,8 @@ setup(name='jupyterhub-yarnspawner',
                    'Programming Language :: Python',
                    'Programming Language :: Python :: 3'],
       packages=['yarnspawner'],
-      python_requires='>=3.5',
-      install_requires=['jupyterhub>=0.8', 'skein>=0.5.0'])
+      entry_points={
+          'console_scripts': ['yarnspawner = yarnspawner.cli:main']
+      },
+      python_requires='>=3.7',
+      install_requires=['jupyterhub>=0.8', 'skein>=0.8.0'])
@@ -0,0 +1,188 @@
+import asyncio
+from collections import deque
+
+from tornado.log import app_log
+
+from .cluster import queue_usage
+from .tracing import detach
+
+
+class AdmissionCancelled(RuntimeError):
+    """A ticket was released while still waiting in line"""
+
+
+class AdmissionTicket(object):
+    """A place in line to submit an application"""
+    __slots__ = ('controller', 'admitted', 'released', '_future')
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.admitted = False
+        self.released = False
+        self._future = asyncio.get_event_loop().create_future()
+
+    @property
+    def position(self):
+        """The 1-based position in line, or 0 if admitted"""
+        return self.controller.position(self)
+
+    async def wait(self):
+        """Wait until admitted"""
+        try:
+            await asyncio.shield(self._future)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        """Give up this ticket's place, or its admitted slot. Idempotent.
+
+        Releasing a ticket still waiting in line makes ``wait`` fail with
+        ``AdmissionCancelled``."""
+        self.controller.release(self)
+
+
+class AdmissionController(object):
+    """Hold back submissions to a YARN queue until it has room.
+
+    Submissions are admitted in order while both:
+
+    - fewer than ``max_pending`` admitted applications have yet to start
+      running
+    - the queue is running, and is using less than ``max_usage`` percent of
+      its maximum capacity
+
+    The queue's usage is fetched at most every ``ttl`` seconds. If it can't
+    be fetched, only the first condition applies.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to request queue information with.
+    queue : str
+        The queue name.
+    max_pending : int, optional
+        The maximum number of admitted applications not yet running.
+    max_usage : float, optional
+        The queue usage (as a percentage of its maximum capacity) above which
+        submissions are held.
+    ttl : float, optional
+        The maximum age (in seconds) of queue information.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, queue, max_pending=20, max_usage=95.0, ttl=5.0,
+                 log=None):
+        self.client = client
+        self.queue = queue
+        self.max_pending = max_pending
+        self.max_usage = max_usage
+        self.ttl = ttl
+        self.log = log or app_log
+        self.pending = 0
+        self._waiting = deque()
+        self._info = None
+        self._info_time = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def position(self, ticket):
+        if ticket.admitted or ticket.released:
+            return 0
+        try:
+            return self._waiting.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    @property
+    def usage(self):
+        """The last known queue usage, as a percentage of its maximum
+        capacity, or None if unknown"""
+        return queue_usage(self._info)
+
+    def enqueue(self):
+        """Get in line for admission, returning a ticket.
+
+        The ticket must be released once the application is running, or has
+        failed to start."""
+        ticket = AdmissionTicket(self)
+        self._waiting.append(ticket)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return ticket
+
+    async def admit(self):
+        """Wait in line until admitted, returning the ticket"""
+        ticket = self.enqueue()
+        await ticket.wait()
+        return ticket
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self.pending -= 1
+            self._wakeup.set()
+        else:
+            try:
+                self._waiting.remove(ticket)
+            except ValueError:
+                pass
+            if not ticket._future.done():
+                ticket._future.set_exception(
+                    AdmissionCancelled("Gave up waiting for room in queue %s"
+                                       % self.queue)
+                )
+                # Mark the exception as retrieved, there may be no waiter
+                ticket._future.exception()
+
+    async def _refresh(self):
+        loop = asyncio.get_event_loop()
+        if (self._info_time is not None and
+                loop.time() - self._info_time < self.ttl):
+            return
+        try:
+            self._info = await self.client.get_queue(self.queue)
+        except Exception as exc:
+            if self._info_time is None:
+                self.log.warning("Failed to get information for queue %s, "
+                                 "admission will only be limited by "
+                                 "pending applications", self.queue,
+                                 exc_info=exc)
+            self._info = None
+        self._info_time = loop.time()
+
+    def _has_room(self):
+        if self.pending >= self.max_pending:
+            return False
+        info = self._info
+        if info is None:
+            return True
+        if str(info.state) != 'RUNNING':
+            return False
+        usage = self.usage
+        return usage is None or usage < self.max_usage
+
+    async def _run(self):
+        detach()
+        while self._waiting:
+            self._wakeup.clear()
+            if self.pending < self.max_pending:
+                await self._refresh()
+            while self._waiting and self._has_room():
+                ticket = self._waiting.popleft()
+                ticket.admitted = True
+                self.pending += 1
+                ticket._future.set_result(None)
+            if not self._waiting:
+                break
+            # Wait for a slot to free up, or for the queue info to expire
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.ttl)
+            except asyncio.TimeoutError:
+                pass
@@ -2,6 +2,8 @@ import json
 from tornado import web
 from jupyterhub.apihandlers import APIHandler, default_handlers
 
+from .spawner import YarnSpawner
+
 
 # Borrowed and modified from jupyterhub/batchspawner:
 # https://github.com/jupyterhub/batchspawner/blob/d1052385f2/batchspawner/api.py
@@ -11,10 +13,45 @@ class YarnSpawnerAPIHandler(APIHandler):
         """POST set user's spawner port number"""
         user = self.current_user
         data = self.get_json_body()
+        usage = data.get('usage')
+        if usage:
+            try:
+                user.spawner.add_usage(usage)
+            except ValueError as exc:
+                raise web.HTTPError(400, str(exc))
+            # Usage history is kept in the spawner's state
+            user.spawner.orm_spawner.state = user.spawner.get_state()
+            self.db.commit()
+        if 'port' not in data:
+            self.finish(json.dumps({"message": "YarnSpawner usage recorded"}))
+            self.set_status(201)
+            return
         port = int(data.get('port', 0))
-        user.spawner.current_port = port
+        trace = data.get('trace')
+        if trace:
+            user.spawner.add_trace(trace)
+        user.spawner.set_port(port)
         self.finish(json.dumps({"message": "YarnSpawner port configured"}))
         self.set_status(201)
 
 
+class YarnSpawnerDiagnosticsHandler(APIHandler):
+    @web.authenticated
+    def get(self, app_id=None):
+        """GET diagnostics for servers that recently failed to start"""
+        if not self.current_user.admin:
+            raise web.HTTPError(403)
+        entries = [e.to_dict() for e in YarnSpawner.failure_diagnostics()
+                   if app_id is None or e.app_id == app_id]
+        if app_id is not None:
+            if not entries:
+                raise web.HTTPError(404)
+            entries = entries[-1]
+        self.finish(json.dumps(entries))
+
+
 default_handlers.append((r"/api/yarnspawner", YarnSpawnerAPIHandler))
+default_handlers.append((r"/api/yarnspawner/diagnostics",
+                         YarnSpawnerDiagnosticsHandler))
+default_handlers.append((r"/api/yarnspawner/diagnostics/([^/]+)",
+                         YarnSpawnerDiagnosticsHandler))
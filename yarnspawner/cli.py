@@ -0,0 +1,51 @@
+import argparse
+import sys
+
+from .environments import EnvironmentSpec, build, config_snippet
+
+
+def build_env(args):
+    spec = EnvironmentSpec.from_file(args.spec)
+
+    def log(msg):
+        print(msg, file=sys.stderr)
+
+    path = build(spec, output_dir=args.output_dir, log=log)
+    snippet = config_snippet(spec, path)
+    if args.config:
+        with open(args.config, 'w') as f:
+            f.write(snippet)
+        log("Wrote configuration to %s" % args.config)
+    else:
+        print(snippet, end='')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='yarnspawner',
+        description='Tools for administering YarnSpawner deployments'
+    )
+    subs = parser.add_subparsers(metavar='command', dest='command')
+    subs.required = True
+
+    build_parser = subs.add_parser(
+        'build-env',
+        help='Build and publish a packaged Python environment',
+        description=('Build an environment archive from a specification, '
+                     'publish it, and print the matching configuration. '
+                     'Environments that were already built are reused.')
+    )
+    build_parser.add_argument('spec', help='Path to the environment specification')
+    build_parser.add_argument('--output-dir', default='.',
+                              help='Directory to write archives to')
+    build_parser.add_argument('--config',
+                              help=('File to write configuration to, instead '
+                                    'of printing it'))
+    build_parser.set_defaults(func=build_env)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
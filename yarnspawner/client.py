@@ -0,0 +1,571 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+import skein
+from skein import proto
+from skein.exceptions import context, ConnectionError, TimeoutError, DriverError
+from skein.model import (ApplicationReport, ApplicationSpec, ApplicationState,
+                         NodeReport, NodeState, Queue)
+from skein.utils import datetime_to_millis
+
+from .metrics import (observe_rpc, RPC_QUEUED_REQUESTS, RPC_QUEUE_WAIT_SECONDS,
+                      RPC_RUNNING_REQUESTS)
+from .tracing import child_span
+
+
+def _timed(operation, func):
+    """Wrap ``func`` to record its duration as a skein ``operation``"""
+    def inner(*args, **kwargs):
+        with observe_rpc(operation), child_span('rpc.%s' % operation):
+            return func(*args, **kwargs)
+    return inner
+
+
+class OperationStats(object):
+    """Counters for a single kind of skein operation, also exported as
+    metrics"""
+    __slots__ = ('queued', 'running', 'calls', 'wait_time', 'max_wait_time',
+                 '_queued_gauge', '_running_gauge', '_wait_histogram')
+
+    def __init__(self, operation):
+        self.queued = 0
+        self.running = 0
+        self.calls = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._queued_gauge = RPC_QUEUED_REQUESTS.labels(operation)
+        self._running_gauge = RPC_RUNNING_REQUESTS.labels(operation)
+        self._wait_histogram = RPC_QUEUE_WAIT_SECONDS.labels(operation)
+
+    def enqueued(self):
+        self.queued += 1
+        self._queued_gauge.inc()
+
+    def dequeued(self):
+        self.queued -= 1
+        self._queued_gauge.dec()
+
+    def started(self, wait):
+        self.dequeued()
+        self.running += 1
+        self._running_gauge.inc()
+        self.calls += 1
+        self.wait_time += wait
+        self.max_wait_time = max(self.max_wait_time, wait)
+        self._wait_histogram.observe(wait)
+
+    def finished(self):
+        self.running -= 1
+        self._running_gauge.dec()
+
+    @property
+    def mean_wait_time(self):
+        return self.wait_time / self.calls if self.calls else 0.0
+
+    def to_dict(self):
+        return {'queued': self.queued,
+                'running': self.running,
+                'calls': self.calls,
+                'wait_time': self.wait_time,
+                'mean_wait_time': self.mean_wait_time,
+                'max_wait_time': self.max_wait_time}
+
+
+class SkeinExecutor(object):
+    """A bounded thread pool for blocking skein calls.
+
+    Each kind of operation (e.g. ``'submit'``, ``'report'``, ``'kill'``) may
+    have its own concurrency limit, so a burst of slow calls of one kind can't
+    occupy every worker thread. Starting and stopping drivers, and health
+    checks, run in separate threads. Health checks then don't wait behind
+    other requests, and a hung driver holding every worker can still be
+    replaced.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The number of worker threads.
+    limits : dict, optional
+        A mapping of operation name to the maximum number of concurrent calls
+        of that operation. Operations without a limit are only bounded by
+        ``max_workers``.
+    control_ops : iterable of str, optional
+        Operations run in the separate control threads.
+    """
+    def __init__(self, max_workers=16, limits=None,
+                 control_ops=('connect', 'ping')):
+        self.max_workers = max_workers
+        self.limits = dict(limits or {})
+        self.control_ops = frozenset(control_ops)
+        self._pool = ThreadPoolExecutor(max_workers,
+                                        thread_name_prefix='yarnspawner')
+        self._control_pool = ThreadPoolExecutor(
+            2, thread_name_prefix='yarnspawner-control'
+        )
+        self._semaphores = {}
+        self._stats = {}
+
+    def _semaphore(self, op):
+        sem = self._semaphores.get(op)
+        if sem is None and self.limits.get(op):
+            sem = self._semaphores[op] = asyncio.Semaphore(self.limits[op])
+        return sem
+
+    def _op_stats(self, op):
+        stats = self._stats.get(op)
+        if stats is None:
+            stats = self._stats[op] = OperationStats(op)
+        return stats
+
+    def stats(self):
+        """Queue depth, concurrency, and wait times by operation"""
+        return {op: s.to_dict() for op, s in self._stats.items()}
+
+    @property
+    def queued(self):
+        """The total number of calls waiting to run"""
+        return sum(s.queued for s in self._stats.values())
+
+    async def run(self, op, func, *args):
+        """Run ``func(*args)`` in a worker thread, as operation ``op``"""
+        loop = asyncio.get_event_loop()
+        stats = self._op_stats(op)
+        sem = self._semaphore(op)
+        submitted = time.monotonic()
+        stats.enqueued()
+        started = False
+
+        def call():
+            nonlocal started
+            started = True
+            loop.call_soon_threadsafe(on_start, time.monotonic())
+            return func(*args)
+
+        def on_start(now):
+            stats.started(now - submitted)
+
+        try:
+            if sem is not None:
+                await sem.acquire()
+            try:
+                # Run in a copy of the current context, so calls are traced
+                ctx = contextvars.copy_context()
+                pool = (self._control_pool if op in self.control_ops
+                        else self._pool)
+                return await loop.run_in_executor(pool, ctx.run, call)
+            finally:
+                if sem is not None:
+                    sem.release()
+        finally:
+            # If the call started, ``on_start`` was scheduled before the
+            # result, and has already run.
+            if started:
+                stats.finished()
+            else:
+                stats.dequeued()
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait)
+        self._control_pool.shutdown(wait=wait)
+
+
+class _Client(skein.Client):
+    """A ``skein.Client`` with a default deadline on requests, so calls to a
+    hung driver don't hold a worker thread forever.
+
+    Submits have their own deadline, since the driver uploads any local files
+    while submitting."""
+    rpc_timeout = None
+    submit_timeout = None
+
+    def _call(self, method, req, timeout=None):
+        if timeout is None:
+            timeout = (self.submit_timeout if method == 'submit'
+                       else self.rpc_timeout)
+        return super()._call(method, req, timeout=timeout)
+
+
+def _start_driver(timeout=None, submit_timeout=None, **kwargs):
+    client = _Client(**kwargs)
+    client.rpc_timeout = timeout
+    client.submit_timeout = submit_timeout
+    return client
+
+
+def _kill_driver(client):
+    proc = client._proc
+    if proc is not None and proc.poll() is None:
+        proc.kill()
+
+
+class ThreadedClient(object):
+    """An asynchronous wrapper around a ``skein.Client``.
+
+    Blocking calls are run in a ``SkeinExecutor``.
+
+    Parameters
+    ----------
+    client : skein.Client
+        The wrapped client.
+    executor : SkeinExecutor
+        The executor to run calls in.
+    """
+    def __init__(self, client, executor):
+        self.client = client
+        self.executor = executor
+
+    @classmethod
+    async def connect(cls, executor, timeout=None, submit_timeout=None,
+                      **kwargs):
+        """Start a new driver and connect to it.
+
+        ``timeout`` is the deadline (in seconds) for each request, other than
+        submits which use ``submit_timeout``. Other keyword arguments are
+        forwarded to ``skein.Client``."""
+        client = await executor.run(
+            'connect',
+            _timed('connect',
+                   lambda: _start_driver(timeout, submit_timeout, **kwargs))
+        )
+        return cls(client, executor)
+
+    def _submit(self, spec):
+        if isinstance(spec, proto.ApplicationSpec):
+            # Already serialized, skip validation and conversion
+            return self.client._call('submit', spec).id
+        return self.client.submit(spec)
+
+    async def submit(self, spec):
+        return await self.executor.run('submit',
+                                       _timed('submit', self._submit), spec)
+
+    async def application_report(self, app_id):
+        return await self.executor.run(
+            'report', _timed('report', self.client.application_report), app_id
+        )
+
+    async def get_applications(self, **kwargs):
+        return await self.executor.run(
+            'report',
+            _timed('list', lambda: self.client.get_applications(**kwargs))
+        )
+
+    async def kill_application(self, app_id, user=""):
+        return await self.executor.run(
+            'kill', _timed('kill', self.client.kill_application), app_id, user
+        )
+
+    async def get_queue(self, name):
+        return await self.executor.run(
+            'report', _timed('queue', self.client.get_queue), name
+        )
+
+    async def application_logs(self, app_id, user=""):
+        """Logs by container id, for a finished application"""
+        logs = await self.executor.run(
+            'logs', _timed('logs', self.client.application_logs), app_id, user
+        )
+        return dict(logs)
+
+    async def get_nodes(self, states=None):
+        return await self.executor.run(
+            'report', _timed('nodes', self.client.get_nodes), states
+        )
+
+    def _ping(self, timeout):
+        proc = self.client._proc
+        if proc is not None and proc.poll() is not None:
+            raise ConnectionError("Driver process exited with code %d"
+                                  % proc.returncode)
+        self.client._call('ping', proto.Empty(), timeout=timeout)
+
+    async def ping(self, timeout=None):
+        """Check the driver is alive and responding"""
+        await self.executor.run('ping', _timed('ping', self._ping), timeout)
+
+    def abort(self):
+        """Kill the driver if it was started by this client, without waiting
+        for a worker thread. Requests in flight fail."""
+        _kill_driver(self.client)
+
+    async def close(self):
+        """Close the client, stopping the driver if it was started by it"""
+        await self.executor.run('connect', self.client.close)
+
+
+class AsyncioClient(object):
+    """An asynchronous client for the skein driver, using grpc's asyncio API.
+
+    Supports the subset of ``skein.Client`` used by ``YarnSpawner``, with
+    requests made directly on the event loop instead of in worker threads.
+    The driver process is owned by the wrapped (blocking) ``skein.Client``.
+
+    Parameters
+    ----------
+    client : skein.Client
+        A connected client, used to find and authenticate with the driver.
+    executor : SkeinExecutor
+        The executor to stop the driver in.
+    timeout : float, optional
+        The deadline (in seconds) for each request, other than submits.
+    submit_timeout : float, optional
+        The deadline (in seconds) for submits.
+    """
+    _active_states = ('SUBMITTED', 'ACCEPTED', 'RUNNING')
+
+    # Driver methods to operation names, for metrics
+    _operations = {'ping': 'ping',
+                   'submit': 'submit',
+                   'getStatus': 'report',
+                   'getApplications': 'list',
+                   'getQueue': 'queue',
+                   'getNodes': 'nodes',
+                   'getLogs': 'logs',
+                   'kill': 'kill'}
+
+    def __init__(self, client, executor, timeout=None, submit_timeout=None):
+        try:
+            import grpc.aio  # noqa
+        except ImportError:
+            raise ImportError("grpcio >= 1.32 is required for the asyncio "
+                              "transport")
+        self.client = client
+        self.executor = executor
+        self.timeout = timeout
+        self.submit_timeout = submit_timeout
+        security = client.security
+        cert_bytes = security._get_bytes('cert')
+        key_bytes = security._get_bytes('key')
+        creds = grpc.ssl_channel_credentials(cert_bytes, key_bytes, cert_bytes)
+        options = [('grpc.ssl_target_name_override', 'skein-internal'),
+                   ('grpc.default_authority', 'skein-internal')]
+        self._channel = grpc.aio.secure_channel(client.address, creds, options)
+        self._stub = proto.DriverStub(self._channel)
+
+    @classmethod
+    async def connect(cls, executor, timeout=None, submit_timeout=None,
+                      **kwargs):
+        """Start a new driver and connect to it.
+
+        ``timeout`` is the deadline (in seconds) for each request, other than
+        submits which use ``submit_timeout``. Other keyword arguments are
+        forwarded to ``skein.Client``. Only starting and stopping the driver
+        happen in ``executor``."""
+        client = await executor.run(
+            'connect',
+            _timed('connect',
+                   lambda: _start_driver(timeout, submit_timeout, **kwargs))
+        )
+        return cls(client, executor, timeout=timeout,
+                   submit_timeout=submit_timeout)
+
+    async def _call(self, method, req, timeout=None):
+        # Mirrors skein.core._ClientBase._call
+        operation = self._operations.get(method, method)
+        if timeout is None:
+            timeout = (self.submit_timeout if method == 'submit'
+                       else self.timeout)
+        try:
+            with observe_rpc(operation), child_span('rpc.%s' % operation):
+                return await getattr(self._stub, method)(req, timeout=timeout)
+        except grpc.aio.AioRpcError as _exc:
+            exc = _exc
+
+        code = exc.code()
+        if code == grpc.StatusCode.UNAVAILABLE:
+            raise ConnectionError("Unable to connect to driver")
+        if code == grpc.StatusCode.DEADLINE_EXCEEDED:
+            raise TimeoutError("Unable to connect to driver")
+        elif code == grpc.StatusCode.NOT_FOUND:
+            raise context.KeyError(exc.details())
+        elif code in (grpc.StatusCode.INVALID_ARGUMENT,
+                      grpc.StatusCode.FAILED_PRECONDITION,
+                      grpc.StatusCode.ALREADY_EXISTS):
+            raise context.ValueError(exc.details())
+        else:
+            raise DriverError(exc.details())
+
+    async def submit(self, spec):
+        if not isinstance(spec, proto.ApplicationSpec):
+            spec = ApplicationSpec._from_any(spec).to_protobuf()
+        resp = await self._call('submit', spec)
+        return resp.id
+
+    async def application_report(self, app_id):
+        resp = await self._call('getStatus', proto.Application(id=app_id))
+        return ApplicationReport.from_protobuf(resp)
+
+    async def get_applications(self, states=None, name=None, user=None,
+                               queue=None, started_begin=None,
+                               started_end=None, finished_begin=None,
+                               finished_end=None):
+        if states is None:
+            states = self._active_states
+        states = tuple(ApplicationState(s) for s in states)
+
+        parse = skein.Client._parse_datetime
+        req = proto.ApplicationsRequest(
+            states=[str(s) for s in states],
+            name=name,
+            user=user,
+            queue=queue,
+            started_begin=datetime_to_millis(
+                parse(started_begin, 'started_begin')),
+            started_end=datetime_to_millis(
+                parse(started_end, 'started_end')),
+            finished_begin=datetime_to_millis(
+                parse(finished_begin, 'finished_begin')),
+            finished_end=datetime_to_millis(
+                parse(finished_end, 'finished_end'))
+        )
+        resp = await self._call('getApplications', req)
+        return sorted((ApplicationReport.from_protobuf(r) for r in resp.reports),
+                      key=lambda x: x.id)
+
+    async def kill_application(self, app_id, user=""):
+        await self._call('kill', proto.KillRequest(id=app_id, user=user))
+
+    async def get_queue(self, name):
+        resp = await self._call('getQueue', proto.QueueRequest(name=name))
+        return Queue.from_protobuf(resp)
+
+    async def application_logs(self, app_id, user=""):
+        """Logs by container id, for a finished application"""
+        resp = await self._call('getLogs',
+                                proto.LogsRequest(id=app_id, user=user))
+        return dict(resp.logs)
+
+    async def get_nodes(self, states=None):
+        states = () if states is None else tuple(NodeState(s) for s in states)
+        req = proto.NodesRequest(states=[str(s) for s in states])
+        resp = await self._call('getNodes', req)
+        return sorted((NodeReport.from_protobuf(r) for r in resp.reports),
+                      key=lambda x: x.id)
+
+    async def ping(self, timeout=None):
+        """Check the driver is alive and responding"""
+        proc = self.client._proc
+        if proc is not None and proc.poll() is not None:
+            raise ConnectionError("Driver process exited with code %d"
+                                  % proc.returncode)
+        await self._call('ping', proto.Empty(), timeout=timeout)
+
+    def abort(self):
+        """Kill the driver if it was started by this client. Requests in
+        flight fail."""
+        _kill_driver(self.client)
+
+    async def close(self):
+        """Close the client, stopping the driver if it was started by it"""
+        await self._channel.close()
+        await self.executor.run('connect', self.client.close)
+
+
+class ReportCache(object):
+    """A short-lived cache of application reports in front of a client.
+
+    Concurrent requests for the same application share a single request, and
+    reports are reused for up to ``ttl`` seconds. Submitting or killing an
+    application invalidates its cached report, so these changes are seen
+    immediately.
+
+    Supports the same interface as the wrapped client.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to wrap.
+    ttl : float, optional
+        The maximum age (in seconds) of a cached report. Set to 0 to only
+        share concurrent requests.
+    max_size : int, optional
+        The maximum number of cached reports, the oldest are dropped first.
+    """
+    def __init__(self, client, ttl=1.0, max_size=1024):
+        self.wrapped = client
+        self.ttl = ttl
+        self.max_size = max_size
+        # app_id -> (loop time, report), oldest first
+        self._reports = OrderedDict()
+        # app_id -> in-flight request
+        self._pending = {}
+
+    @property
+    def client(self):
+        """The underlying ``skein.Client``"""
+        return self.wrapped.client
+
+    def invalidate(self, app_id):
+        """Drop any cached report for an application"""
+        self._reports.pop(app_id, None)
+        self._pending.pop(app_id, None)
+
+    def _store(self, report):
+        now = asyncio.get_event_loop().time()
+        self._reports.pop(report.id, None)
+        self._reports[report.id] = (now, report)
+        # Only expired or excess reports at the front are dropped, so each
+        # store is amortized constant time
+        cutoff = now - self.ttl
+        while self._reports:
+            app_id, (stored, _) = next(iter(self._reports.items()))
+            if stored >= cutoff and len(self._reports) <= self.max_size:
+                break
+            self._reports.popitem(last=False)
+
+    async def submit(self, spec):
+        app_id = await self.wrapped.submit(spec)
+        self.invalidate(app_id)
+        return app_id
+
+    async def application_report(self, app_id):
+        cached = self._reports.get(app_id)
+        if cached is not None:
+            if asyncio.get_event_loop().time() - cached[0] <= self.ttl:
+                return cached[1]
+            del self._reports[app_id]
+        fut = self._pending.get(app_id)
+        if fut is None:
+            fut = self._pending[app_id] = asyncio.ensure_future(
+                self.wrapped.application_report(app_id)
+            )
+            fut.add_done_callback(lambda f: self._fetched(app_id, f))
+        return await asyncio.shield(fut)
+
+    def _fetched(self, app_id, fut):
+        current = self._pending.get(app_id) is fut
+        if current:
+            del self._pending[app_id]
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        # Only store if not invalidated while in flight
+        if current:
+            self._store(fut.result())
+
+    async def get_applications(self, **kwargs):
+        return await self.wrapped.get_applications(**kwargs)
+
+    async def kill_application(self, app_id, user=""):
+        try:
+            return await self.wrapped.kill_application(app_id, user)
+        finally:
+            self.invalidate(app_id)
+
+    async def get_queue(self, name):
+        return await self.wrapped.get_queue(name)
+
+    async def application_logs(self, app_id, user=""):
+        return await self.wrapped.application_logs(app_id, user)
+
+    async def get_nodes(self, states=None):
+        return await self.wrapped.get_nodes(states)
+
+    async def ping(self, timeout=None):
+        await self.wrapped.ping(timeout)
+
+    async def close(self):
+        await self.wrapped.close()
@@ -0,0 +1,321 @@
+import asyncio
+import math
+import os
+import time
+from xml.etree import ElementTree
+
+from tornado.log import app_log
+
+
+def read_yarn_site(conf_dir=None):
+    """Read the properties in ``yarn-site.xml``.
+
+    Parameters
+    ----------
+    conf_dir : str, optional
+        The Hadoop configuration directory. Defaults to ``$HADOOP_CONF_DIR``,
+        or ``/etc/hadoop/conf``.
+
+    Returns
+    -------
+    properties : dict or None
+        The properties, or None if no configuration was found.
+    """
+    if not conf_dir:
+        conf_dir = os.environ.get('HADOOP_CONF_DIR', '/etc/hadoop/conf')
+    path = os.path.join(conf_dir, 'yarn-site.xml')
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (OSError, ElementTree.ParseError):
+        return None
+    out = {}
+    for prop in root.iter('property'):
+        name = prop.findtext('name')
+        if name:
+            out[name.strip()] = (prop.findtext('value') or '').strip()
+    return out
+
+
+def queue_usage(info):
+    """A queue's usage, as a percentage of its maximum capacity, or None if
+    unknown"""
+    if info is None or not info.max_capacity:
+        return None
+    return info.percent_used * info.capacity / info.max_capacity
+
+
+class ClusterLimits(object):
+    """Limits on the resources of a single container.
+
+    Memory is in MiB. Any limit may be None if unknown.
+    """
+    __slots__ = ('max_memory', 'max_vcores', 'min_memory', 'min_vcores')
+
+    def __init__(self, max_memory=None, max_vcores=None, min_memory=None,
+                 min_vcores=None):
+        self.max_memory = max_memory
+        self.max_vcores = max_vcores
+        self.min_memory = min_memory
+        self.min_vcores = min_vcores
+
+    def __repr__(self):
+        return ('ClusterLimits<max_memory=%s, max_vcores=%s, min_memory=%s, '
+                'min_vcores=%s>' % (self.max_memory, self.max_vcores,
+                                    self.min_memory, self.min_vcores))
+
+    def round_memory(self, memory):
+        """The memory (in MiB) the scheduler will allocate for a request"""
+        if not self.min_memory:
+            return memory
+        return int(math.ceil(memory / self.min_memory)) * self.min_memory
+
+    @classmethod
+    def from_yarn_site(cls, props):
+        """Limits from ``yarn-site.xml`` properties.
+
+        Only properties that are set are used, anything else is unknown.
+        Edge nodes often have a client-only configuration without the
+        scheduler's settings, so YARN's defaults can't be assumed."""
+        def get(*names):
+            for name in names:
+                try:
+                    return int(props[name])
+                except (KeyError, ValueError):
+                    pass
+            return None
+
+        # The fair scheduler rounds to a separate increment
+        if 'FairScheduler' in props.get('yarn.resourcemanager.scheduler.class', ''):
+            min_memory = get('yarn.resource-types.memory-mb.increment-allocation',
+                             'yarn.scheduler.increment-allocation-mb')
+        else:
+            min_memory = get('yarn.scheduler.minimum-allocation-mb')
+        return cls(max_memory=get('yarn.scheduler.maximum-allocation-mb'),
+                   max_vcores=get('yarn.scheduler.maximum-allocation-vcores'),
+                   min_memory=min_memory,
+                   min_vcores=get('yarn.scheduler.minimum-allocation-vcores'))
+
+    def restrict(self, nodes):
+        """Restrict the maximum limits to what fits on the largest node"""
+        if not nodes:
+            return self
+        memory = max(n.total_resources.memory for n in nodes)
+        vcores = max(n.total_resources.vcores for n in nodes)
+        return ClusterLimits(
+            max_memory=(memory if self.max_memory is None
+                        else min(memory, self.max_memory)),
+            max_vcores=(vcores if self.max_vcores is None
+                        else min(vcores, self.max_vcores)),
+            min_memory=self.min_memory,
+            min_vcores=self.min_vcores
+        )
+
+
+class ClusterSnapshot(object):
+    """A point-in-time view of free cluster resources.
+
+    Parameters
+    ----------
+    nodes : list of NodeReport
+        The running nodes.
+    queues : dict
+        Queue information by queue name. Queues that couldn't be fetched are
+        missing.
+    limits : ClusterLimits
+        The container limits.
+    time : float
+        When the snapshot was taken, in seconds since the epoch.
+    """
+    __slots__ = ('nodes', 'queues', 'limits', 'time')
+
+    def __init__(self, nodes, queues, limits, time):
+        self.nodes = nodes
+        self.queues = queues
+        self.limits = limits
+        self.time = time
+
+    def available(self, memory, vcores, queue=None, node_label=''):
+        """Estimate how many more containers of a size could start now.
+
+        Parameters
+        ----------
+        memory : int
+            The container memory, in MiB.
+        vcores : int
+            The container vcores.
+        queue : str, optional
+            The queue, if known its remaining maximum capacity also limits
+            the estimate.
+        node_label : str, optional
+            The node label containers are placed on. If empty, the queue's
+            default node label is used if known, otherwise only unlabeled
+            nodes are counted.
+
+        Returns
+        -------
+        count : int
+        """
+        memory = max(self.limits.round_memory(memory), 1)
+        vcores = max(vcores, 1)
+        if ((self.limits.max_memory is not None and
+                memory > self.limits.max_memory) or
+                (self.limits.max_vcores is not None and
+                 vcores > self.limits.max_vcores)):
+            return 0
+        info = self.queues.get(queue)
+        if not node_label and info is not None:
+            node_label = info.default_node_label
+        total_memory = 0
+        count = 0
+        for node in self.nodes:
+            if (node_label in node.labels) if node_label else not node.labels:
+                total = node.total_resources
+                used = node.used_resources
+                total_memory += total.memory
+                count += min((total.memory - used.memory) // memory,
+                             (total.vcores - used.vcores) // vcores)
+        if info is not None:
+            if str(info.state) != 'RUNNING':
+                return 0
+            # Queue capacities are percentages of the partition
+            used = info.percent_used * info.capacity / 100
+            headroom = max(info.max_capacity - used, 0) / 100
+            count = min(count, int(total_memory * headroom // memory))
+        return max(count, 0)
+
+
+class ClusterInfo(object):
+    """A cache of queue, container limit, and free resource information.
+
+    Concurrent requests for the same information share a single request.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to request information with.
+    queue_ttl : float, optional
+        The maximum age (in seconds) of queue information.
+    limits_ttl : float, optional
+        The maximum age (in seconds) of container limits.
+    snapshot_ttl : float, optional
+        The maximum age (in seconds) of cluster snapshots.
+    conf_dir : str, optional
+        The Hadoop configuration directory, see ``read_yarn_site``.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, queue_ttl=5.0, limits_ttl=300.0,
+                 snapshot_ttl=30.0, conf_dir=None, log=None):
+        self.client = client
+        self.queue_ttl = queue_ttl
+        self.limits_ttl = limits_ttl
+        self.snapshot_ttl = snapshot_ttl
+        self.conf_dir = conf_dir
+        self.log = log or app_log
+        # key -> (loop time, value)
+        self._cache = {}
+        self._pending = {}
+
+    def _refresh(self, key, func):
+        loop = asyncio.get_event_loop()
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = self._pending[key] = asyncio.ensure_future(func())
+
+            def store(f):
+                self._pending.pop(key, None)
+                if not f.cancelled() and f.exception() is None:
+                    self._cache[key] = (loop.time(), f.result())
+
+            fut.add_done_callback(store)
+        return fut
+
+    async def _cached(self, key, ttl, func):
+        cached = self._cache.get(key)
+        if (cached is not None and
+                asyncio.get_event_loop().time() - cached[0] < ttl):
+            return cached[1]
+        return await asyncio.shield(self._refresh(key, func))
+
+    async def get_queue(self, name):
+        """Information about a queue"""
+        return await self._cached(('queue', name), self.queue_ttl,
+                                  lambda: self.client.get_queue(name))
+
+    def cached_queue(self, name):
+        """The last information fetched about a queue, however old, or None.
+        Never makes a request."""
+        cached = self._cache.get(('queue', name))
+        return None if cached is None else cached[1]
+
+    async def _get_limits(self):
+        props = read_yarn_site(self.conf_dir)
+        limits = (ClusterLimits() if props is None
+                  else ClusterLimits.from_yarn_site(props))
+        try:
+            nodes = await self.client.get_nodes(states=['RUNNING'])
+        except Exception as exc:
+            self.log.warning("Failed to get cluster nodes", exc_info=exc)
+            nodes = []
+        return limits.restrict(nodes)
+
+    async def limits(self):
+        """The limits on resources for a single container"""
+        return await self._cached('limits', self.limits_ttl, self._get_limits)
+
+    async def _get_snapshot(self, queues):
+        limits = await self.limits()
+        nodes = await self.client.get_nodes(states=['RUNNING'])
+        infos = {}
+        for name in queues:
+            try:
+                infos[name] = await self.get_queue(name)
+            except Exception as exc:
+                self.log.debug("Failed to get information for queue %s",
+                               name, exc_info=exc)
+        return ClusterSnapshot(nodes, infos, limits, time.time())
+
+    async def snapshot(self, queues=(), timeout=None):
+        """A snapshot of free cluster resources, without waiting for a
+        request if possible.
+
+        The last snapshot is returned immediately, refreshing it in the
+        background if older than ``snapshot_ttl``. If there is no snapshot
+        yet, waits up to ``timeout`` seconds for one.
+
+        Parameters
+        ----------
+        queues : iterable of str, optional
+            The queues to include.
+        timeout : float, optional
+            The maximum time to wait if there's no snapshot yet.
+
+        Returns
+        -------
+        snapshot : ClusterSnapshot or None
+            None if no snapshot was available in time.
+        """
+        key = ('snapshot', tuple(sorted(set(queues))))
+
+        def fetch():
+            return self._get_snapshot(key[1])
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            if asyncio.get_event_loop().time() - cached[0] >= self.snapshot_ttl:
+                self._refresh(key, fetch).add_done_callback(self._log_failure)
+            return cached[1]
+        fut = self._refresh(key, fetch)
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            fut.add_done_callback(self._log_failure)
+            return None
+        except Exception as exc:
+            self.log.warning("Failed to get cluster snapshot", exc_info=exc)
+            return None
+
+    def _log_failure(self, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            self.log.warning("Failed to refresh cluster snapshot",
+                             exc_info=fut.exception())
@@ -0,0 +1,94 @@
+import asyncio
+from collections import defaultdict
+
+from tornado.log import app_log
+
+from .metrics import CULLED_SERVERS
+from .tracing import detach
+
+
+class IdleCuller(object):
+    """Periodically stop servers that are idle, or never started properly.
+
+    Spawners register themselves while their server is running. Each cycle,
+    every registered spawner decides whether it should be culled, using the
+    hub's activity data and the shared report snapshot, so checks don't make
+    any requests. Applications to cull are then killed in batches of at most
+    ``concurrency``, one batch at a time, through each spawner's
+    ``ApplicationKiller``. The hub notices the servers stopped on its next
+    poll.
+
+    Parameters
+    ----------
+    interval : float, optional
+        The time (in seconds) between cycles.
+    concurrency : int, optional
+        The maximum number of applications killed at once.
+    kill_timeout : float, optional
+        The time (in seconds) to wait for each batch to stop.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, interval=300.0, concurrency=10, kill_timeout=30.0,
+                 log=None):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.kill_timeout = kill_timeout
+        self.log = log or app_log
+        self.spawners = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self.spawners)
+
+    def add(self, spawner):
+        """Start considering a spawner's server for culling"""
+        self.spawners.add(spawner)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def discard(self, spawner):
+        """Stop considering a spawner's server for culling"""
+        self.spawners.discard(spawner)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def cull(self):
+        """Run a single cycle, returning the culled application ids"""
+        by_killer = defaultdict(list)
+        for spawner in list(self.spawners):
+            try:
+                reason = spawner._cull_reason()
+            except Exception as exc:
+                self.log.warning("Failed to check server for user %s",
+                                 spawner.user.name, exc_info=exc)
+                continue
+            if reason is None:
+                continue
+            self.log.info("Culling server for user %s (application %s): %s",
+                          spawner.user.name, spawner.app_id, reason[1])
+            CULLED_SERVERS.labels(reason[0]).inc()
+            self.spawners.discard(spawner)
+            killer = await spawner._get_killer()
+            by_killer[killer].append(spawner.app_id)
+
+        culled = []
+        for killer, app_ids in by_killer.items():
+            for i in range(0, len(app_ids), self.concurrency):
+                batch = app_ids[i:i + self.concurrency]
+                await killer.kill_all(batch, timeout=self.kill_timeout)
+                culled.extend(batch)
+            # Have the hub's next poll see the stopped applications
+            killer.poller.request_refresh()
+        return culled
+
+    async def _run(self):
+        detach()
+        while self.spawners:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.cull()
+            except Exception as exc:
+                self.log.warning("Failed to cull idle servers", exc_info=exc)
@@ -0,0 +1,223 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from tornado.log import app_log
+
+from .tracing import detach
+
+
+class LogTail(object):
+    """Keep the last ``max_bytes`` of a stream of log output"""
+    __slots__ = ('max_bytes', 'truncated', '_buffer')
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.truncated = 0
+        self._buffer = bytearray()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        excess = len(self._buffer) - self.max_bytes
+        if excess > 0:
+            del self._buffer[:excess]
+            self.truncated += excess
+
+    def text(self):
+        out = self._buffer.decode('utf-8', errors='replace')
+        if self.truncated:
+            out = '[... %d bytes truncated ...]\n%s' % (self.truncated, out)
+        return out
+
+
+class YarnLogsCommandLine(object):
+    """Stream application logs using the ``yarn logs`` command line tool.
+
+    Only the last ``max_bytes`` of each log file is requested, and the output
+    is read incrementally, so large logs are never held in memory. Uses the
+    credentials of the user JupyterHub is running as.
+    """
+    def __init__(self, command='yarn', chunk_size=2**16):
+        self.command = command
+        self.chunk_size = chunk_size
+
+    async def tail(self, app_id, max_bytes, user=''):
+        """The last ``max_bytes`` of an application's logs, as a ``LogTail``"""
+        args = [self.command, 'logs', '-applicationId', app_id,
+                '-size', str(-max_bytes)]
+        if user:
+            args.extend(['-appOwner', user])
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        tail = LogTail(max_bytes)
+        try:
+            while True:
+                chunk = await proc.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                tail.feed(chunk)
+            code = await proc.wait()
+        except BaseException:
+            proc.kill()
+            raise
+        if code != 0:
+            raise RuntimeError("`yarn logs` for application %s exited with "
+                               "code %d" % (app_id, code))
+        return tail
+
+
+class FailureDiagnostics(object):
+    """Information about an application that failed to start"""
+    __slots__ = ('app_id', 'user', 'state', 'diagnostics', 'logs', 'time',
+                 'complete', '_done')
+
+    def __init__(self, app_id, user, state, diagnostics):
+        self.app_id = app_id
+        self.user = user
+        self.state = state
+        self.diagnostics = diagnostics or ''
+        self.logs = ''
+        self.time = time.time()
+        self.complete = False
+        self._done = asyncio.Event()
+
+    async def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds for the logs. Returns True if
+        they're complete."""
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.complete
+
+    def summary(self, max_chars=1000):
+        """A short description, for showing to the user"""
+        lines = ['Application %s failed to start (%s).'
+                 % (self.app_id, self.state)]
+        diagnostics = self.diagnostics.strip()
+        if diagnostics:
+            if len(diagnostics) > max_chars:
+                diagnostics = diagnostics[:max_chars] + '...'
+            lines.append('Diagnostics: %s' % diagnostics)
+        logs = self.logs.strip()
+        if logs:
+            if len(logs) > max_chars:
+                # Start at a line boundary
+                logs = logs[-max_chars:].partition('\n')[2]
+            lines.append('Last log output:\n%s' % logs)
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {'app_id': self.app_id,
+                'user': self.user,
+                'state': self.state,
+                'diagnostics': self.diagnostics,
+                'logs': self.logs,
+                'time': self.time,
+                'complete': self.complete}
+
+
+class DiagnosticsCollector(object):
+    """Collect diagnostics and log tails for applications that failed to
+    start.
+
+    Logs are fetched in a background task, as they're only available once
+    YARN has aggregated them, which may take a while after the application
+    stops. The most recent failures are kept for admins.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to fetch logs with, if the ``yarn`` command isn't
+        available.
+    max_bytes : int, optional
+        The maximum size of the log tail kept for each failure.
+    max_entries : int, optional
+        The number of failures to keep.
+    attempts : int, optional
+        How many times to try fetching logs before giving up.
+    retry_delay : float, optional
+        The time (in seconds) between attempts, while logs aren't available.
+    command : YarnLogsCommandLine, optional
+        Used to stream logs.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, max_bytes=2**16, max_entries=100, attempts=5,
+                 retry_delay=2.0, command=None, log=None):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.command = command or YarnLogsCommandLine()
+        self.log = log or app_log
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, app_id):
+        """The diagnostics for a failed application, or None"""
+        return self._entries.get(app_id)
+
+    def entries(self):
+        """All kept diagnostics, most recent last"""
+        return list(self._entries.values())
+
+    def collect(self, app_id, user, state, diagnostics):
+        """Record a failure, and start fetching its logs"""
+        entry = FailureDiagnostics(app_id, user, state, diagnostics)
+        self._entries.pop(app_id, None)
+        self._entries[app_id] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        asyncio.ensure_future(self._fetch(entry))
+        return entry
+
+    async def _fetch_skein(self, entry):
+        # skein returns all logs at once, only the tail of each is kept
+        logs = await self.client.application_logs(entry.app_id, entry.user)
+        per_container = max(self.max_bytes // max(len(logs), 1), 1)
+        tail = LogTail(self.max_bytes)
+        for container_id in sorted(logs):
+            text = logs[container_id].encode('utf-8', errors='replace')
+            if len(text) > per_container:
+                tail.truncated += len(text) - per_container
+                text = text[-per_container:]
+            tail.feed(('==> %s <==\n' % container_id).encode() + text)
+        return tail
+
+    async def _fetch_once(self, entry):
+        try:
+            return await self.command.tail(entry.app_id, self.max_bytes,
+                                           user=entry.user)
+        except FileNotFoundError:
+            return await self._fetch_skein(entry)
+
+    async def _fetch(self, entry):
+        detach()
+        try:
+            for attempt in range(self.attempts):
+                try:
+                    tail = await self._fetch_once(entry)
+                except Exception as exc:
+                    if attempt == self.attempts - 1:
+                        self.log.warning("Failed to fetch logs for "
+                                         "application %s", entry.app_id,
+                                         exc_info=exc)
+                else:
+                    if len(tail):
+                        entry.logs = tail.text()
+                        entry.complete = True
+                        return
+                # Logs may not be aggregated yet
+                if attempt < self.attempts - 1:
+                    await asyncio.sleep(self.retry_delay)
+        finally:
+            entry._done.set()
@@ -0,0 +1,136 @@
+import time
+import zlib
+
+from .metrics import DRIVER_BUSY_SECONDS, DRIVER_INFLIGHT_REQUESTS
+
+
+class _DriverStats(object):
+    __slots__ = ('inflight', 'calls', 'busy_since', 'busy_time', 'busy',
+                 'inflight_gauge')
+
+    def __init__(self, principal, index):
+        self.inflight = 0
+        self.calls = 0
+        self.busy_since = None
+        self.busy_time = 0.0
+        labels = (principal or '', str(index))
+        self.busy = DRIVER_BUSY_SECONDS.labels(*labels)
+        self.inflight_gauge = DRIVER_INFLIGHT_REQUESTS.labels(*labels)
+
+    def started(self):
+        if self.inflight == 0:
+            self.busy_since = time.monotonic()
+        self.inflight += 1
+        self.calls += 1
+        self.inflight_gauge.inc()
+
+    def finished(self):
+        self.inflight -= 1
+        self.inflight_gauge.dec()
+        if self.inflight == 0:
+            elapsed = time.monotonic() - self.busy_since
+            self.busy_time += elapsed
+            self.busy.inc(elapsed)
+            self.busy_since = None
+
+
+class DriverPool(object):
+    """Spread requests over several skein drivers.
+
+    Requests about an existing application (reports, logs, and kills) always
+    go to the same driver, chosen by a hash of the application id. Submissions
+    and listings go to the driver with the fewest requests in flight.
+
+    Each driver's load is exported as the ``yarnspawner_driver_busy_seconds``
+    (time with at least one request in flight) and
+    ``yarnspawner_driver_inflight_requests`` metrics.
+
+    Supports the same interface as the wrapped clients.
+
+    Parameters
+    ----------
+    drivers : list of SupervisedClient
+        The clients for each driver.
+    principal : str, optional
+        The principal the drivers run as, used to label metrics.
+    """
+    def __init__(self, drivers, principal=None):
+        if not drivers:
+            raise ValueError("At least one driver is required")
+        self.drivers = list(drivers)
+        self._stats = [_DriverStats(principal, i)
+                       for i in range(len(self.drivers))]
+
+    def __len__(self):
+        return len(self.drivers)
+
+    @property
+    def client(self):
+        """The underlying ``skein.Client`` of the least loaded driver"""
+        return self.drivers[self._least_loaded()].client
+
+    def stats(self):
+        """A list of ``(inflight, calls, busy_time)`` for each driver"""
+        out = []
+        now = time.monotonic()
+        for s in self._stats:
+            busy = s.busy_time
+            if s.busy_since is not None:
+                busy += now - s.busy_since
+            out.append((s.inflight, s.calls, busy))
+        return out
+
+    def _shard(self, app_id):
+        return zlib.crc32(app_id.encode()) % len(self.drivers)
+
+    def _least_loaded(self):
+        # Ties are broken by total calls, spreading requests round robin
+        # under light load
+        return min(range(len(self.drivers)),
+                   key=lambda i: (self._stats[i].inflight,
+                                  self._stats[i].calls))
+
+    async def _call(self, index, method, *args, **kwargs):
+        stats = self._stats[index]
+        stats.started()
+        try:
+            return await getattr(self.drivers[index], method)(*args, **kwargs)
+        finally:
+            stats.finished()
+
+    def start(self):
+        for driver in self.drivers:
+            driver.start()
+
+    async def submit(self, spec):
+        return await self._call(self._least_loaded(), 'submit', spec)
+
+    async def application_report(self, app_id):
+        return await self._call(self._shard(app_id), 'application_report',
+                                app_id)
+
+    async def get_applications(self, **kwargs):
+        return await self._call(self._least_loaded(), 'get_applications',
+                                **kwargs)
+
+    async def kill_application(self, app_id, user=""):
+        return await self._call(self._shard(app_id), 'kill_application',
+                                app_id, user)
+
+    async def application_logs(self, app_id, user=""):
+        return await self._call(self._shard(app_id), 'application_logs',
+                                app_id, user)
+
+    async def get_queue(self, name):
+        return await self._call(self._least_loaded(), 'get_queue', name)
+
+    async def get_nodes(self, states=None):
+        return await self._call(self._least_loaded(), 'get_nodes', states)
+
+    async def ping(self, timeout=None):
+        for i in range(len(self.drivers)):
+            await self._call(i, 'ping', timeout)
+
+    async def close(self):
+        for driver in self.drivers:
+            await driver.close()
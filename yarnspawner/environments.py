@@ -0,0 +1,248 @@
+"""
+Build packaged Python environments for use with ``localize_files``.
+
+Environments are described by a small YAML specification:
+
+.. code-block:: yaml
+
+    # The name of the environment, also the directory it's localized as
+    name: analytics
+    # Either 'conda' or 'venv'
+    kind: conda
+    # An explicit conda lockfile (e.g. from ``conda list --explicit`` or
+    # ``conda-lock``), or a pip requirements file for 'venv'
+    lockfile: analytics.lock
+    # Where to publish archives, optional
+    publish: hdfs:///user/jupyterhub/environments
+
+Archives are named by a hash of the specification and lockfile, so identical
+environments are only built and published once.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+from .uploads import HDFSCommandLine
+
+
+# Bumped whenever the archive layout changes, so archives are rebuilt
+LAYOUT_VERSION = 1
+
+# Files that are never needed at runtime, excluded from all archives
+DEFAULT_EXCLUDES = ('*.a', '*.pyo', '*.js.map')
+
+
+class EnvironmentSpec(object):
+    """A specification for a packaged environment.
+
+    Parameters
+    ----------
+    name : str
+        The name of the environment.
+    lockfile : str
+        Path to the lockfile describing the environment's packages. For
+        ``conda`` this must be an explicit lockfile, for ``venv`` a pip
+        requirements file.
+    kind : {'conda', 'venv'}, optional
+        The kind of environment to build.
+    python : str, optional
+        The Python interpreter used to create ``venv`` environments.
+    compress_level : int, optional
+        The gzip compression level of the archive. Lower levels produce
+        larger archives that are faster to unpack.
+    exclude : list of str, optional
+        Additional file patterns to exclude from the archive.
+    publish : str, optional
+        A directory to publish archives to, e.g.
+        ``hdfs:///user/jupyterhub/environments``.
+    """
+    def __init__(self, name, lockfile, kind='conda', python=None,
+                 compress_level=4, exclude=None, publish=None):
+        if kind not in ('conda', 'venv'):
+            raise ValueError("kind must be 'conda' or 'venv', got %r" % kind)
+        if not 0 <= compress_level <= 9:
+            raise ValueError("compress_level must be between 0 and 9")
+        if publish is not None and '://' not in publish:
+            raise ValueError("publish must be a full URI (e.g. "
+                             "'hdfs:///path'), got %r" % publish)
+        self.name = name
+        self.lockfile = lockfile
+        self.kind = kind
+        self.python = python or sys.executable
+        self.compress_level = compress_level
+        self.exclude = list(exclude or ())
+        self.publish = publish.rstrip('/') if publish else None
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a specification from a YAML file.
+
+        Relative lockfile paths are relative to the specification file."""
+        with open(path) as f:
+            data = yaml.safe_load(f)
+        if not isinstance(data, dict):
+            raise ValueError("Invalid environment specification %r" % path)
+        lockfile = data.get('lockfile')
+        if lockfile is not None:
+            data['lockfile'] = os.path.join(os.path.dirname(path), lockfile)
+        return cls(**data)
+
+    def hash(self):
+        """A hash of everything that affects the built archive"""
+        h = hashlib.sha256()
+        parts = [str(LAYOUT_VERSION), self.kind, str(self.compress_level)]
+        parts.extend(sorted(self.exclude))
+        if self.kind == 'venv':
+            parts.append(python_version(self.python))
+        for part in parts:
+            h.update(part.encode() + b'\0')
+        with open(self.lockfile, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    @property
+    def archive_name(self):
+        return '%s-%s.tar.gz' % (self.name, self.hash()[:16])
+
+
+_python_versions = {}
+
+
+def python_version(python):
+    """The full version string of a Python interpreter (``sys.version``).
+
+    Used instead of the interpreter's path, which doesn't change when it's
+    upgraded (e.g. ``/usr/bin/python3``)."""
+    if python not in _python_versions:
+        out = subprocess.run([python, '-c', 'import sys; print(sys.version)'],
+                             check=True, stdout=subprocess.PIPE)
+        _python_versions[python] = out.stdout.decode().strip()
+    return _python_versions[python]
+
+
+def _run(*args):
+    subprocess.run(args, check=True)
+
+
+def create_environment(spec, prefix):
+    """Create the environment described by ``spec`` at ``prefix``"""
+    if spec.kind == 'conda':
+        _run('conda', 'create', '--yes', '--quiet', '--prefix', prefix,
+             '--file', spec.lockfile)
+    else:
+        _run(spec.python, '-m', 'venv', prefix)
+        _run(os.path.join(prefix, 'bin', 'python'), '-m', 'pip', 'install',
+             '--quiet', '--no-deps', '-r', spec.lockfile)
+
+
+def compile_bytecode(prefix):
+    """Compile all Python files in ``prefix``.
+
+    Bytecode is checked against source hashes rather than modification times,
+    so it stays valid after the archive is unpacked. Files that fail to
+    compile (e.g. test fixtures) are skipped.
+    """
+    python = os.path.join(prefix, 'bin', 'python')
+    subprocess.run([python, '-m', 'compileall', '-q', '-j', '0',
+                    '--invalidation-mode', 'unchecked-hash', prefix],
+                   stdout=subprocess.DEVNULL)
+
+
+def pack_environment(spec, prefix, output):
+    """Package the environment at ``prefix`` into an archive at ``output``.
+
+    Files are written in sorted order, excluding ``DEFAULT_EXCLUDES`` and
+    ``spec.exclude``."""
+    if spec.kind == 'conda':
+        try:
+            import conda_pack
+        except ImportError:
+            raise ImportError("conda-pack is required to build conda "
+                              "environments")
+        env = conda_pack.CondaEnv.from_prefix(prefix)
+    else:
+        try:
+            import venv_pack
+        except ImportError:
+            raise ImportError("venv-pack is required to build virtual "
+                              "environments")
+        env = venv_pack.Env(prefix)
+        # venv-pack doesn't order files, conda-pack sorts them already
+        env.files = sorted(env.files, key=lambda f: f.target)
+    for pattern in DEFAULT_EXCLUDES + tuple(spec.exclude):
+        env = env.exclude(pattern)
+    env.pack(output=output, compress_level=spec.compress_level, force=True)
+
+
+def build(spec, output_dir='.', fs=None, log=print):
+    """Build and publish an environment, if not already built.
+
+    Parameters
+    ----------
+    spec : EnvironmentSpec
+        The environment to build.
+    output_dir : str, optional
+        The local directory to write archives to.
+    fs : object, optional
+        The filesystem operations used to publish the archive. Defaults to
+        ``HDFSCommandLine``.
+    log : callable, optional
+        Called with progress messages.
+
+    Returns
+    -------
+    path : str
+        The path to the archive, published if ``spec.publish`` is set,
+        otherwise local.
+    """
+    name = spec.archive_name
+    local = os.path.abspath(os.path.join(output_dir, name))
+    if spec.publish is not None:
+        fs = fs or HDFSCommandLine()
+        published = '%s/%s' % (spec.publish, name)
+        if fs.exists(published):
+            log("Environment %s already published to %s"
+                % (spec.name, published))
+            return published
+
+    if os.path.exists(local):
+        log("Using existing archive %s" % local)
+    else:
+        workdir = tempfile.mkdtemp(prefix='yarnspawner-env-')
+        try:
+            prefix = os.path.join(workdir, spec.name)
+            log("Creating %s environment %s" % (spec.kind, spec.name))
+            create_environment(spec, prefix)
+            log("Compiling bytecode")
+            compile_bytecode(prefix)
+            log("Packing environment to %s" % local)
+            partial = os.path.join(workdir, name)
+            pack_environment(spec, prefix, partial)
+            shutil.move(partial, local)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if spec.publish is None:
+        return local
+    log("Publishing %s" % published)
+    fs.mkdir(spec.publish)
+    fs.put(local, published)
+    fs.chmod('a+r', published)
+    return published
+
+
+def config_snippet(spec, path):
+    """The ``jupyterhub_config.py`` lines to use an environment archive"""
+    return ("c.YarnSpawner.localize_files = {\n"
+            "    %r: {\n"
+            "        'source': %r,\n"
+            "        'visibility': 'public'\n"
+            "    }\n"
+            "}\n"
+            "c.YarnSpawner.prologue = %r\n"
+            % (spec.name, path, 'source %s/bin/activate' % spec.name))
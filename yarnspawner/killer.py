@@ -0,0 +1,115 @@
+import asyncio
+
+from tornado.log import app_log
+
+from .poller import _STOPPED_STATES
+
+
+class ApplicationKiller(object):
+    """Kill applications concurrently, and wait for them to stop.
+
+    Kills from all spawners go through a single instance, so stopping many
+    servers at once (e.g. on hub shutdown) is bounded by ``limit`` concurrent
+    kill requests. Waiting for applications to stop is done using the shared
+    report snapshot, so many waiters cost a single listing per refresh.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to kill applications with.
+    poller : ApplicationPoller
+        The poller tracking application state.
+    limit : int, optional
+        The maximum number of concurrent kill requests. Set to 0 for no limit.
+    check_interval : float, optional
+        The time (in seconds) between checks that killed applications have
+        stopped.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, poller, limit=0, check_interval=0.5, log=None):
+        self.client = client
+        self.poller = poller
+        self.limit = limit
+        self.check_interval = check_interval
+        self.log = log or app_log
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+        # Applications currently being killed, and those that failed to stop
+        # within the timeout for the current batch.
+        self._inflight = set()
+        self._alive = set()
+
+    def _stopped(self, app_id):
+        report = self.poller.get(app_id)
+        return report is not None and str(report.state) in _STOPPED_STATES
+
+    async def _kill(self, app_id):
+        if self._semaphore is not None:
+            async with self._semaphore:
+                await self.client.kill_application(app_id)
+        else:
+            await self.client.kill_application(app_id)
+
+    async def _wait_stopped(self, app_id, deadline):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                report = await self.poller.wait(app_id,
+                                                within=self.check_interval)
+            except KeyError:
+                # Unknown application, nothing to wait for
+                return True
+            if str(report.state) in _STOPPED_STATES:
+                return True
+            if deadline is not None and loop.time() >= deadline:
+                return False
+
+    async def kill(self, app_id, timeout=None):
+        """Kill an application, and wait up to ``timeout`` seconds for it to
+        stop.
+
+        The timeout includes any time spent waiting for other kills to
+        complete. Returns True if the application was confirmed stopped.
+        """
+        if self._stopped(app_id):
+            return True
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        self._inflight.add(app_id)
+        try:
+            await self._kill(app_id)
+            if timeout == 0:
+                return False
+            stopped = await self._wait_stopped(app_id, deadline)
+            if not stopped:
+                self._alive.add(app_id)
+            return stopped
+        finally:
+            self._inflight.discard(app_id)
+            if not self._inflight and self._alive:
+                self.log.warning("%d applications were killed, but weren't "
+                                 "confirmed stopped in time:\n%s",
+                                 len(self._alive),
+                                 '\n'.join(sorted(self._alive)))
+                self._alive.clear()
+
+    async def kill_all(self, app_ids, timeout=None):
+        """Kill many applications, waiting up to ``timeout`` seconds in total
+        for them to stop.
+
+        Returns a list of application ids that weren't confirmed stopped.
+        """
+        app_ids = list(app_ids)
+        results = await asyncio.gather(
+            *(self.kill(app_id, timeout=timeout) for app_id in app_ids),
+            return_exceptions=True
+        )
+        alive = []
+        for app_id, res in zip(app_ids, results):
+            if isinstance(res, Exception):
+                self.log.warning("Failed to kill application %s", app_id,
+                                 exc_info=res)
+                alive.append(app_id)
+            elif not res:
+                alive.append(app_id)
+        return alive
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+from .uploads import normalize_files
+
+
+def public_resources(files):
+    """The public resources in a ``localize_files`` mapping.
+
+    Only public resources are shared between applications in the
+    NodeManager's cache, so only these benefit from landing on the same node.
+    Resources are identified by source, along with size and timestamp if
+    configured (they're usually left unset, as 0). A file changed in place
+    at the same path is then treated as the same resource. Cached uploads
+    and built environments are named by their contents, so they don't have
+    this problem.
+    """
+    return frozenset((f.source, f.size, f.timestamp)
+                     for f in normalize_files(files).values()
+                     if f.visibility == 'public')
+
+
+class LocalizationHistory(object):
+    """Which nodes recently localized which sets of public resources.
+
+    Parameters
+    ----------
+    max_age : float, optional
+        Entries older than this (in seconds) are forgotten, as the
+        NodeManager may have evicted them from its cache.
+    max_entries : int, optional
+        The maximum number of sets of resources to remember.
+    """
+    def __init__(self, max_age=86400, max_entries=128):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        # resources -> {host: last localized}
+        self._history = OrderedDict()
+
+    def record(self, resources, host):
+        """Record that ``host`` localized ``resources``"""
+        if not resources or not host:
+            return
+        hosts = self._history.pop(resources, None) or {}
+        hosts[host] = time.time()
+        self._history[resources] = hosts
+        while len(self._history) > self.max_entries:
+            self._history.popitem(last=False)
+
+    def nodes(self, resources):
+        """The nodes that recently localized ``resources``"""
+        hosts = self._history.get(resources)
+        if not hosts:
+            return set()
+        cutoff = time.time() - self.max_age
+        for host, last in list(hosts.items()):
+            if last < cutoff:
+                del hosts[host]
+        return set(hosts)
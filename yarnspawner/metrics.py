@@ -0,0 +1,182 @@
+"""
+Prometheus metrics exported by YarnSpawner.
+
+These are registered in the default ``prometheus_client`` registry, the same
+one used by JupyterHub, and so are served from JupyterHub's ``/hub/metrics``
+endpoint. Names follow JupyterHub's ``<noun>_<verb>_<type_suffix>``
+convention, with a ``yarnspawner_`` prefix.
+"""
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# Phases of starting a server, in order
+SPAWN_PHASES = (
+    # Waiting for room in the queue (only with admission control)
+    'admission',
+    # Building the application specification
+    'spec',
+    # Submitting the application (or binding to a warm pool application)
+    'submit',
+    # Waiting for the resource manager to accept the application
+    'accepted',
+    # Waiting for the application to be scheduled and start running
+    # (includes file localization)
+    'running',
+    # Waiting for the singleuser server to start and report its port
+    'port',
+)
+
+SPAWN_FAILURE_CAUSES = (
+    # The request was rejected before submitting (e.g. too many resources)
+    'rejected',
+    # The application failed to submit
+    'submit',
+    # The application failed while starting
+    'failed',
+    # The application was killed while starting
+    'killed',
+    # The application finished while starting
+    'finished',
+    # Any other error
+    'error',
+)
+
+RPC_OPERATIONS = ('connect', 'ping', 'submit', 'report', 'list', 'queue',
+                  'nodes', 'logs', 'kill')
+
+spawn_buckets = [0.1, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 180, 300, 600,
+                 float("inf")]
+
+rpc_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               float("inf")]
+
+SPAWN_PHASE_DURATION_SECONDS = Histogram(
+    'yarnspawner_spawn_phase_duration_seconds',
+    'Time taken for each phase of starting a server',
+    ['phase', 'queue', 'profile'],
+    buckets=spawn_buckets,
+)
+
+SPAWN_FAILURES = Counter(
+    'yarnspawner_spawn_failures',
+    'Number of servers that failed to start, by cause',
+    ['cause'],
+)
+
+for cause in SPAWN_FAILURE_CAUSES:
+    SPAWN_FAILURES.labels(cause)
+
+SPAWN_LOCALIZATION_CACHE = Counter(
+    'yarnspawner_spawn_localization_cache',
+    'Number of servers started on a node that had (hit) or had not (miss) '
+    'recently localized the same public files',
+    ['result'],
+)
+
+for result in ('hit', 'miss'):
+    SPAWN_LOCALIZATION_CACHE.labels(result)
+
+PROFILE_MEMORY_ROUNDING_BYTES = Gauge(
+    'yarnspawner_profile_memory_rounding_bytes',
+    'Memory allocated beyond the requested limit, due to rounding up to the '
+    'scheduler increment',
+    ['profile'],
+)
+
+SESSION_PEAK_MEMORY_RATIO = Histogram(
+    'yarnspawner_session_peak_memory_ratio',
+    'Peak memory used by servers, as a fraction of their memory limit',
+    ['queue'],
+    buckets=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, float("inf")],
+)
+
+CULLED_SERVERS = Counter(
+    'yarnspawner_culled_servers',
+    'Number of servers stopped by the culler, by reason',
+    ['reason'],
+)
+
+for reason in ('idle', 'unresponsive'):
+    CULLED_SERVERS.labels(reason)
+
+DRIVER_RECONNECTS = Counter(
+    'yarnspawner_driver_reconnects',
+    'Number of times a failed skein driver was replaced',
+)
+
+DRIVER_BUSY_SECONDS = Counter(
+    'yarnspawner_driver_busy_seconds',
+    'Time each skein driver had at least one request in flight',
+    ['principal', 'driver'],
+)
+
+DRIVER_INFLIGHT_REQUESTS = Gauge(
+    'yarnspawner_driver_inflight_requests',
+    'Number of requests in flight to each skein driver',
+    ['principal', 'driver'],
+)
+
+RPC_DURATION_SECONDS = Histogram(
+    'yarnspawner_rpc_duration_seconds',
+    'Time taken for requests to the skein driver, by operation',
+    ['operation'],
+    buckets=rpc_buckets,
+)
+
+for operation in RPC_OPERATIONS:
+    RPC_DURATION_SECONDS.labels(operation)
+
+RPC_QUEUED_REQUESTS = Gauge(
+    'yarnspawner_rpc_queued_requests',
+    'Number of blocking skein calls waiting for a worker thread, by operation',
+    ['operation'],
+)
+
+RPC_RUNNING_REQUESTS = Gauge(
+    'yarnspawner_rpc_running_requests',
+    'Number of blocking skein calls running in a worker thread, by operation',
+    ['operation'],
+)
+
+RPC_QUEUE_WAIT_SECONDS = Histogram(
+    'yarnspawner_rpc_queue_wait_seconds',
+    'Time blocking skein calls waited for a worker thread, by operation',
+    ['operation'],
+    buckets=rpc_buckets,
+)
+
+
+class PhaseTimer(object):
+    """Record the duration of consecutive spawn phases.
+
+    If ``span`` is provided, each phase is also recorded as a child span."""
+    def __init__(self, queue, profile, span=None):
+        self.queue = queue
+        self.profile = profile
+        self.span = span
+        self.last = time.monotonic()
+        self.last_wall = time.time()
+
+    def mark(self, phase):
+        """End ``phase``, starting the next one"""
+        now = time.monotonic()
+        SPAWN_PHASE_DURATION_SECONDS.labels(
+            phase, self.queue, self.profile
+        ).observe(now - self.last)
+        self.last = now
+        if self.span is not None:
+            self.span.child(phase, start=self.last_wall).finish()
+        self.last_wall = time.time()
+
+
+@contextmanager
+def observe_rpc(operation):
+    """Record the duration of a request to the skein driver"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        RPC_DURATION_SECONDS.labels(operation).observe(time.monotonic() - start)
@@ -0,0 +1,215 @@
+import asyncio
+import random
+
+from tornado.log import app_log
+
+from .tracing import detach
+
+
+# Application states reported by ``client.get_applications``. Applications
+# missing from this listing have finished in some way.
+_ACTIVE_STATES = ('NEW', 'NEW_SAVING', 'SUBMITTED', 'ACCEPTED', 'RUNNING')
+_STOPPED_STATES = {'FAILED', 'KILLED', 'FINISHED'}
+
+
+class ApplicationPoller(object):
+    """A hub-wide snapshot of application reports.
+
+    Instead of every spawner requesting its own application report, spawners
+    register their application ids here. A single background task then
+    refreshes the reports for all tracked applications using one
+    ``get_applications`` call per cycle. Applications that drop out of that
+    listing are looked up individually once, after which their (terminal)
+    report is cached until they're untracked.
+
+    Parameters
+    ----------
+    client : ThreadedClient
+        The asynchronous client to use for requesting reports.
+    interval : float, optional
+        The maximum time (in seconds) between refreshes. Waiters may request
+        earlier refreshes, see ``wait``.
+    min_interval : float, optional
+        The minimum time (in seconds) between refreshes.
+    name : str, optional
+        Only list applications with this name.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, interval=10.0, min_interval=0.5,
+                 name='jupyterhub', log=None):
+        self.client = client
+        self.interval = interval
+        self.min_interval = min_interval
+        self.name = name
+        self.log = log or app_log
+        # A mapping of app_id -> latest report (or None if not yet known)
+        self._reports = {}
+        self._updated = None
+        self._task = None
+        # The loop time the next refresh is due
+        self._deadline = 0
+        self._wakeup = asyncio.Event()
+
+    def __contains__(self, app_id):
+        return app_id in self._reports
+
+    def track(self, app_id):
+        """Start tracking an application, if not already tracked"""
+        if app_id not in self._reports:
+            self._reports[app_id] = None
+        self._ensure_running()
+
+    def untrack(self, app_id):
+        """Stop tracking an application"""
+        self._reports.pop(app_id, None)
+
+    def get(self, app_id):
+        """The latest known report for an application, or None"""
+        return self._reports.get(app_id)
+
+    async def report(self, app_id):
+        """Get a report for an application.
+
+        Returns the latest snapshot if available, otherwise waits for the next
+        refresh."""
+        self.track(app_id)
+        report = self._reports[app_id]
+        if report is None:
+            report = await self.wait(app_id)
+        return report
+
+    async def wait(self, app_id, within=None):
+        """Wait for the next refresh, and return the report for an
+        application.
+
+        Parameters
+        ----------
+        app_id : str
+            The application id.
+        within : float, optional
+            If provided, request that the next refresh happens within this
+            many seconds (subject to ``min_interval``). By default waits for
+            the next scheduled refresh.
+        """
+        self.track(app_id)
+        if within is not None:
+            self.request_refresh(within)
+        await asyncio.shield(self._next_update())
+        report = self._reports.get(app_id)
+        if report is None:
+            raise KeyError("No report found for application %s" % app_id)
+        return report
+
+    def request_refresh(self, within=0):
+        """Request that the next refresh happens within ``within`` seconds"""
+        deadline = asyncio.get_event_loop().time() + within
+        if deadline < self._deadline:
+            self._deadline = deadline
+            self._wakeup.set()
+
+    def close(self):
+        """Stop refreshing reports"""
+        if self._task is not None:
+            self._task.cancel()
+
+    def _next_update(self):
+        if self._updated is None or self._updated.done():
+            self._updated = asyncio.get_event_loop().create_future()
+        return self._updated
+
+    def _pending(self):
+        return [app_id for app_id, report in self._reports.items()
+                if report is None or str(report.state) not in _STOPPED_STATES]
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _sleep(self):
+        # The deadline was set when the refresh started, and may have been
+        # moved earlier since by ``request_refresh``
+        loop = asyncio.get_event_loop()
+        earliest = loop.time() + self.min_interval
+        while True:
+            now = loop.time()
+            timeout = max(self._deadline, earliest) - now
+            if timeout <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        detach()
+        loop = asyncio.get_event_loop()
+        while self._pending():
+            updated = self._next_update()
+            self._deadline = loop.time() + self.interval
+            try:
+                await self._refresh()
+            except Exception as exc:
+                self.log.warning("Failed to refresh application reports",
+                                 exc_info=exc)
+                if not updated.done():
+                    updated.set_exception(exc)
+                    # Mark the exception as retrieved, waiters may be gone
+                    updated.exception()
+            else:
+                if not updated.done():
+                    updated.set_result(None)
+            await self._sleep()
+
+    async def _refresh(self):
+        reports = await self.client.get_applications(states=_ACTIVE_STATES,
+                                                     name=self.name)
+        active = {r.id: r for r in reports}
+
+        missing = []
+        for app_id in self._pending():
+            report = active.get(app_id)
+            if report is not None:
+                self._reports[app_id] = report
+            else:
+                missing.append(app_id)
+
+        # Applications no longer in the listing have stopped, fetch their
+        # final report once. Applications tracked since the listing was
+        # requested are fetched individually too, their waiters are resolved
+        # by this refresh.
+        fetched = set()
+        while missing:
+            fetched.update(missing)
+            results = await asyncio.gather(
+                *(self.client.application_report(a) for a in missing),
+                return_exceptions=True
+            )
+            for app_id, report in zip(missing, results):
+                if isinstance(report, Exception):
+                    self.log.warning("Failed to get report for application %s",
+                                     app_id, exc_info=report)
+                elif app_id in self._reports:
+                    self._reports[app_id] = report
+            missing = [app_id for app_id, report in self._reports.items()
+                       if report is None and app_id not in fetched]
+
+
+def backoff_delays(initial=0.5, maximum=10.0, factor=1.5, jitter=0.1,
+                   fast_period=5.0):
+    """Generate delays for polling with exponential backoff.
+
+    Delays start at ``initial`` for the first ``fast_period`` seconds (as
+    measured by the sum of delays), then grow geometrically by ``factor`` up
+    to ``maximum``. Each delay is randomly perturbed by up to ``jitter``
+    (a fraction of the delay), so that many pollers don't synchronize.
+    """
+    elapsed = 0
+    delay = initial
+    while True:
+        if elapsed >= fast_period:
+            delay = min(delay * factor, maximum)
+        out = delay * (1 + random.uniform(-jitter, jitter))
+        elapsed += out
+        yield out
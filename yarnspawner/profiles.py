@@ -0,0 +1,161 @@
+"""
+Resource profiles users can choose between when starting their server.
+"""
+import html
+import re
+
+from jupyterhub.traitlets import ByteSpecification
+from traitlets import HasTraits
+
+
+# The spawner attributes each profile key sets
+PROFILE_TRAITS = ('queue', 'mem_limit', 'cpu_limit', 'node_label',
+                  'cull_idle_timeout')
+
+PROFILE_KEYS = frozenset(PROFILE_TRAITS + ('display_name', 'slug',
+                                           'description', 'default',
+                                           'environment'))
+
+# The name archived environments are localized as
+ENVIRONMENT_NAME = 'environment'
+
+
+class _Bytes(HasTraits):
+    value = ByteSpecification()
+
+
+def _parse_bytes(value):
+    return _Bytes(value=value).value
+
+
+def _slugify(name):
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def normalize_profiles(profiles):
+    """Validate profiles, filling in slugs and parsing memory limits.
+
+    Parameters
+    ----------
+    profiles : list of dict
+        The configured profiles.
+
+    Returns
+    -------
+    profiles : list of dict
+        Copies of the profiles, with exactly one marked ``default``.
+    """
+    out = []
+    slugs = set()
+    for profile in profiles:
+        unknown = set(profile).difference(PROFILE_KEYS)
+        if unknown:
+            raise ValueError("Unknown profile keys %s"
+                             % ', '.join(sorted(unknown)))
+        if 'display_name' not in profile:
+            raise ValueError("Profiles must have a display_name")
+        profile = dict(profile)
+        slug = profile.setdefault('slug',
+                                  _slugify(profile['display_name']))
+        if not slug or slug in slugs:
+            raise ValueError("Profile slugs must be unique and non-empty, "
+                             "got %r" % slug)
+        slugs.add(slug)
+        if 'mem_limit' in profile:
+            profile['mem_limit'] = _parse_bytes(profile['mem_limit'])
+        profile['default'] = bool(profile.get('default', False))
+        out.append(profile)
+    if out and not any(p['default'] for p in out):
+        out[0]['default'] = True
+    return out
+
+
+def find_profile(profiles, slug=None):
+    """The profile with a slug, or the default profile if no slug"""
+    for profile in profiles:
+        if (profile['slug'] == slug) if slug else profile['default']:
+            return profile
+    raise ValueError("Unknown profile %r" % slug)
+
+
+def apply_profile(spawner, profile):
+    """Set a spawner's attributes from a profile"""
+    for name in PROFILE_TRAITS:
+        if name in profile:
+            setattr(spawner, name, profile[name])
+    environment = profile.get('environment')
+    if environment:
+        files = dict(spawner.localize_files)
+        files[ENVIRONMENT_NAME] = {'source': environment,
+                                   'visibility': 'public'}
+        spawner.localize_files = files
+        activate = 'source %s/bin/activate' % ENVIRONMENT_NAME
+        if activate not in spawner.prologue:
+            spawner.prologue = '%s\n%s' % (activate, spawner.prologue)
+
+
+def _describe(profile, spawner):
+    memory = profile.get('mem_limit', spawner.mem_limit) // 2**20
+    vcores = profile.get('cpu_limit', spawner.cpu_limit)
+    parts = ['%d MiB' % memory, '%d vcores' % vcores,
+             'queue %s' % profile.get('queue', spawner.queue)]
+    label = profile.get('node_label', spawner.node_label)
+    if label:
+        parts.append('%s nodes' % label)
+    return memory, vcores, ', '.join(parts)
+
+
+def _availability(snapshot, profile, spawner, memory, vcores):
+    if snapshot is None:
+        return 'Availability unknown'
+    count = snapshot.available(memory, vcores,
+                               queue=profile.get('queue', spawner.queue),
+                               node_label=profile.get('node_label',
+                                                      spawner.node_label))
+    if count == 0:
+        return 'No room right now, you may have to wait'
+    return 'Room for about %d more' % count
+
+
+def render_form(profiles, spawner, snapshot=None, recommended=None):
+    """Render the options form for choosing a profile.
+
+    Parameters
+    ----------
+    profiles : list of dict
+        The normalized profiles.
+    spawner : YarnSpawner
+        The spawner, used for defaults for anything a profile doesn't set.
+    snapshot : ClusterSnapshot, optional
+        Free cluster resources, used to estimate each profile's availability.
+    recommended : tuple, optional
+        The ``(mem_limit, cpu_limit)`` recommended from the user's usage.
+    """
+    selected = (spawner.user_options or {}).get('profile')
+    if selected not in {p['slug'] for p in profiles}:
+        selected = find_profile(profiles)['slug']
+    items = []
+    for profile in profiles:
+        memory, vcores, summary = _describe(profile, spawner)
+        items.append(
+            '<label class="yarnspawner-profile">\n'
+            '  <input type="radio" name="profile" value="{slug}"{checked}>\n'
+            '  <strong>{name}</strong> ({summary})\n'
+            '  <p>{description}</p>\n'
+            '  <p><em>{availability}</em></p>\n'
+            '</label>'.format(
+                slug=html.escape(profile['slug']),
+                checked=' checked' if profile['slug'] == selected else '',
+                name=html.escape(profile['display_name']),
+                summary=html.escape(summary),
+                description=html.escape(profile.get('description', '')),
+                availability=html.escape(
+                    _availability(snapshot, profile, spawner, memory, vcores)
+                )
+            )
+        )
+    if recommended is not None:
+        items.insert(0, '<p>Based on your recent usage, %d MiB and %d vcores '
+                        'should be enough.</p>'
+                     % (recommended[0] // 2**20, recommended[1]))
+    return '<div class="yarnspawner-profiles">\n%s\n</div>' % '\n'.join(items)
@@ -0,0 +1,62 @@
+import asyncio
+
+
+class ProgressLog(object):
+    """Progress events for a single start, shared by any number of followers.
+
+    The start loop emits events as it observes changes. While waiting on
+    something that changes gradually (e.g. a place in line), it can instead
+    set a ``status`` callable, which followers poll for the current event.
+    Following never makes any requests itself.
+    """
+    def __init__(self):
+        self.events = []
+        self.status = None
+        self.finished = False
+        self._updated = asyncio.Event()
+
+    def _wake(self):
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+    def emit(self, progress, message):
+        """Record an event, clearing any status"""
+        self.events.append({'progress': progress, 'message': message})
+        self.status = None
+        self._wake()
+
+    def set_status(self, status):
+        """Set a callable returning the current event (or None), polled by
+        followers until the next event"""
+        self.status = status
+        self._wake()
+
+    def finish(self):
+        """Mark the start as done, ending all followers"""
+        self.finished = True
+        self.status = None
+        self._wake()
+
+    async def follow(self, interval=1.0):
+        """Yield events until finished, including any earlier events.
+
+        The status is checked every ``interval`` seconds while set, and
+        yielded whenever it changes."""
+        sent = 0
+        last_status = None
+        while True:
+            while sent < len(self.events):
+                yield self.events[sent]
+                sent += 1
+            if self.finished:
+                return
+            status = self.status() if self.status is not None else None
+            if status is not None and status != last_status:
+                yield status
+            last_status = status
+            updated = self._updated
+            try:
+                await asyncio.wait_for(updated.wait(),
+                                       interval if status is not None else None)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,65 @@
+import asyncio
+from collections import deque
+
+import skein
+from tornado.log import app_log
+
+from .tracing import detach
+
+
+class CredentialPool(object):
+    """A pool of pre-generated ``skein.Security`` credentials.
+
+    Generating a new key pair and certificate is CPU intensive. The pool keeps
+    up to ``size`` credentials ready, refilling in the background in a worker
+    thread, so that taking one is cheap.
+
+    Parameters
+    ----------
+    size : int
+        The number of credentials to keep ready.
+    executor : SkeinExecutor
+        The executor to generate credentials in.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, size, executor, log=None):
+        self.size = size
+        self.executor = executor
+        self.log = log or app_log
+        self._ready = deque()
+        self._task = None
+
+    def __len__(self):
+        return len(self._ready)
+
+    async def _generate(self):
+        return await self.executor.run('credentials',
+                                       skein.Security.new_credentials)
+
+    async def _refill(self):
+        detach()
+        while len(self._ready) < self.size:
+            try:
+                self._ready.append(await self._generate())
+            except Exception as exc:
+                self.log.warning("Failed to generate credentials",
+                                 exc_info=exc)
+                break
+
+    def fill(self):
+        """Start refilling the pool in the background, if not already"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refill())
+
+    async def get(self):
+        """Take credentials from the pool.
+
+        If the pool is empty, new credentials are generated in the executor.
+        """
+        try:
+            security = self._ready.popleft()
+        except IndexError:
+            security = await self._generate()
+        self.fill()
+        return security
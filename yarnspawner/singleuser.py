@@ -4,6 +4,12 @@ from jupyterhub.singleuser import SingleUserNotebookApp
 from jupyterhub.utils import random_port, url_path_join
 from traitlets import default
 
+from .tracing import ContainerTrace
+from .usage import UsageMonitor
+
+# Created after imports, to time them
+_trace = ContainerTrace()
+
 
 # Borrowed and modified from jupyterhub/batchspawner:
 # https://github.com/jupyterhub/batchspawner/blob/d1052385f2/batchspawner/singleuser.py
@@ -12,11 +18,25 @@ class YarnSingleUserNotebookApp(SingleUserNotebookApp):
     def _port(self):
         return random_port()
 
-    def start(self):
+    def _post_to_hub(self, data):
         self.hub_auth._api_request(method='POST',
                                    url=url_path_join(self.hub_api_url, 'yarnspawner'),
-                                   json={'port': self.port})
-        super().start()
+                                   json=data)
+
+    def start(self):
+        _trace.mark('initialize')
+        data = {'port': self.port}
+        if _trace.enabled:
+            data['trace'] = _trace.to_json()
+        self._post_to_hub(data)
+        monitor, interval = UsageMonitor.from_environ()
+        if monitor is not None:
+            monitor.start(interval, self._post_to_hub)
+        try:
+            super().start()
+        finally:
+            if monitor is not None:
+                monitor.stop()
 
 
 def main(argv=None):
@@ -1,11 +1,87 @@
+import asyncio
+import datetime
+import functools
+import hashlib
+import json
+
 import skein
 from jupyterhub.spawner import Spawner
 from jupyterhub.traitlets import Command, ByteSpecification
-from traitlets import Unicode, Dict, Integer
+from traitlets import (Unicode, Dict, Integer, Float, Enum, Union, Callable,
+                       Bool, List, default)
 from tornado import gen
 
+from .admission import AdmissionCancelled, AdmissionController
+from .client import AsyncioClient, ReportCache, SkeinExecutor, ThreadedClient
+from .cluster import ClusterInfo, queue_usage
+from .culler import IdleCuller
+from .diagnostics import DiagnosticsCollector
+from .driverpool import DriverPool
+from .killer import ApplicationKiller
+from .localization import LocalizationHistory, public_resources
+from .metrics import (PhaseTimer, PROFILE_MEMORY_ROUNDING_BYTES, SPAWN_FAILURES,
+                      SPAWN_LOCALIZATION_CACHE, SESSION_PEAK_MEMORY_RATIO)
+from .poller import ApplicationPoller, backoff_delays, _STOPPED_STATES
+from .progress import ProgressLog
+from .profiles import (PROFILE_TRAITS, apply_profile, find_profile,
+                       normalize_profiles, render_form)
+from .security import CredentialPool
+from .supervisor import SupervisedClient
+from .tracing import (Span, Tracer, JSONLinesExporter, activate,
+                      TRACE_ID_ENV, PARENT_ID_ENV, SCRIPT_START_ENV)
+from .uploads import UploadCache
+from .usage import USAGE_INTERVAL_ENV, UsageHistory
+from .warmpool import WarmPool
+
+
+class _StartFailed(Exception):
+    """The application stopped before the server started"""
+
+
+class _Rejected(Exception):
+    """The application can't be run with the requested resources"""
+
+
+class _SpecSettings(object):
+    """The settings an application specification is built from.
+
+    Copied from the spawner when created, so warm pools keep building
+    applications matching their key after the spawner that created them
+    changes profile or resources. Any other attributes are read from the
+    spawner.
+    """
+    _fields = ('queue', 'node_label', 'mem_limit', 'cpu_limit', 'prologue',
+               'epilogue')
 
-_STOPPED_STATES = {'FAILED', 'KILLED', 'FINISHED'}
+    def __init__(self, spawner, files=None):
+        for name in self._fields:
+            setattr(self, name, getattr(spawner, name))
+        self.localize_files = (spawner.localize_files if files is None
+                               else files)
+        self._spawner = spawner
+
+    def __getattr__(self, name):
+        return getattr(self._spawner, name)
+
+    def key(self):
+        files = {k: v.to_dict() if isinstance(v, skein.File) else v
+                 for k, v in self.localize_files.items()}
+        data = json.dumps([self.queue, self.node_label, self.mem_limit,
+                           self.cpu_limit, files, self.prologue,
+                           self.epilogue],
+                          sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _age(timestamp):
+    """Seconds since a UTC datetime (naive or aware), or None"""
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is None:
+        now = datetime.datetime.utcnow()
+    else:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return (now - timestamp).total_seconds()
 
 
 class YarnSpawner(Spawner):
@@ -43,6 +119,15 @@ class YarnSpawner(Spawner):
         config=True,
     )
 
+    node_label = Unicode(
+        '',
+        help="""
+        The YARN node label to run singleuser servers on. If empty (the
+        default), the queue's default node label is used.
+        """,
+        config=True,
+    )
+
     localize_files = Dict(
         help="""
         Extra files to distribute to the singleuser server container.
@@ -73,6 +158,277 @@ class YarnSpawner(Spawner):
         config=True,
     )
 
+    profiles = List(
+        Dict(),
+        help="""
+        Resource profiles users can choose between when starting their
+        server. If empty (the default), everyone gets the same resources.
+
+        Each profile is a dict with the following keys, all optional except
+        ``display_name``:
+
+        - ``display_name``: the name shown to users.
+        - ``slug``: a short identifier, stored in ``user_options``. Defaults
+          to a slug of ``display_name``.
+        - ``description``: a longer description shown to users.
+        - ``default``: whether this profile is selected by default. Defaults
+          to the first profile.
+        - ``queue``, ``mem_limit``, ``cpu_limit``, ``node_label``,
+          ``cull_idle_timeout``: override the corresponding configuration.
+        - ``environment``: the path to an archived environment, localized as
+          ``environment`` and activated before the server starts.
+
+        For example:
+
+        .. code::
+
+            c.YarnSpawner.profiles = [
+                {'display_name': 'Small', 'mem_limit': '2 G', 'cpu_limit': 1},
+                {'display_name': 'Large', 'mem_limit': '16 G', 'cpu_limit': 4,
+                 'queue': 'large',
+                 'environment': 'hdfs:///environments/ml.tar.gz'}
+            ]
+
+        Unless ``options_form`` is set, users choose a profile from a form
+        showing each profile's estimated availability, based on a cached
+        snapshot of free cluster resources (see ``cluster_snapshot_ttl``).
+        """,
+        config=True,
+    )
+
+    cluster_snapshot_ttl = Float(
+        30.0,
+        help="""
+        Maximum age (in seconds) of the snapshot of free cluster resources
+        used to estimate the availability of ``profiles``.
+
+        The snapshot is refreshed in the background, the options form never
+        waits for it except when first shown.
+        """,
+        config=True,
+    )
+
+    right_sizing = Enum(
+        ['off', 'recommend', 'apply'],
+        default_value='off',
+        help="""
+        Whether to size ``mem_limit`` and ``cpu_limit`` from each user's
+        past usage.
+
+        - ``off``: don't measure usage.
+        - ``recommend``: measure the peak memory and cpu usage of each
+          server, and recommend limits from the user's recent peaks. The
+          recommendation is logged at start, and shown in the ``profiles``
+          form.
+        - ``apply``: as ``recommend``, but also start servers with the
+          recommended limits, within ``right_sizing_min_mem``,
+          ``right_sizing_max_mem``, and ``right_sizing_max_cpu``.
+
+        Recommendations are the largest peak over the user's last
+        ``right_sizing_history`` sessions, plus ``right_sizing_headroom``.
+        With ``profiles``, servers are only sized from past sessions with the
+        same profile.
+        Usage is sampled every ``usage_sample_interval`` seconds by the
+        singleuser server, from the container's cgroup if YARN uses cgroups,
+        otherwise from its processes.
+        """,
+        config=True,
+    )
+
+    right_sizing_headroom = Float(
+        0.25,
+        min=0.0,
+        help="""
+        Headroom added to a user's peak usage when recommending limits, as a
+        fraction of the peak.
+        """,
+        config=True,
+    )
+
+    right_sizing_min_mem = ByteSpecification(
+        '512 M',
+        help="Smallest ``mem_limit`` applied when ``right_sizing='apply'``.",
+        config=True,
+    )
+
+    right_sizing_max_mem = ByteSpecification(
+        0,
+        help="""
+        Largest ``mem_limit`` applied when ``right_sizing='apply'``. If 0 (the
+        default), the configured (or profile's) ``mem_limit``, so limits are
+        only ever reduced.
+        """,
+        config=True,
+    )
+
+    right_sizing_max_cpu = Integer(
+        0,
+        min=0,
+        help="""
+        Largest ``cpu_limit`` applied when ``right_sizing='apply'``. If 0 (the
+        default), the configured (or profile's) ``cpu_limit``, so limits are
+        only ever reduced.
+        """,
+        config=True,
+    )
+
+    right_sizing_history = Integer(
+        10,
+        min=1,
+        help="""
+        Number of a user's most recent sessions (with each profile) to base
+        limits on.
+        """,
+        config=True,
+    )
+
+    right_sizing_max_age = Float(
+        30 * 24 * 3600,
+        help="Maximum age (in seconds) of sessions to base limits on.",
+        config=True,
+    )
+
+    usage_sample_interval = Float(
+        10.0,
+        help="""
+        Interval (in seconds) between samples of a server's resource usage,
+        when ``right_sizing`` is enabled.
+        """,
+        config=True,
+    )
+
+    cull_idle_timeout = Float(
+        0,
+        help="""
+        Stop servers that have had no activity for this long (in seconds).
+        If 0 (the default), idle servers aren't stopped. Can be set per
+        profile, see ``profiles``.
+
+        Activity is as recorded by the hub. Servers are checked every
+        ``cull_interval`` seconds.
+        """,
+        config=True,
+    )
+
+    cull_callback_timeout = Float(
+        0,
+        help="""
+        Stop servers whose application has been running this long (in
+        seconds) without the singleuser server reporting its port, e.g.
+        after a failed start that the hub lost track of. If 0 (the default),
+        these servers aren't stopped.
+        """,
+        config=True,
+    )
+
+    cull_interval = Float(
+        300.0,
+        help="""
+        Interval (in seconds) between checks for servers to stop, when
+        ``cull_idle_timeout`` or ``cull_callback_timeout`` is set.
+        """,
+        config=True,
+    )
+
+    cull_concurrency = Integer(
+        10,
+        min=1,
+        help="Maximum number of servers the culler stops at once.",
+        config=True,
+    )
+
+    failure_log_bytes = Integer(
+        64 * 1024,
+        min=0,
+        help="""
+        Maximum number of bytes of log output kept for each server that fails
+        to start.
+
+        When an application fails while starting, its diagnostics and the
+        tail of its logs are collected in the background. A short summary is
+        shown to the user, and the most recent failures are available to
+        admins at ``/hub/api/yarnspawner/diagnostics``. Logs are streamed
+        with the ``yarn logs`` command if available, otherwise fetched
+        through skein. Set to 0 to only collect diagnostics.
+        """,
+        config=True,
+    )
+
+    failure_log_wait = Float(
+        5.0,
+        help="""
+        Maximum time (in seconds) to wait for the logs of a server that failed
+        to start, before reporting the failure without them.
+        """,
+        config=True,
+    )
+
+    failure_diagnostics_max_entries = Integer(
+        100,
+        min=1,
+        help="Number of recent start failures kept for admins.",
+        config=True,
+    )
+
+    localization_history_max_age = Float(
+        24 * 3600,
+        help="""
+        How long (in seconds) to remember which nodes localized which public
+        ``localize_files`` resources.
+
+        Servers starting on a node that recently localized the same public
+        resources are counted as cache hits in the
+        ``yarnspawner_spawn_localization_cache`` metric. This can be used to
+        judge whether restricting servers to fewer nodes (e.g. with
+        ``node_label``) would reduce localization time.
+        """,
+        config=True,
+    )
+
+    upload_cache_dir = Unicode(
+        '',
+        help="""
+        A directory to upload local ``localize_files`` resources to, as a full
+        URI, e.g. ``hdfs:///user/jupyterhub/.yarnspawner``. If empty (the default),
+        local resources are uploaded by skein separately for every
+        application.
+
+        Each version of a resource is uploaded once to a path containing a
+        hash of its contents, and reused by all applications until it
+        changes. Uploads use the ``hdfs`` command line tool, with the
+        credentials of the user JupyterHub is running as.
+        """,
+        config=True,
+    )
+
+    upload_cache_public = Bool(
+        False,
+        help="""
+        Whether cached archives (e.g. environments) without a configured
+        visibility should be localized with ``public`` visibility. Public
+        resources are localized once per node and shared between all
+        applications, but are readable by all users. Other files, and
+        resources with an explicitly configured visibility, are left as they
+        are.
+        """,
+        config=True,
+    )
+
+    upload_cache_max_age = Float(
+        7 * 24 * 3600,
+        help="""
+        Cached uploads unused for this long (in seconds) are removed from
+        ``upload_cache_dir``.
+        """,
+        config=True,
+    )
+
+    upload_cache_gc_interval = Float(
+        3600,
+        help="Interval (in seconds) between removing unused cached uploads.",
+        config=True,
+    )
+
     prologue = Unicode(
         '',
         help='Script to run before singleuser server starts.',
@@ -131,122 +487,1336 @@ class YarnSpawner(Spawner):
         config=True,
     )
 
-    # A cache of clients by (principal, keytab). In most cases this will only
-    # be a single client. These should persist for the lifetime of jupyterhub.
+    admission_control = Bool(
+        False,
+        help="""
+        Whether to hold back submissions while the queue is full.
+
+        If enabled, new applications are submitted in the order users started,
+        only while fewer than ``admission_max_pending`` submitted applications
+        are waiting to start running, and the queue is using less than
+        ``admission_max_queue_usage`` percent of its maximum capacity. Users
+        waiting to be submitted see their position in line.
+        """,
+        config=True,
+    )
+
+    admission_max_pending = Integer(
+        20,
+        min=1,
+        help="""
+        Maximum number of submitted applications per queue that have yet to
+        start running, when ``admission_control`` is enabled.
+        """,
+        config=True,
+    )
+
+    admission_max_queue_usage = Float(
+        95.0,
+        help="""
+        Queue usage, as a percentage of the queue's maximum capacity, above
+        which submissions are held back when ``admission_control`` is enabled.
+        """,
+        config=True,
+    )
+
+    queue_info_ttl = Float(
+        5.0,
+        help="Maximum age (in seconds) of cached queue capacity and usage.",
+        config=True,
+    )
+
+    resource_limit_policy = Enum(
+        ['reject', 'clamp'],
+        default_value='reject',
+        help="""
+        What to do when ``mem_limit`` or ``cpu_limit`` is larger than the
+        largest container the cluster can allocate.
+
+        - ``reject``: fail to start, without submitting the application.
+        - ``clamp``: reduce the limit to the cluster maximum.
+
+        The cluster maximum is the smaller of the scheduler's maximum
+        allocation (if set in ``yarn-site.xml``) and the resources of the
+        largest running node. Applications for stopped queues are always
+        rejected.
+        """,
+        config=True,
+    )
+
+    cluster_info_interval = Float(
+        300.0,
+        help="""
+        Maximum age (in seconds) of the cached cluster container limits (the
+        maximum allocation and scheduler increment).
+        """,
+        config=True,
+    )
+
+    hadoop_conf_dir = Unicode(
+        '',
+        help="""
+        The Hadoop configuration directory to read ``yarn-site.xml`` from. If
+        empty (the default), ``$HADOOP_CONF_DIR`` is used, falling back to
+        ``/etc/hadoop/conf``.
+        """,
+        config=True,
+    )
+
+    report_poll_interval = Float(
+        10.0,
+        help="""
+        Maximum interval (in seconds) between refreshes of the shared
+        application report snapshot.
+
+        Reports for all running applications are fetched together in a single
+        request, which is shared between all users. Refreshes happen more
+        frequently while applications are starting, see
+        ``state_poll_interval``.
+        """,
+        config=True,
+    )
+
+    report_cache_ttl = Float(
+        1.0,
+        min=0.0,
+        help="""
+        Maximum age (in seconds) of a cached application report.
+
+        Requests for the same application's report within this time share a
+        single request to YARN. Cached reports are dropped when an
+        application is submitted or killed. Set to 0 to only share concurrent
+        requests.
+        """,
+        config=True,
+    )
+
+    state_poll_interval = Float(
+        0.5,
+        help="""
+        Initial interval (in seconds) between application state checks while
+        waiting for an application to start running.
+
+        The interval is kept for ``state_poll_fast_period`` seconds, then grows
+        by ``state_poll_backoff`` after every check up to
+        ``state_poll_max_interval``. Whenever the application changes state the
+        schedule starts over. This is also the minimum interval between
+        refreshes of the shared application report snapshot.
+        """,
+        config=True,
+    )
+
+    state_poll_fast_period = Float(
+        5.0,
+        help="Duration (in seconds) to poll at ``state_poll_interval``.",
+        config=True,
+    )
+
+    state_poll_backoff = Float(
+        1.5,
+        min=1.0,
+        help="Multiplier applied to the state polling interval after each check.",
+        config=True,
+    )
+
+    state_poll_max_interval = Float(
+        10.0,
+        help="Maximum interval (in seconds) between application state checks.",
+        config=True,
+    )
+
+    state_poll_jitter = Float(
+        0.1,
+        min=0.0,
+        max=1.0,
+        help="""
+        Random jitter applied to each state polling interval, as a fraction of
+        the interval.
+        """,
+        config=True,
+    )
+
+    port_check_interval = Float(
+        5.0,
+        help="""
+        Interval (in seconds) between checks that the application is still
+        alive while waiting for the singleuser server to report its port.
+
+        The wait itself ends as soon as the singleuser server calls back, this
+        only bounds how long a failed application goes unnoticed.
+        """,
+        config=True,
+    )
+
+    stop_timeout = Float(
+        10,
+        help="""
+        Timeout (in seconds) to wait for a killed application to be confirmed
+        stopped. Applications still running after this timeout are logged.
+        Set to 0 to not wait.
+
+        Kills from all users are made concurrently, bounded by
+        ``max_concurrent_kills``, so this is also roughly the time to stop all
+        servers on hub shutdown.
+        """,
+        config=True,
+    )
+
+    client_health_check_interval = Float(
+        30,
+        help="""
+        Interval (in seconds) between health checks of the skein driver.
+
+        If the driver fails a health check, or a request can't reach it, a new
+        driver is started. Requests made in the meantime wait for the new
+        driver, up to ``client_connect_timeout``.
+        """,
+        config=True,
+    )
+
+    client_health_check_timeout = Float(
+        10,
+        help="Timeout (in seconds) for the skein driver to respond to a health check.",
+        config=True,
+    )
+
+    rpc_timeout = Float(
+        60,
+        min=0,
+        help="""
+        Deadline (in seconds) for each request to the skein driver, so
+        requests to a hung driver fail instead of waiting forever. Set to 0
+        for no deadline. Submits use ``submit_timeout`` instead.
+        """,
+        config=True,
+    )
+
+    submit_timeout = Float(
+        0,
+        min=0,
+        help="""
+        Deadline (in seconds) for submitting an application to the skein
+        driver. Local files in ``localize_files`` are uploaded while
+        submitting, so this must allow for uploading the largest of them. Set
+        to 0 for no deadline (the default), submits to a hung driver still
+        fail once the driver's health check fails.
+        """,
+        config=True,
+    )
+
+    client_connect_timeout = Float(
+        120,
+        help="""
+        Maximum time (in seconds) requests wait for a skein driver to start,
+        before failing.
+        """,
+        config=True,
+    )
+
+    drivers_per_principal = Integer(
+        1,
+        min=1,
+        help="""
+        Number of skein drivers to run for each ``principal``.
+
+        Requests for an existing application are always sent to the same
+        driver (by a hash of its application id), new applications are
+        submitted through the least busy driver. The load on each driver is
+        exported in the ``yarnspawner_driver_busy_seconds`` and
+        ``yarnspawner_driver_inflight_requests`` metrics. With the
+        ``'thread'`` transport, all drivers share ``rpc_threads`` and the
+        per-operation limits.
+        """,
+        config=True,
+    )
+
+    max_clients = Integer(
+        16,
+        min=0,
+        help="""
+        Maximum number of skein drivers to keep running. A driver is started
+        for every distinct ``principal`` and ``keytab``, if there are more
+        than this the least recently used is stopped. Set to 0 for no limit.
+        """,
+        config=True,
+    )
+
+    rpc_transport = Enum(
+        ['thread', 'asyncio'],
+        'thread',
+        help="""
+        How requests are made to the skein driver.
+
+        - ``'thread'``: blocking requests are made in a pool of
+          ``rpc_threads`` threads, with per-operation limits.
+        - ``'asyncio'``: requests are made directly on the event loop using
+          grpc's asyncio API (requires grpcio >= 1.32). This allows many more
+          concurrent requests, and isn't bounded by the thread pool size or
+          the per-operation limits.
+        """,
+        config=True,
+    )
+
+    rpc_threads = Integer(
+        16,
+        min=1,
+        help="""
+        Number of threads used for making requests to YARN.
+
+        These threads are shared by all users, and are separate from the
+        thread pool used by the rest of JupyterHub.
+        """,
+        config=True,
+    )
+
+    max_concurrent_submits = Integer(
+        8,
+        min=0,
+        help="""
+        Maximum number of application submissions in flight at once. Set to 0
+        for no limit (other than ``rpc_threads``).
+        """,
+        config=True,
+    )
+
+    max_concurrent_reports = Integer(
+        4,
+        min=0,
+        help="""
+        Maximum number of application report requests in flight at once. Set
+        to 0 for no limit (other than ``rpc_threads``).
+        """,
+        config=True,
+    )
+
+    max_concurrent_kills = Integer(
+        4,
+        min=0,
+        help="""
+        Maximum number of application kill requests in flight at once. Set to
+        0 for no limit (other than ``rpc_threads``).
+        """,
+        config=True,
+    )
+
+    credential_pool_size = Integer(
+        10,
+        min=0,
+        help="""
+        Number of pre-generated security credentials to keep ready.
+
+        Each application requires new credentials (a key pair and
+        certificate), which are expensive to generate. These are generated
+        ahead of time in a background thread, so that many users can be
+        started at once without stalling JupyterHub. Set to 0 to generate
+        credentials on demand (still in a background thread).
+        """,
+        config=True,
+    )
+
+    warm_pool_size = Union(
+        [Integer(), Callable()],
+        default_value=0,
+        help="""
+        Number of idle applications to keep running, ready to be assigned to
+        users.
+
+        Idle applications are started ahead of time with the same queue,
+        resources, and localized files as a user would get, and run the
+        ``prologue`` before waiting. Assigning a user to one skips YARN
+        scheduling and file localization. A separate pool is kept for each
+        distinct combination of these settings, and is refilled in the
+        background as applications are assigned.
+
+        May also be a callable, taking the spawner and returning the pool
+        size. This is evaluated periodically for each pool, with the
+        spawner's queue, resources, localized files, ``prologue``, and
+        ``epilogue`` set to those of the pool. It can be used to vary pool
+        sizes by profile or time of day:
+
+        .. code::
+
+            import datetime
+
+            def warm_pool_size(spawner):
+                if spawner.queue != 'default':
+                    return 0
+                if 8 <= datetime.datetime.now().hour < 10:
+                    return 50
+                return 5
+
+            c.YarnSpawner.warm_pool_size = warm_pool_size
+
+        **Note**: since idle applications are started before a user is known,
+        they run as ``warm_pool_user``, not as the user they're assigned to.
+        Only enable this if that's acceptable for your deployment.
+        """,
+        config=True,
+    )
+
+    warm_pool_user = Unicode(
+        '',
+        help="""
+        The user to run idle warm pool applications as. Defaults to the user
+        JupyterHub is running as.
+        """,
+        config=True,
+    )
+
+    warm_pool_max_idle = Float(
+        3600,
+        help="""
+        Maximum time (in seconds) an idle warm pool application is kept before
+        being replaced. Idle applications also shut themselves down after this
+        long, so they don't outlive JupyterHub.
+        """,
+        config=True,
+    )
+
+    trace_file = Unicode(
+        '',
+        help="""
+        Path to a file to write spawn traces to, as JSON lines. If empty (the
+        default), tracing is disabled.
+
+        Each spawn is recorded as a trace, made up of spans for each phase of
+        starting the server (including requests to YARN), along with spans
+        recorded by the singleuser server itself (running the prologue,
+        importing Python, and initializing the server). Each line is a single
+        finished span, with ``trace_id``, ``span_id``, ``parent_id``,
+        ``name``, ``service``, ``start``, ``end``, ``duration``, and
+        ``attributes`` fields. Times are in seconds since the epoch.
+        """,
+        config=True,
+    )
+
+    # The tracer used for spawn traces, shared by all spawners.
+    tracer = None
+
+    # Admission controllers by (principal, keytab, queue).
+    admission_controllers = {}
+
+    # Cached queue and cluster limit information by (principal, keytab).
+    cluster_infos = {}
+
+    # Which nodes recently localized which resources, shared by all spawners.
+    localization_history = None
+
+    # The cache of uploaded local files, shared by all spawners.
+    upload_cache = None
+
+    # The executor used for all blocking skein calls, shared by all spawners.
+    executor = None
+
+    # The pool of pre-generated credentials, shared by all spawners.
+    credential_pool = None
+
+    # A cache of serialized application specification templates, keyed by a
+    # hash of the configuration they depend on.
+    _spec_templates = {}
+
+    # Application killers by (principal, keytab), one per client.
+    killers = {}
+
+    # Collectors of start failure diagnostics by (principal, keytab), one per
+    # client.
+    diagnostics_collectors = {}
+
+    # The culler of idle servers, shared by all spawners.
+    culler = None
+
+    # Warm pools of idle applications, keyed by specification template key.
+    warm_pools = {}
+
+    # A cache of clients by (principal, keytab), least recently used first.
+    # In most cases this will only be a single client, which persists for the
+    # lifetime of jupyterhub.
     clients = {}
 
+    # A cache of application pollers by (principal, keytab), one per client.
+    pollers = {}
+
+    def _get_executor(self):
+        cls = type(self)
+        if cls.executor is None:
+            cls.executor = SkeinExecutor(
+                max_workers=self.rpc_threads,
+                limits={'submit': self.max_concurrent_submits,
+                        'report': self.max_concurrent_reports,
+                        'kill': self.max_concurrent_kills,
+                        'upload': 2,
+                        'logs': 2,
+                        # Credential generation is CPU bound, don't let it
+                        # take over the pool.
+                        'credentials': 2}
+            )
+        return cls.executor
+
+    def _get_tracer(self):
+        if not self.trace_file:
+            return None
+        cls = type(self)
+        if cls.tracer is None or cls.tracer.exporter.path != self.trace_file:
+            if cls.tracer is not None:
+                cls.tracer.exporter.close()
+            cls.tracer = Tracer(JSONLinesExporter(self.trace_file))
+        return cls.tracer
+
+    def _get_credential_pool(self):
+        cls = type(self)
+        if cls.credential_pool is None:
+            cls.credential_pool = CredentialPool(self.credential_pool_size,
+                                                 self._get_executor(),
+                                                 log=self.log)
+            cls.credential_pool.fill()
+        return cls.credential_pool
+
+    def _get_localization_history(self):
+        cls = type(self)
+        if cls.localization_history is None:
+            cls.localization_history = LocalizationHistory(
+                max_age=self.localization_history_max_age
+            )
+        return cls.localization_history
+
+    def _record_localization(self, resources, host):
+        """Record that ``host`` localized ``resources``, and whether it had
+        recently localized them already"""
+        if not resources:
+            return
+        history = self._get_localization_history()
+        hit = host in history.nodes(resources)
+        SPAWN_LOCALIZATION_CACHE.labels('hit' if hit else 'miss').inc()
+        history.record(resources, host)
+
+    def _get_upload_cache(self):
+        if not self.upload_cache_dir:
+            return None
+        cls = type(self)
+        cache = cls.upload_cache
+        if cache is None or cache.directory != self.upload_cache_dir.rstrip('/'):
+            cache = cls.upload_cache = UploadCache(
+                self.upload_cache_dir,
+                self._get_executor(),
+                public=self.upload_cache_public,
+                max_age=self.upload_cache_max_age,
+                gc_interval=self.upload_cache_gc_interval,
+                log=self.log
+            )
+            cache.start()
+        return cache
+
+    async def _localize_files(self):
+        """The files to localize, with local files replaced by their cached
+        uploads if enabled"""
+        if not self.upload_cache_dir:
+            return self.localize_files
+        try:
+            return await self._get_upload_cache().resolve(self.localize_files)
+        except Exception as exc:
+            self.log.warning("Failed to upload files to %s, falling back to "
+                             "uploading per application",
+                             self.upload_cache_dir, exc_info=exc)
+            return self.localize_files
+
+    async def _connect_client(self):
+        """Start a new driver, and connect to it"""
+        client_class = (AsyncioClient if self.rpc_transport == 'asyncio'
+                        else ThreadedClient)
+        security = await self._get_credential_pool().get()
+        return await client_class.connect(
+            self._get_executor(),
+            timeout=self.rpc_timeout or None,
+            submit_timeout=self.submit_timeout or None,
+            principal=self.principal,
+            keytab=self.keytab,
+            security=security
+        )
+
     async def _get_client(self):
+        cls = type(self)
         key = (self.principal, self.keytab)
-        client = type(self).clients.get(key)
+        # Reinsert on every use, so the dict is ordered least recently used
+        # first.
+        client = cls.clients.pop(key, None)
         if client is None:
-            kwargs = dict(principal=self.principal,
-                          keytab=self.keytab,
-                          security=skein.Security.new_credentials())
-            client = await gen.IOLoop.current().run_in_executor(
-                None, lambda: skein.Client(**kwargs)
-            )
-            type(self).clients[key] = client
+            drivers = [
+                SupervisedClient(
+                    self._connect_client,
+                    check_interval=self.client_health_check_interval,
+                    check_timeout=self.client_health_check_timeout,
+                    connect_timeout=self.client_connect_timeout,
+                    log=self.log
+                )
+                for _ in range(self.drivers_per_principal)
+            ]
+            pool = DriverPool(drivers, principal=self.principal)
+            pool.start()
+            client = ReportCache(pool, ttl=self.report_cache_ttl)
+        cls.clients[key] = client
+        while self.max_clients and len(cls.clients) > self.max_clients:
+            self._evict_client(next(iter(cls.clients)))
         return client
 
+    def _evict_client(self, key):
+        """Close a cached client, along with anything using it"""
+        cls = type(self)
+        self.log.info("Closing skein client for principal %s", key[0])
+        client = cls.clients.pop(key)
+        poller = cls.pollers.pop(key, None)
+        if poller is not None:
+            poller.close()
+        cls.killers.pop(key, None)
+        cls.cluster_infos.pop(key, None)
+        cls.diagnostics_collectors.pop(key, None)
+        for k in [k for k in cls.admission_controllers if k[:2] == key]:
+            del cls.admission_controllers[k]
+        for k, pool in list(cls.warm_pools.items()):
+            if pool.client is client:
+                pool.close()
+                del cls.warm_pools[k]
+        asyncio.ensure_future(client.close())
+
+    async def _get_poller(self):
+        key = (self.principal, self.keytab)
+        poller = type(self).pollers.get(key)
+        if poller is None:
+            client = await self._get_client()
+            poller = type(self).pollers.setdefault(
+                key,
+                ApplicationPoller(client,
+                                  interval=self.report_poll_interval,
+                                  min_interval=self.state_poll_interval,
+                                  log=self.log)
+            )
+        return poller
+
+    def get_env(self):
+        env = super().get_env()
+        span = getattr(self, '_trace_span', None)
+        if span is not None:
+            env[TRACE_ID_ENV] = span.trace_id
+            env[PARENT_ID_ENV] = span.span_id
+        if self.right_sizing != 'off':
+            env[USAGE_INTERVAL_ENV] = str(self.usage_sample_interval)
+        return env
+
     @property
     def singleuser_command(self):
         """The full command (with args) to launch a singleuser server"""
         return ' '.join(self.cmd + self.get_args())
 
-    def _build_specification(self):
-        script = self.script_template.format(
-            prologue=self.prologue,
-            singleuser_command=self.singleuser_command,
-            epilogue=self.epilogue
-        )
+    async def _get_cluster_info(self):
+        key = (self.principal, self.keytab)
+        info = type(self).cluster_infos.get(key)
+        if info is None:
+            client = await self._get_client()
+            info = type(self).cluster_infos.setdefault(
+                key,
+                ClusterInfo(client,
+                            queue_ttl=self.queue_info_ttl,
+                            limits_ttl=self.cluster_info_interval,
+                            snapshot_ttl=self.cluster_snapshot_ttl,
+                            conf_dir=self.hadoop_conf_dir or None,
+                            log=self.log)
+            )
+        return info
+
+    def _get_profiles(self):
+        profiles = getattr(self, '_profiles', None)
+        if profiles is None:
+            profiles = self._profiles = normalize_profiles(self.profiles)
+        return profiles
+
+    @default('options_form')
+    def _options_form_default(self):
+        if not self.profiles:
+            return ''
+        # Called with the spawner as the only argument
+        return type(self)._render_options_form
+
+    async def _render_options_form(self):
+        profiles = self._get_profiles()
+        # Profiles are described relative to the configured defaults
+        self._reset_config()
+        info = await self._get_cluster_info()
+        queues = {p.get('queue', self.queue) for p in profiles}
+        # Only the first form shown waits for a snapshot, and only briefly
+        snapshot = await info.snapshot(queues, timeout=1.0)
+        return render_form(profiles, self, snapshot,
+                           recommended=self.recommended_resources)
+
+    def _load_profile(self, slug=None):
+        """Apply a profile, by default the one chosen in ``user_options``"""
+        self._reset_config()
+        self._profile_slug = None
+        if not self.profiles:
+            return
+        if slug is None:
+            slug = (self.user_options or {}).get('profile')
+        # A list if passed through from the form unchanged
+        if isinstance(slug, list):
+            slug = slug[0] if slug else None
+        profile = find_profile(self._get_profiles(), slug)
+        apply_profile(self, profile)
+        self._profile_slug = profile['slug']
+
+    def _reset_config(self):
+        """Undo anything a previous start changed (e.g. by applying a
+        profile). Spawners are reused between starts."""
+        names = PROFILE_TRAITS + ('localize_files', 'prologue')
+        base = getattr(self, '_base_config', None)
+        if base is None:
+            base = self._base_config = {n: getattr(self, n) for n in names}
+        for name, value in base.items():
+            setattr(self, name, value)
+
+    async def _check_resources(self):
+        """Check the request fits the cluster before submitting, clamping or
+        rejecting requests that don't"""
+        info = await self._get_cluster_info()
+        try:
+            queue = await info.get_queue(self.queue)
+        except Exception as exc:
+            self.log.debug("Failed to get information for queue %s",
+                           self.queue, exc_info=exc)
+        else:
+            if str(queue.state) != 'RUNNING':
+                raise _Rejected("Queue %s is %s, and not accepting "
+                                "applications" % (self.queue, queue.state))
+
+        limits = await info.limits()
+        memory = self.mem_limit // 2**20
+        problems = []
+        if limits.max_memory is not None and memory > limits.max_memory:
+            problems.append(('mem_limit', '%d MiB' % memory,
+                             '%d MiB' % limits.max_memory))
+        if limits.max_vcores is not None and self.cpu_limit > limits.max_vcores:
+            problems.append(('cpu_limit', '%d vcores' % self.cpu_limit,
+                             '%d vcores' % limits.max_vcores))
+        if problems:
+            msg = ', '.join('%s of %s exceeds the cluster maximum of %s' % p
+                            for p in problems)
+            if self.resource_limit_policy == 'reject':
+                raise _Rejected("Requested resources are too large: %s" % msg)
+            self.log.warning("Clamping resources for user %s: %s",
+                             self.user.name, msg)
+            if limits.max_memory is not None and memory > limits.max_memory:
+                memory = limits.max_memory
+                self.mem_limit = memory * 2**20
+            if (limits.max_vcores is not None and
+                    self.cpu_limit > limits.max_vcores):
+                self.cpu_limit = limits.max_vcores
 
-        resources = skein.Resources(
-            memory='%d b' % self.mem_limit,
-            vcores=self.cpu_limit
+        rounding = limits.round_memory(memory) - memory
+        PROFILE_MEMORY_ROUNDING_BYTES.labels(self.resource_profile).set(
+            rounding * 2**20
         )
 
-        security = skein.Security.new_credentials()
+    async def _get_admission_controller(self):
+        key = (self.principal, self.keytab, self.queue)
+        controller = type(self).admission_controllers.get(key)
+        if controller is None:
+            # Shares cached queue information with the pre-submit checks
+            info = await self._get_cluster_info()
+            controller = type(self).admission_controllers.setdefault(
+                key,
+                AdmissionController(info, self.queue,
+                                    max_pending=self.admission_max_pending,
+                                    max_usage=self.admission_max_queue_usage,
+                                    ttl=self.queue_info_ttl,
+                                    log=self.log)
+            )
+        return controller
 
-        # Support dicts as well as File objects
-        files = {k: skein.File.from_dict(v) if isinstance(v, dict) else v
-                 for k, v in self.localize_files.items()}
+    async def _admit(self):
+        """Wait for room in the queue. Returns True if admission control is
+        enabled"""
+        if not self.admission_control:
+            return False
+        controller = await self._get_admission_controller()
+        self._admission_ticket = ticket = controller.enqueue()
+        if ticket.position:
+            self.log.info("Holding application for user %s, position %d in "
+                          "queue %s", self.user.name, ticket.position,
+                          self.queue)
+        await ticket.wait()
+        return True
 
-        master = skein.Master(
-            resources=resources,
-            files=files,
-            env=self.get_env(),
-            script=script,
-            security=security
+    def _release_admission(self):
+        ticket = getattr(self, '_admission_ticket', None)
+        if ticket is not None:
+            ticket.release()
+            self._admission_ticket = None
+
+    def _admission_status(self):
+        ticket = getattr(self, '_admission_ticket', None)
+        if ticket is None or not ticket.position:
+            return None
+        controller = ticket.controller
+        return {
+            'progress': 10,
+            'message': 'Waiting for room in queue %s (position %d of %d)'
+                       % (controller.queue, ticket.position, len(controller))
+        }
+
+    def _accepted_status(self):
+        # Only uses queue information already fetched by the pre-submit checks
+        # or admission control, never makes a request
+        info = type(self).cluster_infos.get((self.principal, self.keytab))
+        usage = queue_usage(info and info.cached_queue(self.queue))
+        message = 'Waiting for resources in queue %s' % self.queue
+        if usage is not None:
+            message += ' (%.0f%% used)' % usage
+        return {'progress': 40, 'message': message}
+
+    async def progress(self):
+        # Follows the events recorded by the running start, so any number of
+        # subscribers can watch without making requests
+        log = getattr(self, '_progress_log', None)
+        if log is None:
+            return
+        async for event in log.follow():
+            yield event
+
+    async def _get_diagnostics_collector(self):
+        key = (self.principal, self.keytab)
+        collector = type(self).diagnostics_collectors.get(key)
+        if collector is None:
+            client = await self._get_client()
+            collector = type(self).diagnostics_collectors.setdefault(
+                key,
+                DiagnosticsCollector(
+                    client,
+                    max_bytes=self.failure_log_bytes,
+                    max_entries=self.failure_diagnostics_max_entries,
+                    attempts=5 if self.failure_log_bytes else 0,
+                    log=self.log
+                )
+            )
+        return collector
+
+    @classmethod
+    def failure_diagnostics(cls):
+        """Diagnostics for recent start failures, most recent last"""
+        entries = [e for c in cls.diagnostics_collectors.values()
+                   for e in c.entries()]
+        return sorted(entries, key=lambda e: e.time)
+
+    async def _get_killer(self):
+        key = (self.principal, self.keytab)
+        killer = type(self).killers.get(key)
+        if killer is None:
+            client = await self._get_client()
+            poller = await self._get_poller()
+            killer = type(self).killers.setdefault(
+                key,
+                ApplicationKiller(client, poller,
+                                  limit=self.max_concurrent_kills,
+                                  check_interval=self.state_poll_interval,
+                                  log=self.log)
+            )
+        return killer
+
+    def _get_culler(self):
+        if not (self.cull_idle_timeout or self.cull_callback_timeout or
+                any(p.get('cull_idle_timeout') for p in self.profiles)):
+            return None
+        cls = type(self)
+        if cls.culler is None:
+            cls.culler = IdleCuller(interval=self.cull_interval,
+                                    concurrency=self.cull_concurrency,
+                                    kill_timeout=self.stop_timeout,
+                                    log=self.log)
+        return cls.culler
+
+    def _cull_reason(self):
+        """Why this server should be culled, as ``(reason, message)``, or
+        None if it shouldn't be"""
+        if self.app_id in ('', 'PENDING') or getattr(self, '_starting', False):
+            return None
+        poller = type(self).pollers.get((self.principal, self.keytab))
+        report = poller.get(self.app_id) if poller is not None else None
+        if report is None or str(report.state) != 'RUNNING':
+            return None
+
+        called_back = getattr(self, 'current_port', 0) or (
+            self.server is not None and
+            self.server.port)
+        if self.cull_callback_timeout and not called_back:
+            # skein reports times as naive local datetimes
+            started = report.start_time
+            running = (None if started is None else
+                       (datetime.datetime.now() - started).total_seconds())
+            if running is not None and running > self.cull_callback_timeout:
+                return ('unresponsive',
+                        "no callback from the server after %d seconds"
+                        % running)
+
+        orm_spawner = getattr(self, 'orm_spawner', None)
+        last_activity = (getattr(orm_spawner, 'last_activity', None) or
+                         getattr(self.user, 'last_activity', None))
+        idle = _age(last_activity)
+        if (self.cull_idle_timeout and idle is not None and
+                idle > self.cull_idle_timeout):
+            return ('idle', "idle for %d seconds" % idle)
+        return None
+
+    def _build_script(self, command=None, settings=None):
+        if settings is None:
+            settings = self
+        script = self.script_template.format(
+            prologue=settings.prologue,
+            singleuser_command=(self.singleuser_command if command is None
+                                else command),
+            epilogue=settings.epilogue
         )
+        if getattr(self, '_trace_span', None) is not None:
+            # Record when the script started, to time the prologue
+            script = 'export %s=$(date +%%s.%%N)\n%s' % (SCRIPT_START_ENV,
+                                                         script)
+        return script
+
+    def _get_spec_template(self, files=None, settings=None):
+        """The validated, serialized parts of the application specification
+        that don't vary between users"""
+        if settings is None:
+            settings = _SpecSettings(self, files)
+        files = settings.localize_files
+        cls = type(self)
+        key = settings.key()
+        template = cls._spec_templates.get(key)
+        if template is None:
+            resources = skein.Resources(
+                memory='%d b' % settings.mem_limit,
+                vcores=settings.cpu_limit
+            )
 
-        return skein.ApplicationSpec(
-            name='jupyterhub',
-            queue=self.queue,
-            user=self.user.name,
-            master=master
+            # Support dicts as well as File objects
+            files = {k: skein.File.from_dict(v) if isinstance(v, dict) else v
+                     for k, v in files.items()}
+
+            # The script is filled in per user, but is required for validation
+            master = skein.Master(
+                resources=resources,
+                files=files,
+                script=self.script_template
+            )
+
+            template = skein.ApplicationSpec(
+                name='jupyterhub',
+                queue=settings.queue,
+                node_label=settings.node_label,
+                master=master
+            ).to_protobuf()
+
+            if len(cls._spec_templates) >= 128:
+                cls._spec_templates.clear()
+            cls._spec_templates[key] = template
+        return template
+
+    def _build_request(self, env, script, security, user=None, files=None,
+                       settings=None):
+        """Build the serialized application specification"""
+        msg = skein.proto.ApplicationSpec()
+        msg.CopyFrom(self._get_spec_template(files, settings))
+        msg.user = self.user.name if user is None else user
+        msg.master.script = script
+        msg.master.env.update(env)
+        msg.master.security.CopyFrom(security.to_protobuf())
+        return msg
+
+    def _build_standby_request(self, security, settings):
+        env = {'YARNSPAWNER_STANDBY_TIMEOUT': str(self.warm_pool_max_idle)}
+        script = self._build_script(command='python -m yarnspawner.standby',
+                                    settings=settings)
+        return self._build_request(env, script, security,
+                                   user=self.warm_pool_user,
+                                   settings=settings)
+
+    def _warm_pool_target(self, settings):
+        size = self.warm_pool_size
+        if callable(size):
+            size = size(settings)
+        return size
+
+    async def _get_warm_pool(self):
+        if not self.warm_pool_size:
+            return None
+        cls = type(self)
+        # The pool keeps the settings it was created with, this spawner's
+        # may change with its user's profile
+        settings = _SpecSettings(self, await self._localize_files())
+        key = settings.key()
+        pool = cls.warm_pools.get(key)
+        if pool is None:
+            client = await self._get_client()
+            poller = await self._get_poller()
+            pool = cls.warm_pools.setdefault(
+                key,
+                WarmPool(client, self._get_executor(), poller,
+                         self._get_credential_pool(),
+                         build_request=functools.partial(
+                             self._build_standby_request, settings=settings),
+                         target=functools.partial(self._warm_pool_target,
+                                                  settings),
+                         max_idle=self.warm_pool_max_idle,
+                         log=self.log)
+            )
+            pool.fill()
+        return pool
+
+    async def _bind_standby(self):
+        """Assign this user to an idle application, returning its id, or None
+        if none are available"""
+        pool = await self._get_warm_pool()
+        if pool is None:
+            return None
+        standby = await pool.acquire()
+        if standby is None:
+            return None
+        try:
+            await pool.bind(standby, self.get_env(), self.singleuser_command)
+        except Exception as exc:
+            self.log.warning("Failed to bind user %s to warm pool application "
+                             "%s, submitting a new application",
+                             self.user.name, standby.app_id, exc_info=exc)
+            await pool.discard(standby)
+            return None
+        self.log.info("Bound user %s to warm pool application %s",
+                      self.user.name, standby.app_id)
+        return standby.app_id
+
+    async def _build_spec(self, files):
+        # Only the per-user parts are built here, the rest is cached. Merging
+        # and serializing happens off the event loop.
+        security = await self._get_credential_pool().get()
+        return await self._get_executor().run(
+            'spec', functools.partial(self._build_request, files=files),
+            self.get_env(), self._build_script(), security
         )
 
+    @property
+    def resource_profile(self):
+        """The slug of the chosen profile, or ``'default'`` if profiles
+        aren't configured. Used to label metrics, so never includes per-user
+        values (e.g. right-sized limits)."""
+        return getattr(self, '_profile_slug', None) or 'default'
+
+    def _state_poll_delays(self):
+        return backoff_delays(initial=self.state_poll_interval,
+                              maximum=self.state_poll_max_interval,
+                              factor=self.state_poll_backoff,
+                              jitter=self.state_poll_jitter,
+                              fast_period=self.state_poll_fast_period)
+
+    def set_port(self, port):
+        """Set the port of the singleuser server, waking up ``start``"""
+        self.current_port = port
+        fut = getattr(self, '_port_future', None)
+        if fut is not None and not fut.done():
+            fut.set_result(port)
+
+    def add_trace(self, payload):
+        """Record spans sent by the singleuser server with its port"""
+        span = getattr(self, '_trace_span', None)
+        if span is None or payload.get('trace_id') != span.trace_id:
+            return
+        for obj in payload.get('spans', ()):
+            span.tracer.export(Span.from_dict(span.tracer, obj))
+        sent = payload.get('sent')
+        if sent is not None:
+            span.child('port_post', start=sent).finish()
+
+    @property
+    def usage_history(self):
+        """The peak usage of the user's recent sessions"""
+        history = getattr(self, '_usage_history', None)
+        if history is None:
+            history = self._usage_history = UsageHistory()
+        return history
+
+    def add_usage(self, payload):
+        """Record peak usage sent by the singleuser server.
+
+        Raises ValueError if the usage is invalid."""
+        try:
+            memory = int(payload.get('memory', 0))
+            cpu = float(payload.get('cpu', 0))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("Invalid usage %r" % (payload,))
+        if memory < 0 or not 0 <= cpu < float('inf'):
+            raise ValueError("Invalid usage %r" % (payload,))
+        if not self.app_id or self.app_id == 'PENDING':
+            return
+        history = self.usage_history
+        history.record(self.app_id, memory, cpu,
+                       profile=getattr(self, '_profile_slug', None))
+        history.trim(self.right_sizing_history, self.right_sizing_max_age)
+        if payload.get('final') and self.mem_limit:
+            SESSION_PEAK_MEMORY_RATIO.labels(self.queue).observe(
+                memory / self.mem_limit
+            )
+
+    @property
+    def recommended_resources(self):
+        """Recommended ``(mem_limit, cpu_limit)`` from the user's recent
+        usage with any profile, or None if unknown"""
+        return self._recommend()
+
+    def _recommend(self, profile=None):
+        if self.right_sizing == 'off':
+            return None
+        history = self.usage_history
+        history.trim(self.right_sizing_history, self.right_sizing_max_age)
+        return history.recommend(self.right_sizing_headroom, profile=profile)
+
+    def _right_size(self):
+        """Log or apply the resources recommended from past sessions with the
+        chosen profile. A larger profile isn't sized down to usage of a
+        smaller one."""
+        recommended = self._recommend(getattr(self, '_profile_slug', None))
+        if recommended is None:
+            return
+        memory, cpu = recommended
+        if self.right_sizing == 'recommend':
+            self.log.info("Recommended resources for user %s are %d MiB and "
+                          "%d vcores, configured %d MiB and %d vcores",
+                          self.user.name, memory // 2**20, cpu,
+                          self.mem_limit // 2**20, self.cpu_limit)
+            return
+        max_memory = self.right_sizing_max_mem or self.mem_limit
+        max_cpu = self.right_sizing_max_cpu or self.cpu_limit
+        memory = min(max(memory, self.right_sizing_min_mem), max_memory)
+        cpu = min(cpu, max_cpu)
+        self.log.info("Sizing server for user %s from recent usage: %d MiB "
+                      "and %d vcores, configured %d MiB and %d vcores",
+                      self.user.name, memory // 2**20, cpu,
+                      self.mem_limit // 2**20, self.cpu_limit)
+        self.mem_limit = memory
+        self.cpu_limit = cpu
+
     def load_state(self, state):
         super().load_state(state)
         self.app_id = state.get('app_id', '')
+        self._usage_history = UsageHistory(state.get('usage'))
+        # Restore the running server's profile, for culling and metrics
+        profile = state.get('profile')
+        if profile:
+            try:
+                self._load_profile(profile)
+            except ValueError:
+                self.log.warning("Profile %r for user %s is no longer "
+                                 "configured", profile, self.user.name)
 
     def get_state(self):
         state = super().get_state()
         if self.app_id:
             state['app_id'] = self.app_id
+            profile = getattr(self, '_profile_slug', None)
+            if profile:
+                state['profile'] = profile
+        if len(self.usage_history):
+            state['usage'] = self.usage_history.to_state()
         return state
 
     def clear_state(self):
+        # Usage history outlives servers, and isn't cleared
         super().clear_state()
+        if type(self).culler is not None:
+            type(self).culler.discard(self)
+        app_id = getattr(self, 'app_id', '')
+        if app_id and app_id != 'PENDING':
+            poller = type(self).pollers.get((self.principal, self.keytab))
+            if poller is not None:
+                poller.untrack(app_id)
         self.app_id = ''
 
+    async def _start_failed(self, app_id, state):
+        SPAWN_FAILURES.labels(state.lower()).inc()
+        poller = type(self).pollers.get((self.principal, self.keytab))
+        report = poller.get(app_id) if poller is not None else None
+        collector = await self._get_diagnostics_collector()
+        entry = collector.collect(
+            app_id,
+            report.user if report is not None else self.user.name,
+            state,
+            report.diagnostics if report is not None else ''
+        )
+        await entry.wait(self.failure_log_wait)
+        self.log.warning("Application %s for user %s failed to start:\n%s",
+                         app_id, self.user.name, entry.summary())
+        return _StartFailed("%s\nCheck application logs for more information."
+                            % entry.summary())
+
     async def start(self):
-        loop = gen.IOLoop.current()
+        self._load_profile()
+        self._right_size()
+        self._progress_log = log = ProgressLog()
+        try:
+            return await self._traced_start()
+        finally:
+            log.finish()
+
+    async def _traced_start(self):
+        tracer = self._get_tracer()
+        if tracer is None:
+            self._trace_span = None
+            return await self._start()
+        self._trace_span = span = tracer.start_trace(
+            'spawn', user=self.user.name, queue=self.queue,
+            profile=self.resource_profile
+        )
+        with activate(span):
+            try:
+                return await self._start()
+            except BaseException as exc:
+                span.attributes['error'] = repr(exc)
+                raise
+            finally:
+                span.attributes['app_id'] = self.app_id
+                self._trace_span = None
+                span.finish()
 
-        spec = self._build_specification()
+    async def _start(self):
+        timer = PhaseTimer(self.queue, self.resource_profile,
+                           span=self._trace_span)
 
         client = await self._get_client()
+        # Resolved by the singleuser server calling back with its port
+        self.current_port = 0
+        self._port_future = port_future = asyncio.Future()
         # Set app_id == 'PENDING' to signal that we're starting
         self.app_id = 'PENDING'
+        self._submitted = asyncio.Event()
         try:
-            self.app_id = app_id = await loop.run_in_executor(None, client.submit, spec)
+            # Applications from the warm pool have already localized their
+            # files, so aren't recorded in the localization history
+            resources = None
+            progress = self._progress_log
+            app_id = await self._bind_standby()
+            if app_id is None:
+                await self._check_resources()
+                progress.set_status(self._admission_status)
+                if await self._admit():
+                    timer.mark('admission')
+                progress.emit(15, 'Preparing application')
+                files = await self._localize_files()
+                resources = public_resources(files)
+                spec = await self._build_spec(files)
+                timer.mark('spec')
+                app_id = await client.submit(spec)
+                progress.emit(20, 'Submitted application %s to queue %s'
+                              % (app_id, self.queue))
+            else:
+                progress.emit(20, 'Assigned pre-started application %s'
+                              % app_id)
+            self.app_id = app_id
+            timer.mark('submit')
+        except _Rejected as exc:
+            self.app_id = ''
+            SPAWN_FAILURES.labels('rejected').inc()
+            self.log.warning("Rejected application for user %s: %s",
+                             self.user.name, exc)
+            raise
+        except AdmissionCancelled:
+            # Stopped while waiting for room in the queue, not a failure
+            self.app_id = ''
+            self.log.info("Stopped waiting for room in queue %s for user %s",
+                          self.queue, self.user.name)
+            raise
         except Exception as exc:
             # We errored, no longer pending
             self.app_id = ''
+            self._release_admission()
+            SPAWN_FAILURES.labels('submit').inc()
             self.log.error(
                 "Failed to submit application for user %s. Original exception:",
                 self.user.name,
                 exc_info=exc
             )
             raise
+        finally:
+            self._submitted.set()
 
-        # Wait for application to start
+        self._starting = True
+        try:
+            out = await self._wait_for_server(app_id, port_future, timer,
+                                              resources)
+        except _StartFailed:
+            raise
+        except Exception:
+            SPAWN_FAILURES.labels('error').inc()
+            raise
+        finally:
+            self._starting = False
+            self._release_admission()
+
+        culler = self._get_culler()
+        if culler is not None:
+            culler.add(self)
+        return out
+
+    async def _wait_for_server(self, app_id, port_future, timer,
+                               resources=None):
+        loop = gen.IOLoop.current()
+        poller = await self._get_poller()
+        poller.track(app_id)
+        progress = self._progress_log
+
+        # Wait for application to start. The shared snapshot may be refreshed
+        # early on behalf of other applications, so only advance the schedule
+        # once our own deadline has passed.
+        delays = self._state_poll_delays()
+        deadline = loop.time() + next(delays)
+        last_state = None
+        accepted = False
         while True:
-            report = await loop.run_in_executor(
-                None, client.application_report, app_id
-            )
+            report = await poller.wait(app_id,
+                                       within=max(deadline - loop.time(), 0))
             state = str(report.state)
+            if state != last_state:
+                # The application moved, start polling quickly again
+                last_state = state
+                delays = self._state_poll_delays()
+                deadline = loop.time() + next(delays)
+            elif loop.time() >= deadline:
+                deadline = loop.time() + next(delays)
+
             if state in _STOPPED_STATES:
-                raise Exception("Application %s failed to start, check "
-                                "application logs for more information"
-                                % app_id)
-            elif state == 'RUNNING':
+                raise await self._start_failed(app_id, state)
+            if not accepted and state in ('ACCEPTED', 'RUNNING'):
+                accepted = True
+                timer.mark('accepted')
+                progress.set_status(self._accepted_status)
+            if state == 'RUNNING':
+                timer.mark('running')
+                self._release_admission()
                 self.current_ip = report.host
+                self._record_localization(resources, report.host)
+                progress.emit(60, 'Application %s running on host %s'
+                              % (app_id, report.host))
                 break
-            else:
-                await gen.sleep(0.5)
 
-        # Wait for port to be set
-        while getattr(self, 'current_port', 0) == 0:
-            await gen.sleep(0.5)
+        progress.emit(80, 'Waiting for server to start on host %s'
+                      % self.current_ip)
 
-            report = await loop.run_in_executor(
-                None, client.application_report, app_id
-            )
-            if str(report.state) in _STOPPED_STATES:
-                raise Exception("Application %s failed to start, check "
-                                "application logs for more information"
-                                % app_id)
+        # Wait for port to be set, periodically checking the application is
+        # still alive.
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(port_future),
+                                       self.port_check_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            report = await poller.wait(app_id, within=0)
+            state = str(report.state)
+            if state in _STOPPED_STATES:
+                raise await self._start_failed(app_id, state)
+        self._port_future = None
+        timer.mark('port')
 
         return self.current_ip, self.current_port
 
@@ -256,36 +1826,37 @@ class YarnSpawner(Spawner):
         elif self.app_id == 'PENDING':
             return None
 
-        client = await self._get_client()
-        report = await gen.IOLoop.current().run_in_executor(
-            None, client.application_report, self.app_id
-        )
+        poller = await self._get_poller()
+        report = await poller.report(self.app_id)
         status = str(report.final_status)
         if status in {'SUCCEEDED', 'KILLED'}:
             return 0
         elif status == 'FAILED':
             return 1
-        else:
-            return None
+        # Also registers servers started before the hub restarted
+        culler = self._get_culler()
+        if culler is not None:
+            culler.add(self)
+        return None
 
     async def stop(self, now=False):
-        if self.app_id == 'PENDING':
+        # Give up any place in line, so a start waiting for room stops
+        self._release_admission()
+        submitted = getattr(self, '_submitted', None)
+        if self.app_id == 'PENDING' and submitted is not None:
             # The application is in the process of being submitted. Wait for a
             # reasonable amount of time until we have an application id
-            for i in range(20):
-                if self.app_id != 'PENDING':
-                    break
-                await gen.sleep(0.1)
-            else:
-                self.log.warn("Application has been PENDING for an "
-                              "unreasonable amount of time, there's likely "
-                              "something wrong")
+            try:
+                await asyncio.wait_for(submitted.wait(), 2)
+            except asyncio.TimeoutError:
+                self.log.warning("Application has been PENDING for an "
+                                 "unreasonable amount of time, there's likely "
+                                 "something wrong")
 
         # Application not submitted, or submission errored out, nothing to do.
-        if self.app_id == '':
+        if self.app_id in ('', 'PENDING'):
             return
 
-        client = await self._get_client()
-        await gen.IOLoop.current().run_in_executor(
-            None, client.kill_application, self.app_id
-        )
+        # Applications that don't stop in time are logged in bulk by the killer
+        killer = await self._get_killer()
+        await killer.kill(self.app_id, timeout=self.stop_timeout)
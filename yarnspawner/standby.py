@@ -0,0 +1,39 @@
+import json
+import os
+import queue
+import sys
+
+import skein
+
+from yarnspawner.warmpool import ASSIGNMENT_KEY
+
+
+def wait_for_assignment(timeout=None):
+    """Wait for the hub to assign a user to this application.
+
+    Returns the assignment, or None if none arrived within ``timeout``."""
+    app = skein.ApplicationClient.from_current()
+    with app.kv.events(key=ASSIGNMENT_KEY, event_type='put') as events:
+        value = app.kv.get(ASSIGNMENT_KEY)
+        if value is None:
+            try:
+                value = events.get(timeout=timeout).result.value
+            except queue.Empty:
+                return None
+    return json.loads(value.decode())
+
+
+def main():
+    timeout = os.environ.get('YARNSPAWNER_STANDBY_TIMEOUT')
+    assignment = wait_for_assignment(float(timeout) if timeout else None)
+    if assignment is None:
+        print("No user assigned before timeout, shutting down", file=sys.stderr)
+        return
+
+    env = dict(os.environ)
+    env.update(assignment['env'])
+    os.execvpe('bash', ['bash', '-c', assignment['command']], env)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import asyncio
+import time
+
+from tornado.log import app_log
+
+from .metrics import DRIVER_RECONNECTS
+from .poller import backoff_delays
+from .tracing import detach
+
+
+class SupervisedClient(object):
+    """A client that's health checked, and reconnected if its driver fails.
+
+    The driver is periodically pinged. If it doesn't respond in time, its
+    process exits, or a request fails to reach it, a new driver is started in
+    the background (retrying with backoff). Requests made while reconnecting
+    wait for the new driver, up to ``connect_timeout``.
+
+    Supports the same interface as the wrapped clients.
+
+    Parameters
+    ----------
+    connect : callable
+        An async callable returning a newly connected client.
+    check_interval : float, optional
+        The time (in seconds) between health checks.
+    check_timeout : float, optional
+        The time (in seconds) to wait for the driver to respond to a health
+        check.
+    connect_timeout : float, optional
+        The maximum time (in seconds) requests wait for a driver.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, connect, check_interval=30, check_timeout=10,
+                 connect_timeout=120, log=None):
+        self._connect = connect
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.connect_timeout = connect_timeout
+        self.log = log or app_log
+        self._client = None
+        self._ready = asyncio.Event()
+        self._connecting = None
+        self._checking = None
+        self._closed = False
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    @property
+    def client(self):
+        """The underlying ``skein.Client`` of the current driver"""
+        if self._client is None:
+            raise ConnectionError("Not connected to a skein driver")
+        return self._client.client
+
+    def start(self):
+        """Start connecting and health checking, if not already"""
+        if self._closed:
+            raise RuntimeError("Client is closed")
+        if self._client is None and (self._connecting is None or
+                                     self._connecting.done()):
+            self._connecting = asyncio.ensure_future(self._reconnect())
+        if self._checking is None or self._checking.done():
+            self._checking = asyncio.ensure_future(self._check_loop())
+
+    async def get(self):
+        """The current client, waiting for a driver if needed"""
+        if self._client is not None:
+            return self._client
+        self.start()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready.wait()),
+                                   self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError("Timed out waiting for a skein driver")
+        return self._client
+
+    async def _reconnect(self):
+        detach()
+        delays = backoff_delays(initial=0.5, maximum=60, factor=2,
+                                jitter=0.1, fast_period=0)
+        while not self._closed:
+            start = time.monotonic()
+            try:
+                client = await self._connect()
+            except Exception as exc:
+                delay = next(delays)
+                self.log.warning("Failed to start skein driver, retrying in "
+                                 "%.1f seconds", delay, exc_info=exc)
+                await asyncio.sleep(delay)
+                continue
+            self.log.info("Started skein driver in %.1f seconds",
+                          time.monotonic() - start)
+            self._client = client
+            self._ready.set()
+            return
+
+    def _failed(self, client, reason):
+        """Replace a failed client, if it's still the current client"""
+        if client is not self._client or self._closed:
+            return
+        self.log.warning("Skein driver failed (%s), starting a new driver",
+                         reason)
+        DRIVER_RECONNECTS.inc()
+        self._client = None
+        self._ready.clear()
+        # Kill the driver first, freeing any worker threads stuck in requests
+        # to it, so closing it and starting a new one can't be blocked
+        try:
+            client.abort()
+        except Exception as exc:
+            self.log.debug("Failed to kill skein driver", exc_info=exc)
+        asyncio.ensure_future(self._close_client(client))
+        self.start()
+
+    async def _close_client(self, client):
+        try:
+            await client.close()
+        except Exception as exc:
+            self.log.debug("Failed to close skein client", exc_info=exc)
+
+    async def check(self):
+        """Check the current driver is healthy, replacing it if not.
+
+        Returns True if the driver is healthy."""
+        client = self._client
+        if client is None:
+            return False
+        try:
+            await asyncio.wait_for(client.ping(self.check_timeout),
+                                   self.check_timeout)
+        except asyncio.TimeoutError:
+            self._failed(client, "health check timed out")
+            return False
+        except Exception as exc:
+            self._failed(client, "health check failed: %s" % exc)
+            return False
+        return True
+
+    async def _check_loop(self):
+        detach()
+        while not self._closed:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def _call(self, method, *args, **kwargs):
+        client = await self.get()
+        try:
+            return await getattr(client, method)(*args, **kwargs)
+        except ConnectionError as exc:
+            # The request didn't reach the driver, retry once on a new driver
+            self._failed(client, exc)
+        client = await self.get()
+        return await getattr(client, method)(*args, **kwargs)
+
+    async def submit(self, spec):
+        return await self._call('submit', spec)
+
+    async def application_report(self, app_id):
+        return await self._call('application_report', app_id)
+
+    async def get_applications(self, **kwargs):
+        return await self._call('get_applications', **kwargs)
+
+    async def kill_application(self, app_id, user=""):
+        return await self._call('kill_application', app_id, user)
+
+    async def get_queue(self, name):
+        return await self._call('get_queue', name)
+
+    async def get_nodes(self, states=None):
+        return await self._call('get_nodes', states)
+
+    async def application_logs(self, app_id, user=""):
+        return await self._call('application_logs', app_id, user)
+
+    async def ping(self, timeout=None):
+        return await self._call('ping', timeout)
+
+    async def close(self):
+        """Stop health checks, and close the current client"""
+        self._closed = True
+        for task in (self._connecting, self._checking):
+            if task is not None:
+                task.cancel()
+        client, self._client = self._client, None
+        if client is not None:
+            await self._close_client(client)
@@ -1,14 +1,20 @@
+import asyncio
 import os
+import random
 import subprocess
 import sys
+import threading
 import time
 from contextlib import contextmanager
+from unittest.mock import Mock, patch
 
 import pytest
 import skein
+from jupyterhub.objects import Server
 from jupyterhub.tests.mocking import MockHub
 from traitlets.config import Config
 from yarnspawner import YarnSpawner
+from yarnspawner.poller import _STOPPED_STATES
 
 
 MockHub.hub_ip = "edge.example.com"
@@ -100,6 +106,28 @@ def clean_cluster(skein_client):
         ensure_no_apps(skein_client, error=True)
 
 
+class MockUser(Mock):
+    escaped_name = name = 'myname'
+    server = Server()
+
+    @property
+    def url(self):
+        return self.server.url
+
+
+def make_report(app_id, state='RUNNING', final_status='UNDEFINED',
+                host='worker.example.com', queue='default'):
+    """Create a fake ApplicationReport for use in tests"""
+    resources = skein.Resources(memory=0, vcores=0)
+    usage = skein.model.ResourceUsageReport(0, 0, 0, resources, resources, resources)
+    return skein.model.ApplicationReport(
+        id=app_id, name='jupyterhub', user='alice', queue=queue, tags=set(),
+        host=host, port=0, tracking_url='', state=state,
+        final_status=final_status, progress=0.0, usage=usage,
+        diagnostics='', start_time=None, finish_time=None
+    )
+
+
 def assert_shutdown_in(skein_client, app_id, timeout=None):
     while timeout:
         state = str(skein_client.application_report(app_id).state)
@@ -109,3 +137,264 @@ def assert_shutdown_in(skein_client, app_id, timeout=None):
         timeout -= 0.1
     else:
         assert False, "Application wasn't properly terminated"
+
+
+class FakeClient(object):
+    """An in-memory stand in for ``ThreadedClient``.
+
+    Submitted applications start in the ``ACCEPTED`` state, tests move them
+    along with ``set_state``."""
+    def __init__(self):
+        self.apps = {}
+        self.specs = {}
+        self.calls = []
+        self.queues = {}
+        self.nodes = []
+        self.logs = {}
+
+    def set_state(self, app_id, state, final_status='UNDEFINED'):
+        self.apps[app_id] = make_report(app_id, state, final_status)
+
+    async def submit(self, spec):
+        self.calls.append('submit')
+        app_id = 'application_%d' % (len(self.apps) + 1)
+        self.specs[app_id] = spec
+        self.set_state(app_id, 'ACCEPTED')
+        return app_id
+
+    async def application_report(self, app_id):
+        self.calls.append('report')
+        return self.apps[app_id]
+
+    async def get_applications(self, states=None, **kwargs):
+        self.calls.append('list')
+        return [r for r in self.apps.values()
+                if states is None or str(r.state) in states]
+
+    def set_queue(self, name, state='RUNNING', capacity=100.0,
+                  max_capacity=100.0, percent_used=0.0):
+        self.queues[name] = skein.model.Queue(name, state, float(capacity),
+                                              float(max_capacity),
+                                              float(percent_used), {'*'}, '')
+
+    async def get_queue(self, name):
+        self.calls.append('queue')
+        if name not in self.queues:
+            self.set_queue(name)
+        return self.queues[name]
+
+    async def get_nodes(self, states=None):
+        self.calls.append('nodes')
+        return list(self.nodes)
+
+    async def application_logs(self, app_id, user=''):
+        self.calls.append('logs')
+        return dict(self.logs.get(app_id, {}))
+
+    async def ping(self, timeout=None):
+        self.calls.append('ping')
+
+    def abort(self):
+        self.calls.append('abort')
+
+    async def close(self):
+        self.calls.append('close')
+
+    async def kill_application(self, app_id, user=''):
+        self.calls.append('kill')
+        if str(self.apps[app_id].state) not in _STOPPED_STATES:
+            self.set_state(app_id, 'KILLED', 'KILLED')
+
+
+class SimulatedCluster(object):
+    """A simulated YARN cluster, standing in for the blocking ``skein.Client``
+    of every driver.
+
+    Used with ``simulated_cluster``, so requests go through the same client
+    stack as against a real cluster. Requests block the calling worker thread,
+    applications are moved along on the event loop.
+
+    Parameters
+    ----------
+    latency : float, optional
+        The time (in seconds) every request takes.
+    jitter : float, optional
+        The maximum time (in seconds) randomly added to each request.
+    queue_delay : float, optional
+        The time (in seconds) applications spend ``ACCEPTED``.
+    failure_rate : float, optional
+        The fraction of applications that fail instead of running.
+    callback_delay : float, optional
+        The time (in seconds) after an application is ``RUNNING`` until
+        ``on_running`` is called with its id, i.e. until the singleuser
+        server calls back to the hub.
+    seed : int, optional
+        The seed for failures and jitter.
+    """
+    # No driver process
+    _proc = None
+
+    def __init__(self, latency=0.005, jitter=0.0, queue_delay=0.2,
+                 failure_rate=0.0, callback_delay=0.1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.queue_delay = queue_delay
+        self.failure_rate = failure_rate
+        self.callback_delay = callback_delay
+        self.random = random.Random(seed)
+        self.on_running = None
+        self.loop = asyncio.get_event_loop()
+        self.lock = threading.Lock()
+        self.apps = {}
+        # Requests made to drivers, by operation name
+        self.calls = []
+        self.drivers = 0
+
+    def connect(self, **kwargs):
+        """Start a driver"""
+        with self.lock:
+            self.drivers += 1
+        return self
+
+    def _request(self, operation):
+        self.calls.append(operation)
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _set_state(self, app_id, state, final_status='UNDEFINED'):
+        self.apps[app_id] = make_report(app_id, state, final_status)
+
+    def _launch(self, app_id):
+        with self.lock:
+            if str(self.apps[app_id].state) != 'ACCEPTED':
+                return
+            if self.random.random() < self.failure_rate:
+                self._set_state(app_id, 'FAILED', 'FAILED')
+                return
+            self._set_state(app_id, 'RUNNING')
+        if self.on_running is not None:
+            self.loop.call_later(self.callback_delay, self._callback, app_id)
+
+    def _callback(self, app_id):
+        if str(self.apps[app_id].state) == 'RUNNING':
+            self.on_running(app_id)
+
+    def _call(self, method, req, timeout=None):
+        if method == 'submit':
+            return Mock(id=self.submit(req))
+        self._request(method)
+
+    def submit(self, spec):
+        self._request('submit')
+        with self.lock:
+            app_id = 'application_%d' % (len(self.apps) + 1)
+            self._set_state(app_id, 'ACCEPTED')
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.queue_delay,
+                                       self._launch, app_id)
+        return app_id
+
+    def application_report(self, app_id):
+        self._request('report')
+        return self.apps[app_id]
+
+    def get_applications(self, states=None, **kwargs):
+        self._request('list')
+        states = None if states is None else {str(s) for s in states}
+        with self.lock:
+            return [r for r in self.apps.values()
+                    if states is None or str(r.state) in states]
+
+    def get_queue(self, name):
+        self._request('queue')
+        return skein.model.Queue(name, 'RUNNING', 100.0, 100.0, 0.0, {'*'}, '')
+
+    def get_nodes(self, states=None):
+        self._request('nodes')
+        return []
+
+    def application_logs(self, app_id, user=''):
+        self._request('logs')
+        return {}
+
+    def kill_application(self, app_id, user=''):
+        self._request('kill')
+        with self.lock:
+            if str(self.apps[app_id].state) not in _STOPPED_STATES:
+                self._set_state(app_id, 'KILLED', 'KILLED')
+
+    def close(self):
+        self.calls.append('close')
+
+
+@contextmanager
+def _fresh_state():
+    """Reset the state shared by all ``YarnSpawner`` instances, restoring it
+    on exit"""
+    caches = ['clients', 'pollers', 'killers', 'warm_pools',
+              'admission_controllers', 'cluster_infos', 'diagnostics_collectors']
+    # Shared objects using asyncio primitives bound to a single event loop
+    singletons = ['culler', 'executor', 'credential_pool']
+    saved = {k: getattr(YarnSpawner, k) for k in caches + singletons}
+    for k in caches:
+        setattr(YarnSpawner, k, {})
+    for k in singletons:
+        setattr(YarnSpawner, k, None)
+    try:
+        yield
+    finally:
+        for poller in YarnSpawner.pollers.values():
+            if poller._task is not None:
+                poller._task.cancel()
+        if YarnSpawner.culler is not None:
+            YarnSpawner.culler.close()
+        pool = YarnSpawner.credential_pool
+        if getattr(pool, '_task', None) is not None:
+            pool._task.cancel()
+        if YarnSpawner.executor is not None:
+            YarnSpawner.executor.shutdown()
+        for k, v in saved.items():
+            setattr(YarnSpawner, k, v)
+
+
+@contextmanager
+def installed_client(client):
+    """Use ``client`` for all ``YarnSpawner`` instances, with fresh shared
+    state.
+
+    ``client`` replaces the whole client stack, use ``simulated_cluster`` to
+    test the stack too."""
+    with _fresh_state():
+        YarnSpawner.clients[(None, None)] = client
+        yield client
+
+
+@contextmanager
+def simulated_cluster(cluster):
+    """Connect all ``YarnSpawner`` drivers to ``cluster``, with fresh shared
+    state.
+
+    Everything above the blocking ``skein.Client`` is real, call
+    ``close_clients`` before exiting to stop it."""
+    def start_driver(timeout=None, submit_timeout=None, **kwargs):
+        return cluster.connect(**kwargs)
+
+    with _fresh_state(), patch('yarnspawner.client._start_driver',
+                               start_driver):
+        yield cluster
+
+
+async def close_clients():
+    """Close all clients cached by ``YarnSpawner``"""
+    clients = list(YarnSpawner.clients.values())
+    YarnSpawner.clients.clear()
+    for client in clients:
+        await client.close()
+
+
+@pytest.fixture
+def fake_client():
+    """Install a ``FakeClient`` for all ``YarnSpawner`` instances"""
+    with installed_client(FakeClient()) as client:
+        yield client
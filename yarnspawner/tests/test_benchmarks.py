@@ -0,0 +1,220 @@
+"""
+Benchmarks of many users starting, polling, and stopping servers, against a
+simulated cluster. Run with ``py.test yarnspawner/tests/test_benchmarks.py``,
+requires ``pytest-benchmark``. The largest runs are marked ``slow``, skip them
+with ``-m "not slow"``.
+
+Each benchmark reports (in ``extra_info``) spawn latency percentiles, requests
+made to drivers per user, and event loop lag.
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+from unittest.mock import Mock
+
+import pytest
+import skein
+from jupyterhub.objects import Hub
+
+from yarnspawner import YarnSpawner
+from yarnspawner.apihandler import YarnSpawnerAPIHandler
+from .conftest import MockUser, SimulatedCluster, close_clients, simulated_cluster
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+requires_benchmark = pytest.mark.skipif(pytest_benchmark is None,
+                                        reason="pytest-benchmark not installed")
+
+
+class CallbackRequest(object):
+    """Stands in for the request handler, so ``YarnSpawnerAPIHandler`` can
+    handle callbacks without an HTTP server"""
+    def __init__(self, user, data):
+        self.current_user = user
+        self.body = json.dumps(data)
+        self.db = Mock()
+        self.status = None
+
+    def get_json_body(self):
+        return json.loads(self.body)
+
+    def finish(self, chunk=None):
+        pass
+
+    def set_status(self, status):
+        self.status = status
+
+
+class FixedCredentials(object):
+    """Hands out the same credentials for every application, so benchmarks
+    aren't dominated by generating them"""
+    def __init__(self):
+        self.security = skein.Security.new_credentials()
+
+    async def get(self):
+        return self.security
+
+
+class LoopLagMonitor(object):
+    """Measure how late the event loop wakes up from short sleeps"""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - start - self.interval)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'p%d' % q: values[min(len(values) * q // 100, len(values) - 1)]
+            for q in qs}
+
+
+async def simulate(cluster, users, **config):
+    """Start, poll, and stop ``users`` servers at once, returning statistics.
+
+    Servers call back with their port through ``YarnSpawnerAPIHandler``. All
+    clients are closed once done.
+    """
+    spawners = []
+    for i in range(users):
+        user = MockUser()
+        user.name = user.escaped_name = 'user%d' % i
+        spawner = YarnSpawner(hub=Hub(), user=user, **config)
+        spawner.clear_state()
+        user.spawner = spawner
+        spawners.append(spawner)
+
+    by_app = {}
+
+    def on_running(app_id):
+        if app_id not in by_app:
+            by_app.update((s.app_id, s) for s in spawners)
+        spawner = by_app[app_id]
+        YarnSpawnerAPIHandler.post(CallbackRequest(spawner.user,
+                                                   {'port': 1234}))
+
+    cluster.on_running = on_running
+    lag = LoopLagMonitor()
+    lag.start()
+
+    async def start(spawner):
+        t0 = time.perf_counter()
+        await spawner.start()
+        return time.perf_counter() - t0
+
+    try:
+        results = await asyncio.gather(*(start(s) for s in spawners),
+                                       return_exceptions=True)
+        latencies = [r for r in results if not isinstance(r, BaseException)]
+        start_calls = len(cluster.calls)
+        codes = await asyncio.gather(*(s.poll() for s in spawners))
+        await asyncio.gather(*(s.stop() for s in spawners))
+    finally:
+        lag.stop()
+        await close_clients()
+
+    calls = Counter(cluster.calls)
+    return {
+        'users': users,
+        'started': len(latencies),
+        'failed': users - len(latencies),
+        'running': sum(c is None for c in codes),
+        'spawn_latency': percentiles(latencies),
+        'rpcs_per_user': len(cluster.calls) / users,
+        'start_rpcs_per_user': start_calls / users,
+        'rpcs': {k: v / users for k, v in sorted(calls.items())},
+        'loop_lag': dict(percentiles(lag.samples),
+                         max=max(lag.samples, default=0)),
+    }
+
+
+def run_simulation(benchmark, users, config=None, credentials=None,
+                   **kwargs):
+    """Benchmark ``simulate`` on a fresh event loop. ``credentials`` are
+    generated for each application if not provided, the remaining keyword
+    arguments configure the ``SimulatedCluster``."""
+    config = dict(config or {}, failure_log_wait=0, failure_log_bytes=0)
+    stats = {}
+
+    def run():
+        async def main():
+            with simulated_cluster(SimulatedCluster(**kwargs)) as cluster:
+                if credentials is not None:
+                    YarnSpawner.credential_pool = credentials
+                stats.update(await simulate(cluster, users, **config))
+
+        asyncio.run(main())
+
+    benchmark.pedantic(run, rounds=1, iterations=1)
+    benchmark.extra_info.update(stats)
+    return stats
+
+
+@pytest.mark.asyncio
+async def test_simulate():
+    cluster = SimulatedCluster(latency=0.001, queue_delay=0.05,
+                               callback_delay=0.01, failure_rate=0.5)
+    with simulated_cluster(cluster):
+        YarnSpawner.credential_pool = FixedCredentials()
+        stats = await simulate(cluster, 10, state_poll_interval=0.01,
+                               drivers_per_principal=2,
+                               failure_log_wait=0, failure_log_bytes=0)
+    assert stats['started'] + stats['failed'] == 10
+    assert 0 < stats['started'] < 10
+    assert stats['running'] == stats['started']
+    # Requests went through the full client stack, to every driver
+    assert cluster.drivers == 2
+    assert cluster.calls.count('submit') == 10
+    assert cluster.calls.count('close') == 2
+    # All applications were stopped
+    assert all(str(r.state) in ('KILLED', 'FAILED')
+               for r in cluster.apps.values())
+    assert set(stats['spawn_latency']) == {'p50', 'p90', 'p99'}
+
+
+@pytest.fixture(scope='module')
+def credentials():
+    return FixedCredentials()
+
+
+@requires_benchmark
+@pytest.mark.parametrize('users', [10, 100, 1000,
+                                   pytest.param(5000, marks=pytest.mark.slow)])
+def test_spawn_poll_stop(benchmark, credentials, users):
+    stats = run_simulation(benchmark, users, credentials=credentials)
+    assert stats['started'] == users
+
+
+@requires_benchmark
+@pytest.mark.parametrize('users', [100, 1000])
+def test_spawn_slow_cluster(benchmark, credentials, users):
+    # Slow requests, a busy queue, and some applications failing to start
+    stats = run_simulation(benchmark, users, credentials=credentials,
+                           latency=0.05, jitter=0.05, queue_delay=2.0,
+                           failure_rate=0.05, callback_delay=1.0)
+    assert stats['started'] + stats['failed'] == users
+
+
+@requires_benchmark
+def test_spawn_generating_credentials(benchmark):
+    stats = run_simulation(benchmark, 100)
+    assert stats['started'] == 100
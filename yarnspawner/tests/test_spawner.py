@@ -1,3 +1,13 @@
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+
 import pytest
 from unittest.mock import Mock
 
@@ -5,12 +15,33 @@ from jupyterhub.tests.test_api import add_user, api_request
 from jupyterhub.tests.mocking import public_url
 from jupyterhub.tests.utils import async_requests
 from jupyterhub.utils import url_path_join
-from jupyterhub.objects import Hub, Server
+from jupyterhub.objects import Hub
 from tornado import gen
 
 import skein
 from yarnspawner import YarnSpawner
-from .conftest import clean_cluster, assert_shutdown_in
+from yarnspawner.admission import AdmissionCancelled, AdmissionController
+from yarnspawner.client import (AsyncioClient, ReportCache, SkeinExecutor,
+                                ThreadedClient)
+from yarnspawner.cluster import ClusterLimits
+from yarnspawner.diagnostics import LogTail
+from yarnspawner.environments import (EnvironmentSpec, build, config_snippet,
+                                      pack_environment, _python_versions)
+from yarnspawner.localization import LocalizationHistory, public_resources
+from yarnspawner.driverpool import DriverPool
+from yarnspawner.killer import ApplicationKiller
+from yarnspawner.poller import ApplicationPoller, backoff_delays
+from yarnspawner.profiles import normalize_profiles
+from yarnspawner.security import CredentialPool
+from yarnspawner.spawner import _SpecSettings
+from yarnspawner.supervisor import SupervisedClient
+from yarnspawner.uploads import UploadCache
+from yarnspawner.usage import (CgroupSampler, ProcessTreeSampler, UsageHistory,
+                               UsageMonitor, USAGE_INTERVAL_ENV)
+from yarnspawner.tracing import ContainerTrace, TRACE_ID_ENV, PARENT_ID_ENV
+from yarnspawner.warmpool import WarmPool
+from .conftest import (clean_cluster, assert_shutdown_in, make_report, FakeClient,
+                       MockUser)
 
 
 @pytest.mark.asyncio
@@ -62,16 +93,8 @@ def test_import_jupyter_labhub():
     import yarnspawner.jupyter_labhub  # noqa
 
 
-class MockUser(Mock):
-    escaped_name = name = 'myname'
-    server = Server()
-
-    @property
-    def url(self):
-        return self.server.url
-
-
-def test_specification():
+@pytest.mark.asyncio
+async def test_specification(fake_client):
     spawner = YarnSpawner(hub=Hub(), user=MockUser())
 
     spawner.queue = 'myqueue'
@@ -79,6 +102,7 @@ def test_specification():
     spawner.epilogue = 'Do this after'
     spawner.mem_limit = '1 G'
     spawner.cpu_limit = 2
+    spawner.node_label = 'notebooks'
     spawner.localize_files = {
         'environment': 'environment.tar.gz',
         'file2': {'source': 'path/to/file',
@@ -86,10 +110,12 @@ def test_specification():
     }
     spawner.environment = {'TEST_ENV_VAR': 'TEST_VALUE'}
 
-    spec = spawner._build_specification()
+    msg = await spawner._build_spec(spawner.localize_files)
+    spec = skein.ApplicationSpec.from_protobuf(msg)
 
     assert spec.user == 'myname'
     assert spec.queue == 'myqueue'
+    assert spec.node_label == 'notebooks'
 
     assert 'Do this first\n' in spec.master.script
     assert 'python -m yarnspawner.singleuser' in spec.master.script
@@ -103,3 +129,1290 @@ def test_specification():
 
     assert 'TEST_ENV_VAR' in spec.master.env
     assert 'JUPYTERHUB_API_TOKEN' in spec.master.env
+
+
+def test_specification_template_cache():
+    spawner = YarnSpawner(hub=Hub(), user=MockUser())
+    spawner.localize_files = {'environment': 'environment.tar.gz'}
+    template = spawner._get_spec_template()
+
+    # Same configuration, same template
+    spawner2 = YarnSpawner(hub=Hub(), user=MockUser())
+    spawner2.localize_files = {'environment': 'environment.tar.gz'}
+    assert spawner2._get_spec_template() is template
+
+    # Changing relevant configuration changes the template
+    spawner2.prologue = 'source environment/bin/activate'
+    assert spawner2._get_spec_template() is not template
+    spawner2.mem_limit = '4 G'
+    assert spawner2._get_spec_template() is not template
+
+    # Templates contain no per-user information
+    assert not template.user
+    assert not template.master.env
+    assert not template.master.HasField('security')
+
+    # Warm pools keep building applications with their original settings
+    spawner2.mem_limit = '16 G'
+    spawner2.warm_pool_size = lambda s: 3 if s.mem_limit == 16 * 2**30 else 0
+    settings = _SpecSettings(spawner2)
+    spawner2.mem_limit = '1 G'
+    spawner2.prologue = 'echo small'
+    msg = spawner2._build_standby_request(skein.Security.new_credentials(),
+                                          settings)
+    assert msg.master.resources.memory == 16 * 1024
+    assert 'echo small' not in msg.master.script
+    assert spawner2._warm_pool_target(settings) == 3
+
+
+@pytest.mark.asyncio
+async def test_application_poller():
+    reports = {'app_1': make_report('app_1', 'ACCEPTED'),
+               'app_2': make_report('app_2', 'RUNNING')}
+    client = Mock()
+    client.get_applications.side_effect = lambda **kw: list(reports.values())
+    client.application_report.return_value = make_report(
+        'app_1', 'KILLED', 'KILLED'
+    )
+
+    poller = ApplicationPoller(ThreadedClient(client, SkeinExecutor(2)),
+                               interval=0.01)
+    report1, report2 = await gen.multi([poller.report('app_1'),
+                                        poller.report('app_2')])
+    assert str(report1.state) == 'ACCEPTED'
+    assert str(report2.state) == 'RUNNING'
+    # A single listing served both applications
+    assert client.get_applications.call_count == 1
+    assert not client.application_report.called
+
+    # Stopped applications are looked up individually, once
+    del reports['app_1']
+    report = await poller.wait('app_1')
+    assert str(report.final_status) == 'KILLED'
+    await poller.wait('app_2')
+    assert client.application_report.call_count == 1
+
+    poller.untrack('app_1')
+    poller.untrack('app_2')
+    assert poller.get('app_1') is None
+
+
+def test_backoff_delays():
+    delays = backoff_delays(initial=1, maximum=8, factor=2, jitter=0,
+                            fast_period=3)
+    assert [next(delays) for i in range(7)] == [1, 1, 1, 2, 4, 8, 8]
+
+    delays = backoff_delays(initial=1, jitter=0.5)
+    assert all(0.5 <= next(delays) <= 1.5 for i in range(5))
+
+
+@pytest.mark.asyncio
+async def test_application_poller_request_refresh():
+    client = Mock()
+    client.get_applications.return_value = [make_report('app_1', 'ACCEPTED')]
+
+    poller = ApplicationPoller(ThreadedClient(client, SkeinExecutor(2)),
+                               interval=60, min_interval=0)
+    await poller.report('app_1')
+    # Requesting a refresh wakes up the poller early
+    await gen.with_timeout(gen.IOLoop.current().time() + 5,
+                           poller.wait('app_1', within=0))
+    assert client.get_applications.call_count == 2
+    poller.untrack('app_1')
+
+
+@pytest.mark.asyncio
+async def test_application_poller_track_during_refresh():
+    import threading
+
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def application_report(app_id):
+        if app_id == 'app_1':
+            fetching.set()
+            release.wait()
+            return make_report(app_id, 'FINISHED', 'SUCCEEDED')
+        return make_report(app_id, 'ACCEPTED')
+
+    client = Mock()
+    client.get_applications.return_value = []
+    client.application_report.side_effect = application_report
+
+    poller = ApplicationPoller(ThreadedClient(client, SkeinExecutor(2)),
+                               interval=60, min_interval=0)
+    first = gen.convert_yielded(poller.report('app_1'))
+    while not fetching.is_set():
+        await gen.sleep(0.01)
+    # Applications tracked, and refreshes requested, during a refresh aren't
+    # lost
+    second = gen.convert_yielded(poller.report('app_2'))
+    poller.request_refresh(0)
+    release.set()
+    report1, report2 = await gen.multi([first, second])
+    assert (report1.id, report2.id) == ('app_1', 'app_2')
+    await gen.with_timeout(gen.IOLoop.current().time() + 5,
+                           poller.wait('app_2'))
+    assert client.get_applications.call_count == 2
+    poller.close()
+
+
+@pytest.mark.asyncio
+async def test_skein_executor_limits():
+    import threading
+    import time
+
+    lock = threading.Lock()
+    running = {'submit': 0, 'kill': 0}
+    peak = dict(running)
+
+    def work(op):
+        with lock:
+            running[op] += 1
+            peak[op] = max(peak[op], running[op])
+        time.sleep(0.05)
+        with lock:
+            running[op] -= 1
+        return op
+
+    executor = SkeinExecutor(max_workers=4, limits={'submit': 2})
+    futs = [executor.run('submit', work, 'submit') for i in range(6)]
+    futs.extend(executor.run('kill', work, 'kill') for i in range(2))
+    results = await gen.multi(futs)
+
+    assert results == ['submit'] * 6 + ['kill'] * 2
+    assert peak['submit'] == 2
+    # Submits never occupied all the workers
+    assert peak['kill'] == 2
+
+    stats = executor.stats()
+    assert stats['submit']['calls'] == 6
+    assert stats['submit']['queued'] == stats['submit']['running'] == 0
+    assert stats['submit']['max_wait_time'] > 0
+
+    # Drivers can be started and health checked while every worker is busy
+    release = threading.Event()
+    blocked = [executor.run('report', release.wait) for i in range(4)]
+    assert await asyncio.wait_for(executor.run('connect', work, 'kill'),
+                                  1) == 'kill'
+    assert await asyncio.wait_for(executor.run('ping', work, 'kill'),
+                                  1) == 'kill'
+    release.set()
+    await gen.multi(blocked)
+    executor.shutdown()
+
+
+def test_driver_deadlines(monkeypatch):
+    from yarnspawner.client import _Client
+
+    calls = []
+    monkeypatch.setattr(skein.Client, '_call',
+                        lambda self, method, req, timeout=None:
+                        calls.append((method, timeout)))
+    client = _Client.__new__(_Client)
+    client.rpc_timeout = 60
+    client.submit_timeout = None
+    client._call('getStatus', None)
+    client._call('ping', None, timeout=5)
+    # Submits upload local files, they don't use the default deadline
+    client._call('submit', None)
+    assert calls == [('getStatus', 60), ('ping', 5), ('submit', None)]
+
+
+@pytest.mark.asyncio
+async def test_skein_executor_metrics():
+    import threading
+    from prometheus_client import REGISTRY
+
+    def sample(name, op):
+        return REGISTRY.get_sample_value('yarnspawner_rpc_%s' % name,
+                                         {'operation': op}) or 0
+
+    waits = sample('queue_wait_seconds_count', 'logs')
+    release = threading.Event()
+    executor = SkeinExecutor(max_workers=1)
+    calls = [gen.convert_yielded(executor.run('logs', release.wait))
+             for _ in range(3)]
+    await gen.sleep(0.05)
+    # Queue depth and running calls are exported by operation
+    assert sample('queued_requests', 'logs') == 2
+    assert sample('running_requests', 'logs') == 1
+    release.set()
+    await gen.multi(calls)
+    assert sample('queued_requests', 'logs') == 0
+    assert sample('running_requests', 'logs') == 0
+    assert sample('queue_wait_seconds_count', 'logs') == waits + 3
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_asyncio_client():
+    grpc_aio = pytest.importorskip('grpc.aio')
+    import grpc
+    from skein.proto import skein_pb2_grpc
+
+    security = skein.Security.new_credentials()
+    report = make_report('app_1', 'RUNNING')
+
+    class Driver(skein_pb2_grpc.DriverServicer):
+        async def getStatus(self, req, context):
+            if req.id != 'app_1':
+                await context.abort(grpc.StatusCode.NOT_FOUND, 'Unknown app')
+            return report.to_protobuf()
+
+        async def getApplications(self, req, context):
+            assert len(req.states) == 1
+            return skein.proto.skein_pb2.ApplicationsResponse(
+                reports=[report.to_protobuf()]
+            )
+
+        async def kill(self, req, context):
+            return skein.proto.Empty()
+
+    server = grpc_aio.server()
+    skein_pb2_grpc.add_DriverServicer_to_server(Driver(), server)
+    creds = grpc.ssl_server_credentials(
+        [(security._get_bytes('key'), security._get_bytes('cert'))],
+        root_certificates=security._get_bytes('cert'),
+        require_client_auth=True
+    )
+    port = server.add_secure_port('127.0.0.1:0', creds)
+    await server.start()
+    executor = SkeinExecutor(1)
+    try:
+        sync_client = Mock(security=security, address='127.0.0.1:%d' % port)
+        client = AsyncioClient(sync_client, executor)
+        assert await client.application_report('app_1') == report
+        assert await client.get_applications(states=['RUNNING']) == [report]
+        await client.kill_application('app_1')
+        with pytest.raises(KeyError):
+            await client.application_report('app_2')
+        # The driver is stopped in the executor's control threads
+        await client.close()
+        assert sync_client.close.called
+        assert executor.stats()['connect']['calls'] == 1
+    finally:
+        await server.stop(None)
+        executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_credential_pool():
+    executor = SkeinExecutor(2)
+    pool = CredentialPool(2, executor)
+    pool.fill()
+    await pool._task
+    assert len(pool) == 2
+
+    sec = await pool.get()
+    assert isinstance(sec, skein.Security)
+    await pool._task
+    assert len(pool) == 2
+
+    # Empty pools generate on demand
+    empty = CredentialPool(0, executor)
+    assert isinstance(await empty.get(), skein.Security)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_warm_pool():
+    apps = {}
+
+    def submit(msg):
+        app_id = 'app_%d' % (len(apps) + 1)
+        apps[app_id] = make_report(app_id, 'ACCEPTED')
+        return app_id
+
+    sync_client = Mock()
+    sync_client._call.side_effect = lambda method, msg: Mock(id=submit(msg))
+    sync_client.get_applications.side_effect = lambda **kw: list(apps.values())
+    executor = SkeinExecutor(4)
+    client = ThreadedClient(sync_client, executor)
+    poller = ApplicationPoller(client, interval=60, min_interval=0)
+    target = [2]
+    pool = WarmPool(client, executor, poller, CredentialPool(0, executor),
+                    build_request=lambda sec: skein.proto.ApplicationSpec(),
+                    target=lambda: target[0])
+
+    await pool._maintain()
+    assert len(pool) == 2
+    assert sync_client._call.call_count == 2
+
+    # Running applications are preferred
+    apps['app_2'] = make_report('app_2', 'RUNNING')
+    await poller.wait('app_2', within=0)
+    standby = await pool.acquire()
+    assert standby.app_id == 'app_2'
+    assert len(pool) == 1
+
+    # Applications that can't be bound are killed
+    await pool.discard(standby)
+    sync_client.kill_application.assert_called_once_with('app_2', '')
+    assert 'app_2' not in poller
+
+    # Stopped applications are dropped, and the pool scales down
+    apps['app_1'] = make_report('app_1', 'FAILED', 'FAILED')
+    await poller.wait('app_1', within=0)
+    target[0] = 0
+    await pool._maintain()
+    assert len(pool) == 0
+    assert await pool.acquire() is None
+    pool._task.cancel()
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_application_killer():
+    apps = {'app_%d' % i: make_report('app_%d' % i, 'RUNNING')
+            for i in range(6)}
+    # This application ignores kill requests
+    stubborn = 'app_0'
+
+    def kill_application(app_id, user=''):
+        if app_id != stubborn:
+            apps[app_id] = make_report(app_id, 'KILLED', 'KILLED')
+
+    sync_client = Mock()
+    sync_client.get_applications.side_effect = lambda **kw: list(apps.values())
+    sync_client.kill_application.side_effect = kill_application
+    executor = SkeinExecutor(4)
+    client = ThreadedClient(sync_client, executor)
+    poller = ApplicationPoller(client, interval=60, min_interval=0)
+    killer = ApplicationKiller(client, poller, limit=2, check_interval=0.01)
+
+    alive = await killer.kill_all(list(apps), timeout=0.5)
+    assert alive == [stubborn]
+    assert sync_client.kill_application.call_count == 6
+    # Already stopped applications aren't killed again
+    assert await killer.kill('app_1')
+    assert sync_client.kill_application.call_count == 6
+    for app_id in apps:
+        poller.untrack(app_id)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_start_poll_stop(fake_client):
+    from prometheus_client import REGISTRY
+
+    def failures(cause):
+        return REGISTRY.get_sample_value('yarnspawner_spawn_failures_total',
+                                         {'cause': cause}) or 0
+
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(),
+                          state_poll_interval=0.01, port_check_interval=0.01)
+    spawner.clear_state()
+    assert await spawner.poll() == 0
+
+    async def run_application():
+        while 'application_1' not in fake_client.apps:
+            await gen.sleep(0.01)
+        fake_client.set_state('application_1', 'RUNNING')
+        await gen.sleep(0.05)
+        spawner.set_port(1234)
+
+    running = gen.convert_yielded(run_application())
+    ip, port = await spawner.start()
+    await running
+    assert (ip, port) == ('worker.example.com', 1234)
+    assert spawner.app_id == 'application_1'
+    assert await spawner.poll() is None
+
+    labels = {'phase': 'port', 'queue': 'default',
+              'profile': spawner.resource_profile}
+    assert REGISTRY.get_sample_value(
+        'yarnspawner_spawn_phase_duration_seconds_count', labels
+    ) >= 1
+
+    spawner.stop_timeout = 5
+    await spawner.stop()
+    assert await spawner.poll() == 0
+    spawner.clear_state()
+
+    # Applications failing during startup are reported
+    before = failures('failed')
+
+    async def fail_application():
+        while 'application_2' not in fake_client.apps:
+            await gen.sleep(0.01)
+        fake_client.set_state('application_2', 'FAILED', 'FAILED')
+
+    failing = gen.convert_yielded(fail_application())
+    with pytest.raises(Exception, match='failed to start'):
+        await spawner.start()
+    await failing
+    assert failures('failed') == before + 1
+
+
+@pytest.mark.asyncio
+async def test_progress(fake_client):
+    fake_client.set_queue('default', capacity=50, max_capacity=100,
+                          percent_used=50)
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(),
+                          state_poll_interval=0.01, port_check_interval=0.01)
+    spawner.clear_state()
+
+    async def subscribe():
+        while getattr(spawner, '_progress_log', None) is None:
+            await gen.sleep(0.01)
+        return [e['message'] async for e in spawner.progress()]
+
+    async def run_application():
+        while 'application_1' not in fake_client.apps:
+            await gen.sleep(0.01)
+        await gen.sleep(0.05)
+        fake_client.set_state('application_1', 'RUNNING')
+        await gen.sleep(0.05)
+        spawner.set_port(1234)
+
+    subscribers = [gen.convert_yielded(subscribe()) for _ in range(3)]
+    running = gen.convert_yielded(run_application())
+    await spawner.start()
+    await running
+    events = [await s for s in subscribers]
+
+    assert events[0] == [
+        'Preparing application',
+        'Submitted application application_1 to queue default',
+        'Waiting for resources in queue default (25% used)',
+        'Application application_1 running on host worker.example.com',
+        'Waiting for server to start on host worker.example.com'
+    ]
+    assert events[1] == events[2] == events[0]
+    # Subscribers only use queue information fetched by the start itself
+    assert fake_client.calls.count('queue') == 1
+
+    # Late subscribers see the recorded events, and finish immediately
+    late = [e['message'] async for e in spawner.progress()]
+    assert late == [m for m in events[0] if not m.startswith('Waiting for res')]
+
+    spawner.stop_timeout = 5
+    await spawner.stop()
+    spawner.clear_state()
+
+
+@pytest.mark.asyncio
+async def test_spawn_tracing(fake_client, tmpdir):
+    trace_file = str(tmpdir.join('traces.jsonl'))
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), trace_file=trace_file,
+                          state_poll_interval=0.01, port_check_interval=0.01)
+    spawner.clear_state()
+
+    async def run_application():
+        while 'application_1' not in fake_client.apps:
+            await gen.sleep(0.01)
+        # The trace is forwarded to the container through its environment
+        spec = fake_client.specs['application_1']
+        env = dict(spec.master.env)
+        script = spec.master.script
+        assert 'YARNSPAWNER_SCRIPT_START' in script
+        fake_client.set_state('application_1', 'RUNNING')
+
+        trace = ContainerTrace(env)
+        assert trace.enabled
+        trace.mark('initialize')
+        spawner.add_trace(trace.to_json())
+        spawner.set_port(1234)
+        return env
+
+    running = gen.convert_yielded(run_application())
+    await spawner.start()
+    env = await running
+
+    # Spans are written in the background
+    YarnSpawner.tracer.exporter.flush()
+    with open(trace_file) as f:
+        spans = [json.loads(line) for line in f]
+    root = [s for s in spans if s['name'] == 'spawn']
+    assert len(root) == 1
+    root = root[0]
+    assert root['trace_id'] == env[TRACE_ID_ENV]
+    assert root['span_id'] == env[PARENT_ID_ENV]
+    assert root['attributes']['app_id'] == 'application_1'
+
+    assert all(s['trace_id'] == root['trace_id'] for s in spans)
+    names = {s['name'] for s in spans}
+    assert {'spec', 'submit', 'running', 'port',
+            'initialize', 'port_post'}.issubset(names)
+    assert {s['service'] for s in spans} == {'hub', 'singleuser'}
+
+    # Tracing is off without a trace file
+    assert 'YARNSPAWNER_TRACE_ID' not in spawner.get_env()
+
+
+class LocalFS(object):
+    """Filesystem operations on the local filesystem, for testing"""
+    def __init__(self):
+        self.puts = []
+
+    def exists(self, path):
+        return os.path.exists(path[len('file://'):])
+
+    def mkdir(self, path):
+        os.makedirs(path[len('file://'):], exist_ok=True)
+
+    def put(self, local, path):
+        self.puts.append(path)
+        shutil.copy(local, path[len('file://'):])
+
+    def chmod(self, mode, path, recursive=False):
+        pass
+
+    def listdir(self, path):
+        path = path[len('file://'):]
+        return [(os.path.join(path, p), os.stat(os.path.join(path, p)).st_mtime)
+                for p in os.listdir(path)]
+
+    def remove(self, path):
+        shutil.rmtree(path[len('file://'):])
+
+
+@pytest.mark.asyncio
+async def test_upload_cache(tmpdir):
+    env = tmpdir.join('environment.tar.gz')
+    env.write('version 1')
+    cache_dir = 'file://' + str(tmpdir.join('cache'))
+    fs = LocalFS()
+    cache = UploadCache(cache_dir, SkeinExecutor(max_workers=2), fs=fs,
+                        public=True)
+    config = tmpdir.join('config.json')
+    config.write('{}')
+
+    files = {'environment': str(env),
+             'private': {'source': str(env), 'visibility': 'private'},
+             'application': {'source': str(env),
+                             'visibility': 'application'},
+             'config': str(config),
+             'remote': 'hdfs:///path/to/file.zip'}
+    res = await asyncio.gather(cache.resolve(files), cache.resolve(files))
+    assert res[0] == res[1]
+    resolved = res[0]
+
+    # Local files are uploaded once, to a content addressed path
+    assert len(fs.puts) == 2
+    path = resolved['environment'].source
+    assert path.startswith(cache_dir)
+    assert path.endswith('/environment.tar.gz')
+    with open(path[len('file://'):]) as f:
+        assert f.read() == 'version 1'
+    assert resolved['environment'].type == 'archive'
+    assert resolved['environment'].visibility == 'public'
+    assert resolved['private'].source == path
+    assert resolved['private'].visibility == 'private'
+    # Only archives without a configured visibility are made public
+    assert resolved['application'].visibility == 'application'
+    assert resolved['config'].type == 'file'
+    assert resolved['config'].visibility == 'application'
+    # Remote files are unchanged
+    assert resolved['remote'].source == 'hdfs:///path/to/file.zip'
+
+    # Changing the file uploads a new version
+    env.write('version 2, changed')
+    resolved2 = await cache.resolve(files)
+    assert len(fs.puts) == 3
+    assert resolved2['environment'].source != path
+
+    # Unused versions are removed
+    assert await cache.collect() == []
+    cache.max_age = -1
+    assert len(await cache.collect()) == 3
+    assert os.listdir(str(tmpdir.join('cache'))) == []
+
+
+def test_environment_build(tmpdir):
+    tmpdir.join('env.lock').write('@EXPLICIT\nhttps://example.com/python.conda\n')
+    tmpdir.join('env.yaml').write('name: analytics\n'
+                                  'lockfile: env.lock\n'
+                                  'compress_level: 1\n'
+                                  'publish: file://%s/published\n' % tmpdir)
+    spec = EnvironmentSpec.from_file(str(tmpdir.join('env.yaml')))
+    assert spec.kind == 'conda'
+    assert spec.lockfile == str(tmpdir.join('env.lock'))
+
+    # Archives are named by a hash of the lockfile and build options
+    name = spec.archive_name
+    assert name.startswith('analytics-') and name.endswith('.tar.gz')
+    assert EnvironmentSpec.from_file(str(tmpdir.join('env.yaml'))).archive_name == name
+    spec.compress_level = 9
+    assert spec.archive_name != name
+    spec.compress_level = 1
+
+    with pytest.raises(ValueError):
+        EnvironmentSpec('bad', 'env.lock', kind='pip')
+
+    # Already published environments aren't rebuilt
+    fs = LocalFS()
+    published = spec.publish + '/' + name
+    os.makedirs(str(tmpdir.join('published')))
+    tmpdir.join('published', name).write('archive')
+    assert build(spec, output_dir=str(tmpdir), fs=fs, log=lambda m: None) == published
+
+    # Built, but not published, archives are published
+    spec.compress_level = 2
+    tmpdir.join(spec.archive_name).write('archive')
+    path = build(spec, output_dir=str(tmpdir), fs=fs, log=lambda m: None)
+    assert path == spec.publish + '/' + spec.archive_name
+    assert fs.puts == [path]
+
+    snippet = config_snippet(spec, path)
+    compile(snippet, 'jupyterhub_config.py', 'exec')
+    assert "'source': %r" % path in snippet
+    assert "source analytics/bin/activate" in snippet
+
+
+def test_environment_venv_hash(tmpdir, monkeypatch):
+    tmpdir.join('requirements.txt').write('requests==2.22.0\n')
+    spec = EnvironmentSpec('web', str(tmpdir.join('requirements.txt')),
+                           kind='venv', python=sys.executable)
+    name = spec.archive_name
+
+    # Upgrading the interpreter in place changes the archive, even though
+    # its path is the same
+    monkeypatch.setitem(_python_versions, sys.executable,
+                        '3.99.0 (main)')
+    assert spec.archive_name != name
+
+
+def test_pack_venv(tmpdir):
+    pytest.importorskip('venv_pack')
+    prefix = str(tmpdir.join('env'))
+    subprocess.run([sys.executable, '-m', 'venv', '--without-pip', prefix],
+                   check=True)
+    site = os.path.join(prefix, 'lib', 'python%d.%d' % sys.version_info[:2],
+                        'site-packages')
+    for name in ['zz.py', 'aa.py', 'lib.a', 'skip.txt']:
+        with open(os.path.join(site, name), 'w') as f:
+            f.write(name)
+
+    spec = EnvironmentSpec('env', 'requirements.txt', kind='venv',
+                           compress_level=1, exclude=['*/skip.txt'])
+    output = str(tmpdir.join('env.tar.gz'))
+    pack_environment(spec, prefix, output)
+
+    with tarfile.open(output) as tf:
+        names = tf.getnames()
+    packed = [os.path.basename(n) for n in names if '/site-packages/' in n]
+    assert packed == ['aa.py', 'zz.py']
+    # Environment files are written in sorted order, followed by venv-pack's
+    # rewritten activation scripts
+    files = names[:names.index('pyvenv.cfg') + 1]
+    assert files == sorted(files)
+
+
+def test_pack_conda(tmpdir):
+    pytest.importorskip('conda_pack')
+    # A minimal conda environment with a single package, linked from a
+    # package cache
+    pkgs = tmpdir.join('pkgs', 'pkg-1.0-0')
+    prefix = tmpdir.join('env')
+    files = ['lib/data.txt', 'lib/libpkg.a']
+    for root in [pkgs, prefix]:
+        for name in files:
+            root.join(name).write(name, ensure=True)
+    pkgs.join('info', 'files').write('\n'.join(files), ensure=True)
+    prefix.join('conda-meta', 'history').write('', ensure=True)
+    prefix.join('conda-meta', 'pkg-1.0-0.json').write(json.dumps({
+        'name': 'pkg', 'version': '1.0', 'build': '0', 'build_number': 0,
+        'channel': 'https://example.com', 'url': 'https://example.com/pkg.tar.bz2',
+        'files': files, 'link': {'source': str(pkgs), 'type': 1}}))
+
+    spec = EnvironmentSpec('env', 'env.lock', compress_level=1)
+    output = str(tmpdir.join('env.tar.gz'))
+    pack_environment(spec, str(prefix), output)
+
+    with tarfile.open(output) as tf:
+        names = tf.getnames()
+    assert 'lib/data.txt' in names
+    assert 'lib/libpkg.a' not in names
+
+
+def test_localization_history():
+    files = {'env': {'source': 'hdfs:///envs/env.tar.gz',
+                     'visibility': 'public'},
+             'data': 'hdfs:///data/file.txt'}
+    resources = public_resources(files)
+    # Only public resources are shared between applications
+    assert resources == {('hdfs:///envs/env.tar.gz', 0, 0)}
+    assert public_resources({'data': 'hdfs:///data/file.txt'}) == set()
+
+    history = LocalizationHistory(max_entries=2)
+    assert history.nodes(resources) == set()
+    history.record(resources, 'worker1')
+    history.record(resources, 'worker2')
+    assert history.nodes(resources) == {'worker1', 'worker2'}
+
+    # Old entries expire
+    history.max_age = -1
+    assert history.nodes(resources) == set()
+
+    # Least recently used resources are forgotten
+    history.max_age = 3600
+    for i in range(3):
+        history.record(frozenset([('hdfs:///env%d' % i, 0, 0)]), 'worker1')
+    assert history.nodes(frozenset([('hdfs:///env0', 0, 0)])) == set()
+    assert history.nodes(frozenset([('hdfs:///env2', 0, 0)])) == {'worker1'}
+
+
+@pytest.mark.asyncio
+async def test_report_cache(fake_client):
+    cache = ReportCache(fake_client, ttl=60)
+    app_id = await cache.submit(None)
+
+    # Concurrent requests share a single request
+    reports = await asyncio.gather(*(cache.application_report(app_id)
+                                     for _ in range(5)))
+    assert fake_client.calls.count('report') == 1
+    assert all(r.id == app_id for r in reports)
+
+    # Cached within the ttl
+    fake_client.set_state(app_id, 'RUNNING')
+    report = await cache.application_report(app_id)
+    assert str(report.state) == 'ACCEPTED'
+    assert fake_client.calls.count('report') == 1
+
+    # Listings aren't cached
+    await cache.get_applications()
+    assert len(cache._reports) == 1
+
+    # Killing an application invalidates its report
+    await cache.kill_application(app_id)
+    report = await cache.application_report(app_id)
+    assert str(report.state) == 'KILLED'
+    assert fake_client.calls.count('report') == 2
+
+    # Expired reports are refreshed
+    cache.ttl = 0
+    await gen.sleep(0.01)
+    await cache.application_report(app_id)
+    assert fake_client.calls.count('report') == 3
+
+    # The oldest reports are dropped beyond max_size
+    cache = ReportCache(fake_client, ttl=60, max_size=2)
+    app_ids = [await fake_client.submit(None) for _ in range(3)]
+    for i in app_ids:
+        await cache.application_report(i)
+    assert list(cache._reports) == app_ids[1:]
+
+
+@pytest.mark.asyncio
+async def test_supervised_client():
+    drivers = []
+
+    async def connect():
+        if len(drivers) == 1:
+            # Fail to start the second driver once, to exercise retries
+            drivers.append(None)
+            raise ValueError("Failed to start")
+        drivers.append(FakeClient())
+        return drivers[-1]
+
+    client = SupervisedClient(connect, check_interval=3600, check_timeout=0.1,
+                              connect_timeout=5)
+    app_id = await client.submit(None)
+    assert drivers[0].calls == ['submit']
+    assert await client.check()
+
+    # A hung driver is replaced, requests wait for the new driver
+    async def hang(timeout=None):
+        await gen.sleep(10)
+
+    drivers[0].ping = hang
+    assert not await client.check()
+    assert not client.connected
+    with pytest.raises(KeyError):
+        await client.application_report(app_id)
+    assert len(drivers) == 3
+    assert drivers[0].calls[-2:] == ['abort', 'close']
+
+    # Requests that fail to reach the driver are retried on a new driver
+    async def unavailable(app_id):
+        raise ConnectionError("Unable to connect to driver")
+
+    drivers[2].application_report = unavailable
+    await client.submit(None)
+    with pytest.raises(KeyError):
+        await client.application_report(app_id)
+    assert len(drivers) == 4
+
+    await client.close()
+    assert 'close' in drivers[3].calls
+
+
+@pytest.mark.asyncio
+async def test_supervised_client_busy():
+    import threading
+
+    release = threading.Event()
+    skein_client = Mock(_proc=None)
+    skein_client.submit.side_effect = lambda spec: release.wait()
+    executor = SkeinExecutor(max_workers=4)
+
+    async def connect():
+        return ThreadedClient(skein_client, executor)
+
+    client = SupervisedClient(connect, check_interval=3600, check_timeout=0.2,
+                              connect_timeout=5)
+    # A healthy driver stays healthy while slow requests hold every worker
+    submits = [gen.convert_yielded(client.submit(None)) for _ in range(4)]
+    await gen.sleep(0.05)
+    try:
+        assert await client.check()
+        assert client.connected
+    finally:
+        release.set()
+    await gen.multi(submits)
+    await client.close()
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_driver_pool():
+    drivers = [FakeClient() for _ in range(3)]
+    pool = DriverPool(drivers, principal='test')
+
+    # Submissions go to the least loaded driver
+    app_ids = [await pool.submit(None) for _ in range(3)]
+    assert [d.calls for d in drivers] == [['submit']] * 3
+
+    # Requests for an application always go to the same driver
+    for app_id in app_ids:
+        index = pool._shard(app_id)
+        drivers[index].set_state(app_id, 'RUNNING')
+        for _ in range(2):
+            report = await pool.application_report(app_id)
+            assert str(report.state) == 'RUNNING'
+        assert drivers[index].calls.count('report') >= 2
+
+    stats = pool.stats()
+    assert [s[0] for s in stats] == [0, 0, 0]
+    assert sum(s[1] for s in stats) == 9
+
+
+@pytest.mark.asyncio
+async def test_evict_client(fake_client):
+    spawner = YarnSpawner(hub=Hub(), user=MockUser())
+    await spawner._get_poller()
+    await spawner._get_killer()
+    await spawner._get_admission_controller()
+    await spawner._get_diagnostics_collector()
+    pool = WarmPool(fake_client, None, None, None, None, lambda: 0)
+    pool._task = asyncio.ensure_future(gen.sleep(60))
+    YarnSpawner.warm_pools['key'] = pool
+
+    # Everything using the client is dropped along with it
+    spawner._evict_client((None, None))
+    caches = ['clients', 'pollers', 'killers', 'admission_controllers',
+              'cluster_infos', 'diagnostics_collectors', 'warm_pools']
+    assert all(not getattr(YarnSpawner, k) for k in caches)
+    await gen.sleep(0)
+    assert pool._task.cancelled()
+    assert 'close' in fake_client.calls
+
+
+@pytest.mark.asyncio
+async def test_admission_controller(fake_client):
+    fake_client.set_queue('default', capacity=50, max_capacity=100,
+                          percent_used=100)
+    controller = AdmissionController(fake_client, 'default', max_pending=2,
+                                     max_usage=90, ttl=0.05)
+
+    # Admitted in order, up to max_pending
+    tickets = [controller.enqueue() for _ in range(4)]
+    await gen.sleep(0.01)
+    assert controller.usage == 50
+    assert [t.position for t in tickets] == [0, 0, 1, 2]
+    assert controller.pending == 2
+
+    # Releasing an admitted ticket admits the next in line
+    tickets[0].release()
+    await tickets[2].wait()
+    assert [t.position for t in tickets[2:]] == [0, 1]
+
+    # Held while the queue is too full
+    fake_client.set_queue('default', capacity=50, max_capacity=100,
+                          percent_used=190)
+    await gen.sleep(0.1)
+    tickets[1].release()
+    await gen.sleep(0.1)
+    assert tickets[3].position == 1
+
+    # Giving up a place in line fails the waiter
+    waiter = gen.convert_yielded(tickets[3].wait())
+    tickets[3].release()
+    with pytest.raises(RuntimeError):
+        await waiter
+    assert len(controller) == 0
+
+    fake_client.set_queue('default', percent_used=0)
+    tickets[2].release()
+    ticket = await asyncio.wait_for(controller.admit(), 1)
+    assert ticket.admitted
+
+
+@pytest.mark.asyncio
+async def test_stop_waiting_for_admission(fake_client, caplog):
+    from prometheus_client import REGISTRY
+
+    def failures(cause):
+        return REGISTRY.get_sample_value('yarnspawner_spawn_failures_total',
+                                         {'cause': cause}) or 0
+
+    fake_client.set_queue('default', capacity=50, max_capacity=100,
+                          percent_used=200)
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), admission_control=True,
+                          admission_max_queue_usage=90)
+    spawner.clear_state()
+    before = {c: failures(c) for c in ('submit', 'error')}
+
+    starting = gen.convert_yielded(spawner.start())
+    while spawner._admission_status() is None:
+        await gen.sleep(0.01)
+    await spawner.stop()
+
+    # Stopping gives up the place in line, without counting as a failure
+    with pytest.raises(AdmissionCancelled):
+        await starting
+    assert spawner.app_id == ''
+    assert 'submit' not in fake_client.calls
+    assert {c: failures(c) for c in before} == before
+    assert not [r for r in caplog.records if r.levelname == 'ERROR']
+
+
+@pytest.mark.asyncio
+async def test_resource_limits(fake_client, tmpdir):
+    from prometheus_client import REGISTRY
+
+    tmpdir.join('yarn-site.xml').write(
+        '<configuration>'
+        '<property><name>yarn.scheduler.maximum-allocation-mb</name>'
+        '<value>4096</value></property>'
+        '<property><name>yarn.scheduler.minimum-allocation-mb</name>'
+        '<value>512</value></property>'
+        '</configuration>'
+    )
+    fake_client.nodes = [
+        skein.model.NodeReport('node-%d' % i, 'node-%d:8042' % i, '/default',
+                               set(), 'RUNNING', '',
+                               skein.Resources(memory, 8),
+                               skein.Resources(0, 0))
+        for i, memory in enumerate([2048, 3072])
+    ]
+
+    def make_spawner(**kwargs):
+        spawner = YarnSpawner(hub=Hub(), user=MockUser(),
+                              hadoop_conf_dir=str(tmpdir), **kwargs)
+        spawner.clear_state()
+        return spawner
+
+    # Limited by the largest node, and only by properties that are set
+    limits = await make_spawner()._get_cluster_info()
+    limits = await limits.limits()
+    assert (limits.max_memory, limits.max_vcores) == (3072, 8)
+    assert limits.round_memory(1000) == 1024
+
+    # Client-only configurations don't impose YARN's default limits
+    limits = ClusterLimits.from_yarn_site({'yarn.resourcemanager.address':
+                                           'rm.example.com:8032'})
+    assert (limits.max_memory, limits.max_vcores, limits.min_memory) == (
+        None, None, None)
+    assert limits.round_memory(1000) == 1000
+
+    # Too large requests are rejected before submitting
+    before = REGISTRY.get_sample_value('yarnspawner_spawn_failures_total',
+                                       {'cause': 'rejected'}) or 0
+    spawner = make_spawner(mem_limit='4 G', cpu_limit=2)
+    with pytest.raises(Exception, match='mem_limit of 4096 MiB exceeds'):
+        await spawner.start()
+    assert not fake_client.specs
+    assert spawner.app_id == ''
+    assert REGISTRY.get_sample_value('yarnspawner_spawn_failures_total',
+                                     {'cause': 'rejected'}) == before + 1
+
+    # Or clamped, with memory lost to rounding reported
+    spawner = make_spawner(mem_limit='4 G', cpu_limit=10,
+                           resource_limit_policy='clamp')
+    await spawner._check_resources()
+    assert (spawner.mem_limit, spawner.cpu_limit) == (3072 * 2**20, 8)
+
+    spawner = make_spawner(mem_limit='1000 M')
+    await spawner._check_resources()
+    assert REGISTRY.get_sample_value(
+        'yarnspawner_profile_memory_rounding_bytes',
+        {'profile': spawner.resource_profile}
+    ) == 24 * 2**20
+
+    # Stopped queues are rejected
+    fake_client.set_queue('closed', state='STOPPED')
+    with pytest.raises(Exception, match='Queue closed is STOPPED'):
+        await make_spawner(queue='closed')._check_resources()
+
+
+@pytest.mark.asyncio
+async def test_profiles(fake_client, tmpdir):
+    fake_client.nodes = [
+        skein.model.NodeReport('node-%d' % i, 'node-%d:8042' % i, '/default',
+                               set(), 'RUNNING', '',
+                               skein.Resources(8192, 8),
+                               skein.Resources(used, 1))
+        for i, used in enumerate([0, 6144])
+    ]
+    fake_client.set_queue('large', capacity=50, max_capacity=50,
+                          percent_used=50)
+    profiles = [
+        {'display_name': 'Small', 'mem_limit': '1 G'},
+        {'display_name': 'Large <ML>', 'mem_limit': '4 G', 'cpu_limit': 2,
+         'queue': 'large', 'environment': 'hdfs:///envs/ml.tar.gz',
+         'description': 'For model training', 'cull_idle_timeout': 0},
+    ]
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), profiles=profiles,
+                          hadoop_conf_dir=str(tmpdir), prologue='echo hi',
+                          cull_idle_timeout=3600)
+    spawner.clear_state()
+
+    form = await spawner.get_options_form()
+    assert 'value="small" checked' in form
+    assert 'Large &lt;ML&gt;' in form
+    assert '4096 MiB, 2 vcores, queue large' in form
+    # Free resources on both nodes, or a quarter of the cluster for the queue
+    assert 'Room for about 9 more' in form
+    assert 'Room for about 1 more' in form
+
+    # The snapshot is reused, without waiting on requests
+    fake_client.calls.clear()
+    await spawner.get_options_form()
+    assert 'nodes' not in fake_client.calls
+
+    spawner.user_options = {'profile': ['large-ml']}
+    spawner._load_profile()
+    assert (spawner.queue, spawner.mem_limit, spawner.cpu_limit) == (
+        'large', 4 * 2**30, 2
+    )
+    assert spawner.localize_files['environment']['source'] == \
+        'hdfs:///envs/ml.tar.gz'
+    assert spawner.prologue == 'source environment/bin/activate\necho hi'
+    # Metrics are labeled by the profile, not the resources requested
+    spawner.mem_limit = '5 G'
+    assert spawner.resource_profile == 'large-ml'
+
+    # A running server's profile is restored with its state, e.g. after the
+    # hub restarts
+    spawner.app_id = 'application_1'
+    state = spawner.get_state()
+    spawner.app_id = ''
+    restored = YarnSpawner(hub=Hub(), user=MockUser(), profiles=profiles,
+                           cull_idle_timeout=3600)
+    restored.load_state(state)
+    assert restored.resource_profile == 'large-ml'
+    assert (restored.queue, restored.cull_idle_timeout) == ('large', 0)
+    restored.load_state(dict(state, profile='removed'))
+    assert restored.resource_profile == 'default'
+
+    # Switching profiles undoes the previous one
+    spawner.user_options = {}
+    spawner._load_profile()
+    assert (spawner.queue, spawner.mem_limit, spawner.cpu_limit) == (
+        'default', 2**30, 1
+    )
+    assert spawner.localize_files == {}
+    assert spawner.prologue == 'echo hi'
+
+    spawner.user_options = {'profile': 'missing'}
+    with pytest.raises(ValueError, match='Unknown profile'):
+        spawner._load_profile()
+
+    with pytest.raises(ValueError, match='Unknown profile keys'):
+        normalize_profiles([{'display_name': 'x', 'memory': 1}])
+
+
+def test_usage_monitor(tmpdir):
+    # A cgroup v2 container
+    cgroup = tmpdir.mkdir('cgroup').mkdir('container_1')
+    cgroup.join('memory.current').write('%d\n' % (300 * 2**20))
+    cgroup.join('memory.stat').write('anon 1\ninactive_file %d\n' % 2**20)
+    cgroup.join('cpu.stat').write('usage_usec 1000000\nuser_usec 1\n')
+    proc_cgroup = tmpdir.join('proc_cgroup')
+    proc_cgroup.write('0::/container_1\n')
+    sampler = CgroupSampler.detect(str(proc_cgroup), str(tmpdir.join('cgroup')))
+    assert sampler.sample() == (299 * 2**20, 1.0)
+
+    # Not in a container cgroup
+    proc_cgroup.write('0::/user.slice\n')
+    assert CgroupSampler.detect(str(proc_cgroup)) is None
+    assert UsageMonitor.from_environ({}) == (None, 0)
+
+    memory, cpu = ProcessTreeSampler().sample()
+    assert memory > 0
+
+    posted = []
+    monitor = UsageMonitor(sampler)
+    monitor._post = posted.append
+    monitor.sample()
+    monitor.report()
+    monitor.report()
+    cgroup.join('memory.current').write('%d\n' % (100 * 2**20))
+    monitor.sample()
+    monitor.report(final=True)
+    assert [p['usage']['final'] for p in posted] == [False, True]
+    assert posted[-1]['usage']['memory'] == 299 * 2**20
+
+
+def test_right_sizing():
+    history = UsageHistory([['application_1', 100, 2**30, 0.5]])
+    history.record('application_2', 500 * 2**20, 1.5, now=200)
+    history.record('application_2', 400 * 2**20, 0.1, now=300)
+    assert history.to_state()[-1] == [
+        'application_2', 300, 500 * 2**20, 1.5, None
+    ]
+    assert history.recommend(0.25) == (1280 * 2**20, 2)
+    history.trim(1, 1000, now=400)
+    assert history.recommend(0.0) == (512 * 2**20, 2)
+    history.trim(1, 10, now=400)
+    assert history.recommend() is None
+
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), right_sizing='apply',
+                          mem_limit='4 G', cpu_limit=4)
+    spawner.clear_state()
+    spawner.load_state({'usage': [['application_1', time.time(),
+                                   100 * 2**20, 0.2]]})
+    assert spawner.get_env()[USAGE_INTERVAL_ENV] == '10.0'
+
+    # Applied within bounds, and restored before the next start
+    spawner._load_profile()
+    spawner._right_size()
+    assert (spawner.mem_limit, spawner.cpu_limit) == (512 * 2**20, 1)
+    spawner.right_sizing_max_cpu = 8
+    spawner.right_sizing_min_mem = 0
+    spawner.usage_history.record('application_1', 6 * 2**30, 6)
+    spawner._load_profile()
+    spawner._right_size()
+    assert (spawner.mem_limit, spawner.cpu_limit) == (4 * 2**30, 8)
+
+    # Only recorded for the running application, and kept after stopping
+    spawner.app_id = 'application_2'
+    spawner.add_usage({'memory': 2**30, 'cpu': 1.0, 'final': True})
+    for bad in [{'memory': 'lots'}, {'cpu': -1}, {'cpu': 'inf'}, ['memory']]:
+        with pytest.raises(ValueError):
+            spawner.add_usage(bad)
+    spawner.clear_state()
+    assert [s[0] for s in spawner.get_state()['usage']] == [
+        'application_1', 'application_2'
+    ]
+
+    # Sized from sessions with the same profile only
+    history = UsageHistory([['app_1', 100, 2**30, 1],
+                            ['app_2', 200, 2**30, 1, 'small'],
+                            ['app_3', 300, 8 * 2**30, 4, 'large']])
+    assert history.recommend(0.0, profile='small') == (2**30, 1)
+    assert history.recommend(0.0, profile='large') == (8 * 2**30, 4)
+    assert history.recommend(0.0, profile='medium') is None
+    assert history.recommend(0.0) == (8 * 2**30, 4)
+    # Each profile keeps its own recent sessions
+    history.record('app_4', 2**30, 1, now=400, profile='small')
+    history.trim(1, 1000, now=400)
+    assert [s[0] for s in history.sessions] == ['app_1', 'app_3', 'app_4']
+
+    # Explicitly choosing a larger profile isn't undone by past usage
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), right_sizing='apply',
+                          profiles=[{'display_name': 'Small', 'mem_limit': '2 G'},
+                                    {'display_name': 'Large', 'mem_limit': '16 G'}])
+    spawner.load_state({'usage': [['application_1', time.time(), 2**30, 1,
+                                   'small']]})
+    spawner.user_options = {'profile': 'large'}
+    spawner._load_profile()
+    spawner._right_size()
+    assert spawner.mem_limit == 16 * 2**30
+    spawner.user_options = {'profile': 'small'}
+    spawner._load_profile()
+    spawner._right_size()
+    assert spawner.mem_limit == 1280 * 2**20
+
+
+@pytest.mark.asyncio
+async def test_idle_culler(fake_client):
+    now = datetime.datetime.utcnow()
+    spawners = []
+    # Active, idle, idle with a longer profile timeout, never called back
+    for i, idle in enumerate([10, 600, 600, 10]):
+        spawner = YarnSpawner(hub=Hub(), user=MockUser(), cull_interval=60,
+                              report_poll_interval=0.05,
+                              cull_idle_timeout=300, cull_callback_timeout=300,
+                              cull_concurrency=1)
+        spawner.clear_state()
+        spawner.orm_spawner = Mock(
+            last_activity=now - datetime.timedelta(seconds=idle), server=None
+        )
+        spawner.app_id = await fake_client.submit(None)
+        fake_client.set_state(spawner.app_id, 'RUNNING')
+        fake_client.apps[spawner.app_id].start_time = (
+            datetime.datetime.now() - datetime.timedelta(seconds=3600)
+        )
+        if i != 3:
+            spawner.set_port(1234)
+        assert await spawner.poll() is None
+        spawners.append(spawner)
+    spawners[2].cull_idle_timeout = 3600
+
+    culler = YarnSpawner.culler
+    assert len(culler) == 4
+    # Decided from the snapshot, without any requests
+    fake_client.calls.clear()
+    assert [s._cull_reason() and s._cull_reason()[0] for s in spawners] == [
+        None, 'idle', None, 'unresponsive'
+    ]
+    assert fake_client.calls == []
+
+    culled = await culler.cull()
+    assert sorted(culled) == [spawners[1].app_id, spawners[3].app_id]
+    for spawner, code in zip(spawners, [None, 0, None, 0]):
+        assert await spawner.poll() == code
+    assert len(culler) == 2
+
+    for spawner in spawners[::2]:
+        await spawner.stop()
+        spawner.clear_state()
+    assert len(culler) == 0
+
+
+@pytest.mark.asyncio
+async def test_failure_diagnostics(fake_client):
+    tail = LogTail(10)
+    tail.feed(b'0123456789')
+    tail.feed(b'abc')
+    assert tail.text() == '[... 3 bytes truncated ...]\n3456789abc'
+
+    spawner = YarnSpawner(hub=Hub(), user=MockUser(), failure_log_bytes=40,
+                          state_poll_interval=0.01)
+    spawner.clear_state()
+    collector = await spawner._get_diagnostics_collector()
+    collector.retry_delay = 0.01
+
+    class MissingCommand(object):
+        async def tail(self, app_id, max_bytes, user=''):
+            raise FileNotFoundError('yarn')
+
+    collector.command = MissingCommand()
+
+    async def fail_application():
+        while 'application_1' not in fake_client.apps:
+            await gen.sleep(0.01)
+        fake_client.set_state('application_1', 'FAILED', 'FAILED')
+        fake_client.apps['application_1'].diagnostics = 'Container exited'
+        fake_client.logs['application_1'] = {
+            'container_1': 'x' * 100 + '\nImportError: no module named foo'
+        }
+
+    failing = gen.convert_yielded(fail_application())
+    with pytest.raises(Exception) as exc:
+        await spawner.start()
+    await failing
+    msg = str(exc.value)
+    assert 'application_1 failed to start (FAILED)' in msg
+    assert 'Diagnostics: Container exited' in msg
+    assert 'ImportError: no module named foo' in msg
+    assert 'x' * 50 not in msg
+
+    # The full copy is kept for admins
+    entry, = YarnSpawner.failure_diagnostics()
+    assert entry.complete
+    assert entry.to_dict()['logs'].startswith('[... ')
@@ -0,0 +1,276 @@
+"""
+Lightweight tracing of server startup.
+
+A trace is a tree of spans sharing a ``trace_id``. The hub starts a trace for
+every spawn, and forwards the trace id to the singleuser server through its
+environment. The singleuser server sends its own spans back along with its
+port, so a single trace covers the whole startup. Finished spans are written
+to a file as JSON lines.
+"""
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from tornado.log import app_log
+
+
+TRACE_ID_ENV = 'YARNSPAWNER_TRACE_ID'
+PARENT_ID_ENV = 'YARNSPAWNER_TRACE_PARENT'
+SCRIPT_START_ENV = 'YARNSPAWNER_SCRIPT_START'
+
+
+_current_span = contextvars.ContextVar('yarnspawner_span', default=None)
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    """A timed operation within a trace.
+
+    Times are in seconds since the epoch, so spans from different hosts can
+    be compared (subject to clock skew).
+    """
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id',
+                 'service', 'start', 'end', 'attributes')
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, service=None,
+                 start=None, attributes=None, span_id=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id or _new_id()
+        self.parent_id = parent_id
+        self.service = service
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = dict(attributes or {})
+
+    def __repr__(self):
+        return 'Span<name=%r, trace_id=%r>' % (self.name, self.trace_id)
+
+    def child(self, name, start=None, **attributes):
+        """Start a new span with this span as its parent"""
+        return Span(self.tracer, name, self.trace_id, parent_id=self.span_id,
+                    service=self.service, start=start, attributes=attributes)
+
+    def finish(self, end=None):
+        """End the span, and export it"""
+        if self.end is None:
+            self.end = time.time() if end is None else end
+            if self.tracer is not None:
+                self.tracer.export(self)
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'service': self.service,
+                'start': self.start,
+                'end': self.end,
+                'duration': None if self.end is None else self.end - self.start,
+                'attributes': self.attributes}
+
+    @classmethod
+    def from_dict(cls, tracer, obj):
+        span = cls(tracer, obj['name'], obj['trace_id'],
+                   parent_id=obj.get('parent_id'),
+                   service=obj.get('service'),
+                   start=obj['start'],
+                   attributes=obj.get('attributes'),
+                   span_id=obj.get('span_id'))
+        span.end = obj.get('end')
+        return span
+
+
+class JSONLinesExporter(object):
+    """Append spans to a file, one JSON object per line.
+
+    Spans are written by a background thread, which keeps the file open and
+    flushes it whenever there's nothing left to write, so exporting never
+    blocks on the filesystem."""
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def export(self, span):
+        self._queue.put(json.dumps(span.to_dict(), sort_keys=True) + '\n')
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._write, name='yarnspawner-traces',
+                        daemon=True
+                    )
+                    self._thread.start()
+
+    def flush(self):
+        """Wait until all exported spans are written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Write any remaining spans, and close the file"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _write(self):
+        f = None
+        try:
+            while True:
+                line = self._queue.get()
+                try:
+                    if line is None:
+                        return
+                    if f is None:
+                        f = open(self.path, 'a')
+                    f.write(line)
+                    if self._queue.empty():
+                        f.flush()
+                except OSError as exc:
+                    app_log.warning("Failed to write trace to %s", self.path,
+                                    exc_info=exc)
+                finally:
+                    self._queue.task_done()
+        finally:
+            if f is not None:
+                f.close()
+
+
+class Tracer(object):
+    """Create spans, and export them when finished.
+
+    Parameters
+    ----------
+    exporter : object
+        An object with an ``export(span)`` method, or None to drop spans.
+    service : str, optional
+        The name of the service creating spans.
+    """
+    def __init__(self, exporter=None, service='hub'):
+        self.exporter = exporter
+        self.service = service
+
+    def start_trace(self, name, **attributes):
+        """Start a new root span"""
+        return Span(self, name, uuid.uuid4().hex, service=self.service,
+                    attributes=attributes)
+
+    def export(self, span):
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+
+def current_span():
+    """The active span in this context, or None"""
+    return _current_span.get()
+
+
+@contextmanager
+def activate(span):
+    """Make ``span`` the active span within the block"""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+def detach():
+    """Clear the active span for the current task.
+
+    Background tasks copy the context they're created in, call this so their
+    work isn't attributed to whichever spawn happened to start them."""
+    _current_span.set(None)
+
+
+@contextmanager
+def child_span(name, **attributes):
+    """Time the block as a child of the active span, if any"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.child(name, **attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.attributes['error'] = repr(exc)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.finish()
+
+
+def process_start_time():
+    """The wall clock time this process started, or None if unknown"""
+    try:
+        with open('/proc/self/stat') as f:
+            # The process name may contain spaces, fields follow the last ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        start_ticks = int(fields[19])
+        with open('/proc/stat') as f:
+            boot = next(int(l.split()[1]) for l in f if l.startswith('btime'))
+        return boot + start_ticks / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return None
+
+
+class ContainerTrace(object):
+    """Spans recorded by the singleuser server, to send back to the hub.
+
+    Only active if the hub started a trace for this server."""
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        self.trace_id = environ.get(TRACE_ID_ENV)
+        self.parent_id = environ.get(PARENT_ID_ENV)
+        self.spans = []
+        if not self.trace_id:
+            return
+        self._last = time.time()
+        script_start = environ.get(SCRIPT_START_ENV)
+        process_start = process_start_time()
+        if script_start and process_start:
+            self.add('prologue', float(script_start), process_start)
+        if process_start:
+            self._last = process_start
+            self.mark('imports')
+
+    @property
+    def enabled(self):
+        return bool(self.trace_id)
+
+    def add(self, name, start, end, **attributes):
+        if not self.enabled:
+            return
+        span = Span(None, name, self.trace_id, parent_id=self.parent_id,
+                    service='singleuser', start=start, attributes=attributes)
+        span.end = end
+        self.spans.append(span)
+
+    def mark(self, name):
+        """End a span started at the end of the previous one"""
+        if not self.enabled:
+            return
+        now = time.time()
+        self.add(name, self._last, now)
+        self._last = now
+
+    def to_json(self):
+        """The payload to include in the port callback"""
+        return {'trace_id': self.trace_id,
+                'sent': time.time(),
+                'spans': [s.to_dict() for s in self.spans]}
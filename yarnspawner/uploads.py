@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import os
+import posixpath
+import subprocess
+import time
+from datetime import datetime
+
+import skein
+from tornado.log import app_log
+
+from .tracing import detach
+
+
+def _walk(path):
+    """Sorted (relative path, full path) pairs for all files under ``path``"""
+    out = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            out.append((os.path.relpath(full, path), full))
+    return out
+
+
+def _stat_key(path):
+    """A key that changes whenever the contents at ``path`` may have"""
+    if os.path.isdir(path):
+        items = []
+        for rel, full in _walk(path):
+            st = os.stat(full)
+            items.append((rel, st.st_size, st.st_mtime_ns))
+        return (path, tuple(items))
+    st = os.stat(path)
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def content_digest(path, blocksize=2**20):
+    """The sha256 hex digest of a local file, or of all files in a local
+    directory (including their relative paths)"""
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = _walk(path)
+    else:
+        paths = [('', path)]
+    for rel, full in paths:
+        h.update(rel.encode() + b'\0')
+        with open(full, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def normalize_files(files):
+    """Convert a ``localize_files`` mapping to a mapping of ``skein.File``"""
+    return {k: (skein.File.from_dict(v) if isinstance(v, dict)
+                else skein.File(v) if isinstance(v, str)
+                else v)
+            for k, v in files.items()}
+
+
+class HDFSCommandLine(object):
+    """Filesystem operations using the ``hdfs dfs`` command line tool.
+
+    Operations are blocking, and use the credentials of the user JupyterHub
+    is running as.
+    """
+    def __init__(self, command='hdfs'):
+        self.command = command
+
+    def _run(self, *args, check=True):
+        proc = subprocess.run([self.command, 'dfs'] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if check and proc.returncode != 0:
+            raise RuntimeError("`hdfs dfs %s` failed:\n%s"
+                               % (' '.join(args), proc.stderr))
+        return proc
+
+    def exists(self, path):
+        return self._run('-test', '-e', path, check=False).returncode == 0
+
+    def mkdir(self, path):
+        self._run('-mkdir', '-p', path)
+
+    def put(self, local, path):
+        self._run('-put', local, path)
+
+    def chmod(self, mode, path, recursive=False):
+        args = ['-chmod'] + (['-R'] if recursive else []) + [mode, path]
+        self._run(*args)
+
+    def listdir(self, path):
+        """A list of ``(path, modification time)`` for entries in ``path``"""
+        out = []
+        for line in self._run('-ls', path).stdout.splitlines():
+            parts = line.split(None, 7)
+            if len(parts) != 8:
+                # The 'Found N items' header
+                continue
+            mtime = datetime.strptime('%s %s' % (parts[5], parts[6]),
+                                      '%Y-%m-%d %H:%M').timestamp()
+            out.append((parts[7], mtime))
+        return out
+
+    def remove(self, path):
+        self._run('-rm', '-r', '-skipTrash', path)
+
+
+class UploadCache(object):
+    """Upload local files to content addressed locations, once.
+
+    Local ``localize_files`` resources are uploaded by skein to a staging
+    directory for every application. Instead, each distinct version of a
+    resource is uploaded once to ``<directory>/<sha256>/<name>``, and
+    applications reference that path. Since the path is content addressed, a
+    cached upload is never stale. Unused versions are periodically removed.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to upload to, as a full URI, e.g.
+        ``hdfs:///jupyterhub/cache``.
+    executor : SkeinExecutor
+        The executor to run blocking operations in.
+    public : bool, optional
+        Whether archives without a configured visibility should be localized
+        with ``public`` visibility instead, allowing the NodeManagers to share
+        a single localized copy between applications. Public resources are
+        readable by all users, so other files are never made public.
+    max_age : float, optional
+        Versions unused for this long (in seconds) are removed.
+    gc_interval : float, optional
+        The time (in seconds) between removing unused versions.
+    fs : object, optional
+        The filesystem operations to use. Defaults to ``HDFSCommandLine``.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, directory, executor, public=False, max_age=7 * 86400,
+                 gc_interval=3600, fs=None, log=None):
+        if '://' not in directory:
+            raise ValueError("Upload cache directory must be a full URI "
+                             "(e.g. 'hdfs:///path'), got %r" % directory)
+        self.directory = directory.rstrip('/')
+        self.executor = executor
+        self.public = public
+        self.max_age = max_age
+        self.gc_interval = gc_interval
+        self.fs = fs or HDFSCommandLine()
+        self.log = log or app_log
+        # Digests by stat key, so unchanged files aren't rehashed
+        self._digests = {}
+        # Uploaded, and in-progress uploads, by (path, public)
+        self._uploaded = set()
+        self._pending = {}
+        # The last time each version directory was used by this process
+        self._last_used = {}
+        self._task = None
+
+    def _digest(self, path):
+        key = _stat_key(path)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = content_digest(path)
+        return digest
+
+    def _put(self, local, path, public):
+        parent = posixpath.dirname(path)
+        if not self.fs.exists(path):
+            self.fs.mkdir(parent)
+            try:
+                self.fs.put(local, path)
+            except Exception:
+                # Another process may have uploaded the same version
+                if not self.fs.exists(path):
+                    raise
+        if public:
+            # Public resources must be world readable, with all ancestors
+            # world executable.
+            self.fs.chmod('a+rX', parent, recursive=True)
+            self.fs.chmod('a+x', self.directory)
+
+    async def _upload(self, local, path, public):
+        key = (path, public)
+        if key in self._uploaded:
+            return
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = self._pending[key] = asyncio.ensure_future(
+                self.executor.run('upload', self._put, local, path, public)
+            )
+            fut.add_done_callback(lambda f: self._pending.pop(key, None))
+        await asyncio.shield(fut)
+        self._uploaded.add(key)
+
+    async def _resolve(self, file, promote=False):
+        source = file.source
+        if not source.startswith('file://'):
+            return file
+        local = source[len('file://'):]
+        digest = await self.executor.run('upload', self._digest, local)
+        version = '%s/%s' % (self.directory, digest)
+        path = '%s/%s' % (version, os.path.basename(local.rstrip('/')))
+        visibility = file.visibility
+        if promote and visibility == 'application' and file.type == 'archive':
+            visibility = 'public'
+        await self._upload(local, path, visibility == 'public')
+        self._last_used[version] = time.time()
+        return skein.File(source=path, type=file.type, visibility=visibility)
+
+    async def resolve(self, files):
+        """Replace local sources in a ``localize_files`` mapping with their
+        uploaded paths, uploading them if needed.
+
+        Returns a new mapping of ``skein.File`` objects.
+        """
+        # Only promote resources with the default visibility, not any
+        # configured explicitly
+        promote = {k for k, v in files.items()
+                   if self.public and (isinstance(v, str) or
+                                       (isinstance(v, dict) and
+                                        'visibility' not in v))}
+        files = normalize_files(files)
+        names = list(files)
+        resolved = await asyncio.gather(*(self._resolve(files[k], k in promote)
+                                          for k in names))
+        return dict(zip(names, resolved))
+
+    def _collect(self):
+        now = time.time()
+        removed = []
+        for path, mtime in self.fs.listdir(self.directory):
+            version = self.directory + '/' + path.rstrip('/').rsplit('/', 1)[-1]
+            last_used = max(mtime, self._last_used.get(version, 0))
+            if now - last_used > self.max_age:
+                self.fs.remove(version)
+                self._last_used.pop(version, None)
+                self._uploaded = {k for k in self._uploaded
+                                  if not k[0].startswith(version + '/')}
+                removed.append(version)
+        return removed
+
+    async def collect(self):
+        """Remove versions unused for longer than ``max_age``.
+
+        Returns a list of the removed version directories."""
+        removed = await self.executor.run('upload', self._collect)
+        if removed:
+            self.log.info("Removed %d unused uploads from %s",
+                          len(removed), self.directory)
+        return removed
+
+    def start(self):
+        """Start periodically removing unused versions, if not already"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        detach()
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                await self.collect()
+            except Exception as exc:
+                self.log.warning("Failed to remove unused uploads from %s",
+                                 self.directory, exc_info=exc)
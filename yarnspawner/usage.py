@@ -0,0 +1,278 @@
+"""
+Measure the peak resource usage of singleuser servers, and recommend limits
+from it.
+
+The singleuser server samples its container's memory and cpu usage, and
+reports the peaks to the hub. The hub keeps the peaks of each user's recent
+sessions in the spawner's state.
+"""
+import math
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+from tornado.log import app_log
+
+# Set by the hub to enable sampling, the interval between samples in seconds
+USAGE_INTERVAL_ENV = 'YARNSPAWNER_USAGE_INTERVAL'
+
+_CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().split()[0])
+
+
+def _read_stat(path, key):
+    with open(path) as f:
+        for line in f:
+            name, _, value = line.partition(' ')
+            if name == key:
+                return int(value)
+    return 0
+
+
+class CgroupSampler(object):
+    """Sample the usage of the cgroup YARN placed the container in.
+
+    Memory is the working set (usage less inactive page cache), matching what
+    the kernel can't reclaim before killing the container.
+    """
+    def __init__(self, memory_dir, cpu_dir, version):
+        self.memory_dir = memory_dir
+        self.cpu_dir = cpu_dir
+        self.version = version
+
+    @classmethod
+    def detect(cls, proc_cgroup='/proc/self/cgroup', root=_CGROUP_ROOT):
+        """The sampler for this process's container cgroup, or None if YARN
+        isn't using cgroups"""
+        try:
+            with open(proc_cgroup) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        paths = {}
+        for line in lines:
+            _, controllers, path = line.split(':', 2)
+            for c in controllers.split(','):
+                paths[c] = path
+        if '' in paths and 'container_' in paths['']:
+            d = os.path.join(root, paths[''].lstrip('/'))
+            return cls(d, d, 2)
+        if 'container_' in paths.get('memory', '') and 'cpuacct' in paths:
+            cpu_root = [c for c in os.listdir(root) if 'cpuacct' in c.split(',')]
+            if cpu_root:
+                return cls(
+                    os.path.join(root, 'memory', paths['memory'].lstrip('/')),
+                    os.path.join(root, cpu_root[0],
+                                 paths['cpuacct'].lstrip('/')),
+                    1
+                )
+        return None
+
+    def sample(self):
+        """The current ``(memory bytes, total cpu seconds)``"""
+        if self.version == 2:
+            memory = (_read_int(os.path.join(self.memory_dir, 'memory.current')) -
+                      _read_stat(os.path.join(self.memory_dir, 'memory.stat'),
+                                 'inactive_file'))
+            cpu = _read_stat(os.path.join(self.cpu_dir, 'cpu.stat'),
+                             'usage_usec') / 1e6
+        else:
+            memory = (_read_int(os.path.join(self.memory_dir,
+                                             'memory.usage_in_bytes')) -
+                      _read_stat(os.path.join(self.memory_dir, 'memory.stat'),
+                                 'total_inactive_file'))
+            cpu = _read_int(os.path.join(self.cpu_dir, 'cpuacct.usage')) / 1e9
+        return max(memory, 0), cpu
+
+
+class ProcessTreeSampler(object):
+    """Sample the usage of all processes in this process's session.
+
+    YARN starts each container in a new session, and (without cgroups)
+    enforces memory limits on the total resident memory of its processes.
+    Cpu time of exited processes isn't counted.
+    """
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self.session = os.getsid(0)
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.ticks = os.sysconf('SC_CLK_TCK')
+
+    def sample(self):
+        """The current ``(memory bytes, total cpu seconds)``"""
+        memory = 0
+        ticks = 0
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.proc, pid, 'stat')) as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # The command may contain spaces, fields after it are fixed
+            fields = stat[stat.rfind(')') + 2:].split()
+            if int(fields[3]) != self.session:
+                continue
+            ticks += int(fields[11]) + int(fields[12])
+            memory += int(fields[21]) * self.page_size
+        return memory, ticks / self.ticks
+
+
+def default_sampler():
+    return CgroupSampler.detect() or ProcessTreeSampler()
+
+
+class UsageMonitor(object):
+    """Track the peak memory and cpu usage of the container.
+
+    Peak cpu is the most cores used on average between two samples.
+
+    Parameters
+    ----------
+    sampler : CgroupSampler or ProcessTreeSampler, optional
+        The sampler to use. Defaults to the container's cgroup if any,
+        otherwise its processes.
+    """
+    def __init__(self, sampler=None):
+        self.sampler = sampler or default_sampler()
+        self.peak_memory = 0
+        self.peak_cpu = 0.0
+        self.samples = 0
+        self._last = None
+        self._post = None
+        self._reported = None
+        self._callbacks = []
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """A monitor and its sample interval, or ``(None, 0)`` if not enabled
+        by the hub"""
+        environ = os.environ if environ is None else environ
+        interval = float(environ.get(USAGE_INTERVAL_ENV) or 0)
+        if interval <= 0:
+            return None, 0
+        return cls(), interval
+
+    def start(self, interval, post, report_interval=300):
+        """Start sampling every ``interval`` seconds on the current event
+        loop, sending new peaks with ``post`` every ``report_interval``
+        seconds. Reports are also sent before shutting down (see ``stop``),
+        but YARN may kill the container before the last one is sent."""
+        self._post = post
+        self.sample()
+        self._callbacks = [PeriodicCallback(self.sample, interval * 1000),
+                           PeriodicCallback(self.report,
+                                            report_interval * 1000)]
+        for callback in self._callbacks:
+            callback.start()
+
+    def stop(self):
+        """Stop sampling, and send the final report"""
+        for callback in self._callbacks:
+            callback.stop()
+        self.sample()
+        self.report(final=True)
+
+    def sample(self):
+        try:
+            memory, cpu = self.sampler.sample()
+        except (OSError, ValueError, IndexError):
+            return
+        now = time.monotonic()
+        self.samples += 1
+        self.peak_memory = max(self.peak_memory, memory)
+        if self._last is not None:
+            last_time, last_cpu = self._last
+            if now > last_time:
+                self.peak_cpu = max(self.peak_cpu,
+                                    (cpu - last_cpu) / (now - last_time))
+        self._last = (now, cpu)
+
+    def to_json(self, final=False):
+        """The payload to send to the hub"""
+        return {'memory': self.peak_memory,
+                'cpu': round(self.peak_cpu, 3),
+                'samples': self.samples,
+                'final': final}
+
+    def report(self, final=False):
+        """Send the peaks to the hub, if changed since the last report"""
+        if self._post is None or not self.samples:
+            return
+        peaks = (self.peak_memory, self.peak_cpu)
+        if peaks == self._reported and not final:
+            return
+        try:
+            self._post({'usage': self.to_json(final)})
+        except Exception as exc:
+            app_log.warning("Failed to report resource usage", exc_info=exc)
+            return
+        self._reported = peaks
+
+
+class UsageHistory(object):
+    """The peak usage of a user's recent sessions, by profile.
+
+    Parameters
+    ----------
+    sessions : list, optional
+        ``[app_id, time, memory, cpu, profile]`` for each session, as stored
+        in the spawner's state. ``profile`` is the slug of the session's
+        profile, or None without profiles.
+    """
+    def __init__(self, sessions=None):
+        # Sessions stored before profiles were recorded have no profile
+        self.sessions = [(list(s) + [None])[:5] for s in sessions or ()]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def to_state(self):
+        return [list(s) for s in self.sessions]
+
+    def record(self, app_id, memory, cpu, now=None, profile=None):
+        """Update the peaks of a session"""
+        now = time.time() if now is None else now
+        for session in self.sessions:
+            if session[0] == app_id:
+                session[1] = now
+                session[2] = max(session[2], memory)
+                session[3] = max(session[3], cpu)
+                return
+        self.sessions.append([app_id, now, memory, cpu, profile])
+
+    def trim(self, max_sessions, max_age, now=None):
+        """Drop all but the newest ``max_sessions`` sessions of each profile,
+        and any older than ``max_age`` seconds"""
+        now = time.time() if now is None else now
+        sessions = [s for s in self.sessions if now - s[1] <= max_age]
+        sessions.sort(key=lambda s: s[1], reverse=True)
+        counts = {}
+        kept = []
+        for session in sessions:
+            count = counts[session[4]] = counts.get(session[4], 0) + 1
+            if count <= max_sessions:
+                kept.append(session)
+        self.sessions = kept[::-1]
+
+    def recommend(self, headroom=0.25, memory_increment=256 * 2**20,
+                  profile=None):
+        """Recommended ``(mem_limit, cpu_limit)``, or None without history.
+
+        Each is the largest peak over the sessions of ``profile`` (or all
+        sessions if None), plus ``headroom`` (a fraction of the peak). Memory
+        is rounded up to ``memory_increment`` bytes, and cpu up to a whole
+        core."""
+        sessions = [s for s in self.sessions
+                    if profile is None or s[4] == profile]
+        if not sessions:
+            return None
+        memory = max(s[2] for s in sessions) * (1 + headroom)
+        cpu = max(s[3] for s in sessions) * (1 + headroom)
+        memory = int(math.ceil(memory / memory_increment)) * memory_increment
+        return max(memory, memory_increment), max(int(math.ceil(cpu)), 1)
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+from tornado.log import app_log
+
+from .poller import _STOPPED_STATES
+from .tracing import detach
+
+
+# The key in the application key-value store holding a user assignment.
+ASSIGNMENT_KEY = 'yarnspawner.assignment'
+
+
+class StandbyApp(object):
+    """An idle application waiting to be bound to a user"""
+    __slots__ = ('app_id', 'security', 'launched')
+
+    def __init__(self, app_id, security, launched=None):
+        self.app_id = app_id
+        self.security = security
+        self.launched = time.monotonic() if launched is None else launched
+
+
+class WarmPool(object):
+    """A pool of idle, pre-launched applications for a single profile.
+
+    Each application runs the configured prologue (localizing and activating
+    any environments), then waits for an assignment to be written to its
+    key-value store. Binding a user writes the user's environment and command
+    to the store, after which the application starts a singleuser server that
+    calls back to the hub as usual.
+
+    Parameters
+    ----------
+    client : ThreadedClient or AsyncioClient
+        The client to submit and kill applications with.
+    executor : SkeinExecutor
+        The executor to run blocking calls in.
+    poller : ApplicationPoller
+        The poller tracking application state.
+    credentials : CredentialPool
+        The pool to take application credentials from.
+    build_request : callable
+        Called with a ``skein.Security`` to build a serialized standby
+        application specification.
+    target : callable
+        Called with no arguments to get the desired number of idle
+        applications.
+    max_idle : float, optional
+        Idle applications older than this (in seconds) are replaced.
+    interval : float, optional
+        The time (in seconds) between maintenance passes.
+    log : logging.Logger, optional
+        The logger to use.
+    """
+    def __init__(self, client, executor, poller, credentials, build_request,
+                 target, max_idle=3600, interval=60, log=None):
+        self.client = client
+        self.executor = executor
+        self.poller = poller
+        self.credentials = credentials
+        self.build_request = build_request
+        self.target = target
+        self.max_idle = max_idle
+        self.interval = interval
+        self.log = log or app_log
+        self._idle = deque()
+        self._launching = 0
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _state(self, standby):
+        report = self.poller.get(standby.app_id)
+        return None if report is None else str(report.state)
+
+    def _expired(self, standby):
+        return time.monotonic() - standby.launched > self.max_idle
+
+    def _prune(self):
+        """Drop idle applications that have stopped"""
+        alive = deque()
+        for standby in self._idle:
+            if self._state(standby) in _STOPPED_STATES:
+                self.poller.untrack(standby.app_id)
+            else:
+                alive.append(standby)
+        self._idle = alive
+
+    async def acquire(self):
+        """Take an idle application from the pool, or None if empty.
+
+        Applications that are already running are preferred over those still
+        waiting to be scheduled."""
+        self._prune()
+        candidates = [s for s in self._idle if not self._expired(s)]
+        running = [s for s in candidates if self._state(s) == 'RUNNING']
+        choices = running or candidates
+        if not choices:
+            self.fill()
+            return None
+        standby = choices[0]
+        self._idle.remove(standby)
+        self.fill()
+        return standby
+
+    async def bind(self, standby, env, command):
+        """Assign a user to an idle application"""
+        assignment = json.dumps({'env': env, 'command': command}).encode()
+        sync_client = self.client.client
+
+        def put():
+            app = sync_client.connect(standby.app_id, wait=False,
+                                      security=standby.security)
+            try:
+                app.kv[ASSIGNMENT_KEY] = assignment
+            finally:
+                app.close()
+
+        await self.executor.run('bind', put)
+
+    def fill(self):
+        """Trigger a maintenance pass, starting the pool if needed"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+
+    def close(self):
+        """Stop maintaining the pool. Idle applications stop themselves once
+        ``max_idle`` has passed."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        detach()
+        while True:
+            try:
+                await self._maintain()
+            except Exception as exc:
+                self.log.warning("Failed to maintain warm pool", exc_info=exc)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _maintain(self):
+        self._prune()
+        target = max(self.target(), 0)
+
+        # Replace expired applications, and scale down if over target
+        remove = [s for s in self._idle if self._expired(s)]
+        keep = [s for s in self._idle if not self._expired(s)]
+        remove.extend(keep[target:])
+        for standby in remove:
+            self._idle.remove(standby)
+        if remove:
+            self.log.info("Stopping %d idle warm pool applications",
+                          len(remove))
+            await asyncio.gather(*(self.discard(s) for s in remove))
+
+        count = target - len(self._idle) - self._launching
+        if count > 0:
+            self.log.info("Launching %d warm pool applications", count)
+            await asyncio.gather(*(self._launch() for _ in range(count)))
+
+    async def discard(self, standby):
+        """Kill an application taken from the pool instead of binding it
+        (e.g. if binding failed)"""
+        self.poller.untrack(standby.app_id)
+        try:
+            await self.client.kill_application(standby.app_id)
+        except Exception as exc:
+            self.log.warning("Failed to kill warm pool application %s",
+                             standby.app_id, exc_info=exc)
+
+    async def _launch(self):
+        self._launching += 1
+        try:
+            security = await self.credentials.get()
+            msg = await self.executor.run('spec', self.build_request, security)
+            app_id = await self.client.submit(msg)
+        except Exception as exc:
+            self.log.warning("Failed to launch warm pool application",
+                             exc_info=exc)
+            return
+        finally:
+            self._launching -= 1
+        self.poller.track(app_id)
+        self._idle.append(StandbyApp(app_id, security))